@@ -0,0 +1,62 @@
+"""
+    Throughput of onboarding an event: creating users, giving each a token and topping their
+    uses up, one crud call per item against the bulk calls. Each path runs on its own fresh copy
+    of the schema in a temporary SQLite file, so DB_URL is not touched.
+    Run with `python -m benchmarks.bulk_admin [people]`.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from open_ai_token import crud, models, schemas
+
+
+def fresh_session(path: str):
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(engine)
+    statements = [0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(*args):
+        statements[0] += 1
+
+    return sessionmaker(bind=engine)(), statements
+
+
+def people(count: int) -> list:
+    return [schemas.UserCreate(slack_id=f"U{i:06}", name=f"Hacker {i}", email=f"hacker{i}@example.com") for i in range(count)]
+
+
+def per_item(db, users: list):
+    for user in users:
+        crud.create_user(db, user)
+    tokens = [crud.create_token(db, schemas.TokenCreate(user_id=user.slack_id)) for user in users]
+    for token in tokens:
+        token.uses_left = 1000
+        crud.update_token(db, token)
+
+
+def bulk(db, users: list):
+    crud.create_users(db, users)
+    tokens, _ = crud.create_tokens(db, [user.slack_id for user in users])
+    crud.update_tokens(db, {"uses_left": 1000}, tokens=[token["token"] for token in tokens])
+
+
+def main(count: int):
+    users = people(count)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, run in (("per item", per_item), ("bulk", bulk)):
+            db, statements = fresh_session(os.path.join(directory, f"{name.replace(' ', '_')}.db"))
+            started = time.perf_counter()
+            run(db, users)
+            elapsed = time.perf_counter() - started
+            db.close()
+            print(f"{name:<9} {count} people in {elapsed * 1000:8.1f} ms, {count / elapsed:8.0f} people/s, {statements[0]} statements")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,317 @@
+"""
+    Gateway overhead under load. Starts benchmarks.mock_openai and the gateway, on a throwaway
+    SQLite database, then runs every route against the mock directly and through the gateway at
+    the same concurrency. Reports throughput, the p50/p99 latency the gateway adds, database
+    statements per request and memory per concurrent stream.
+
+    Each run is appended to benchmarks/results/gateway.jsonl with the commit it measured and
+    compared with the last run with the same settings, so regressions show up across commits.
+    Run with `python -m benchmarks.gateway [--requests 500] [--concurrency 20] [--streams 100] [--no-save]`.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import httpx
+import orjson
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from open_ai_token import crud, models, schemas
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "benchmarks", "results", "gateway.jsonl")
+TOKEN = "benchmark-token"
+
+# The mock is slow enough to look like a network hop, fast enough that the gateway's own cost shows
+MOCK_TTFB_MS = 20
+MOCK_TOKENS_PER_SECOND = 50
+COMPLETION_TOKENS = 16
+
+
+class Scenario(NamedTuple):
+    name: str
+    route: str
+    method: str
+    path: Callable[[int], str]
+    body: Optional[Callable[[int], dict]] = None
+
+
+def chat(i: int, stream: bool = False) -> dict:
+    return {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": f"Say hello to hacker {i}"}], "max_tokens": COMPLETION_TOKENS, "stream": stream}
+
+
+SCENARIOS = (
+    Scenario("models", "/models", "GET", lambda i: "/models"),
+    Scenario("chat", "/chat/completions", "POST", lambda i: "/chat/completions", chat),
+    Scenario("chat stream", "/chat/completions", "POST", lambda i: "/chat/completions", lambda i: chat(i, stream=True)),
+    # Distinct inputs and batch ids, so neither the embeddings cache nor single-flight answers for upstream
+    Scenario("embeddings", "/embeddings", "POST", lambda i: "/embeddings", lambda i: {"model": "text-embedding-3-small", "input": [f"document {i}"]}),
+    Scenario("batch", "/batches/{batch_id}", "GET", lambda i: f"/batches/batch_{i}"),
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid: int) -> int:
+    # Linux only, which is where the gateway runs
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    raise RuntimeError("No VmRSS in /proc status")
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def git(*args) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def seed(path: str, tokens=()):
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    crud.create_user(db, schemas.UserCreate(slack_id="UBENCH", name="Benchmark", email="bench@example.com", gpt4_usage_allowed=True))
+    for token in (TOKEN, *tokens):
+        db.add(models.Token(token=token, user_id="UBENCH", uses_left=10 ** 9))
+    db.commit()
+    db.close()
+    engine.dispose()
+
+
+def environment(directory: str, mock: str, **overrides) -> dict:
+    """
+        Settings for the mock and a gateway on the database in `directory`, seeded with seed()
+    """
+    env = {key: value for key, value in os.environ.items() if key not in ("PROMETHEUS_MULTIPROC_DIR", "CAPTURE_FILE")}
+    env.update(
+        DB_URL=f"sqlite:///{os.path.join(directory, 'gateway.db')}",
+        OPEN_AI_BASE_URL=f"{mock}/v1",
+        OPEN_AI_KEY="sk-benchmark",
+        POLICY_FILE=os.path.join(directory, "policy.json"),
+        RATE_LIMIT="false",
+        # Measure the gateway's own cost, not how it queues past the per-family limits
+        SCHEDULER_LIMITS='{"*": 100000}',
+        SLOW_REQUEST_MS="1e9",
+        # SQLite has a single writer; large leases keep quota renewals from queueing behind the usage writer
+        QUOTA_LEASE_SIZE="1000",
+        MOCK_TTFB_MS=str(MOCK_TTFB_MS),
+        MOCK_TOKENS_PER_SECOND=str(MOCK_TOKENS_PER_SECOND),
+    )
+    env.update(overrides)
+    return env
+
+
+def start(args: List[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, env=env)
+
+
+def start_servers(env: dict, mock_port: int, gateway_port: int) -> List[subprocess.Popen]:
+    return [
+        start(["-m", "benchmarks.mock_openai", str(mock_port)], env),
+        start(["-m", "uvicorn", "open_ai_token.main:app", "--port", str(gateway_port), "--log-level", "warning", "--timeout-keep-alive", "120"], env),
+    ]
+
+
+async def wait_until_up(client: httpx.AsyncClient, url: str, process: subprocess.Popen):
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"{url} did not come up")
+
+
+async def load(client: httpx.AsyncClient, base: str, scenario: Scenario, requests: int, concurrency: int, offset: int = 0) -> dict:
+    """
+        Send `requests` requests, `concurrency` at a time, reading every response to the end
+    """
+    latencies: List[float] = []
+    errors = 0
+    numbers = iter(range(offset, offset + requests))
+
+    async def worker():
+        nonlocal errors
+        for i in numbers:
+            body = scenario.body(i) if scenario.body is not None else None
+            started = time.perf_counter()
+            async with client.stream(scenario.method, base + scenario.path(i), content=orjson.dumps(body) if body is not None else None) as resp:
+                async for _ in resp.aiter_raw():
+                    pass
+            latencies.append(time.perf_counter() - started)
+            if resp.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"latencies": latencies, "errors": errors, "throughput_rps": requests / elapsed}
+
+
+async def db_statements(client: httpx.AsyncClient, gateway: str) -> Dict[str, float]:
+    text = (await client.get(f"{gateway}/metrics")).text
+    return {route: float(value) for route, value in re.findall(r'^gateway_db_statements_total\{route="([^"]*)"\} (\S+)$', text, re.M)}
+
+
+async def memory_per_stream(client: httpx.AsyncClient, gateway: str, processes: List[subprocess.Popen], streams: int) -> float:
+    """
+        Keep `streams` streamed completions going at once, each read as it arrives, and see how much
+        the gateway grows. The mock and the gateway are killed afterwards rather than left to wind
+        down every stream.
+    """
+    pid = processes[-1].pid
+    before = rss_kb(pid)
+    started = asyncio.Event()
+    opened = [0]
+
+    async def hold(i: int):
+        body = dict(chat(i, stream=True), max_tokens=10 ** 6)
+        async with client.stream("POST", f"{gateway}/chat/completions", content=orjson.dumps(body)) as resp:
+            if resp.status_code != 200:
+                raise RuntimeError(f"Stream {i} failed with {resp.status_code}: {(await resp.aread())[:200]}")
+            counted = False
+            async for _ in resp.aiter_raw():
+                if not counted:
+                    counted = True
+                    opened[0] += 1
+                    if opened[0] == streams:
+                        started.set()
+
+    tasks = [asyncio.ensure_future(hold(i)) for i in range(streams)]
+    try:
+        await asyncio.wait_for(started.wait(), 60)
+        await asyncio.sleep(2)
+        during = rss_kb(pid)
+    finally:
+        for process in processes:
+            process.kill()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return max(during - before, 0) / streams
+
+
+async def run(requests: int, concurrency: int, streams: int) -> dict:
+    mock_port, gateway_port = free_port(), free_port()
+    mock, gateway = f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{gateway_port}"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "gateway.db")
+        seed(path)
+        env = environment(directory, mock, MOCK_COMPLETION_TOKENS=str(10 ** 6))
+        processes = start_servers(env, mock_port, gateway_port)
+        limits = httpx.Limits(max_connections=concurrency + streams, max_keepalive_connections=concurrency + streams)
+        try:
+            async with httpx.AsyncClient(limits=limits, timeout=120, headers={"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}) as client:
+                await wait_until_up(client, f"{mock}/health", processes[0])
+                await wait_until_up(client, f"{gateway}/metrics", processes[1])
+                routes = {}
+                for number, scenario in enumerate(SCENARIOS):
+                    offset = number * 3 * (requests + concurrency)
+                    # Warm up both sides first: connection pools, token cache, quota lease
+                    await load(client, f"{mock}/v1", scenario, concurrency, concurrency, offset)
+                    await load(client, gateway, scenario, concurrency, concurrency, offset)
+                    direct = await load(client, f"{mock}/v1", scenario, requests, concurrency, offset + concurrency)
+                    statements = await db_statements(client, gateway)
+                    through = await load(client, gateway, scenario, requests, concurrency, offset + concurrency + requests)
+                    statements = (await db_statements(client, gateway)).get(scenario.route, 0) - statements.get(scenario.route, 0)
+                    routes[scenario.name] = {
+                        "throughput_rps": round(through["throughput_rps"], 1),
+                        "p50_ms": round(percentile(through["latencies"], 0.5) * 1000, 2),
+                        "p99_ms": round(percentile(through["latencies"], 0.99) * 1000, 2),
+                        "added_p50_ms": round((percentile(through["latencies"], 0.5) - percentile(direct["latencies"], 0.5)) * 1000, 2),
+                        "added_p99_ms": round((percentile(through["latencies"], 0.99) - percentile(direct["latencies"], 0.99)) * 1000, 2),
+                        "db_statements_per_request": round(statements / requests, 2),
+                        "errors": through["errors"],
+                    }
+                memory = await memory_per_stream(client, gateway, processes, streams)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "settings": {
+            "requests": requests,
+            "concurrency": concurrency,
+            "streams": streams,
+            "mock_ttfb_ms": MOCK_TTFB_MS,
+            "mock_tokens_per_second": MOCK_TOKENS_PER_SECOND,
+            "completion_tokens": COMPLETION_TOKENS,
+        },
+        "routes": routes,
+        "memory_per_stream_kb": round(memory, 1),
+    }
+
+
+def previous(settings: dict) -> Optional[dict]:
+    if not os.path.exists(RESULTS):
+        return None
+    with open(RESULTS, "rb") as f:
+        runs = [orjson.loads(line) for line in f if line.strip()]
+    return next((run for run in reversed(runs) if run["settings"] == settings), None)
+
+
+def report(result: dict, before: Optional[dict]):
+    def change(route: Optional[str], field: str, value: float) -> str:
+        if before is None:
+            return ""
+        old = before["routes"].get(route, {}).get(field) if route is not None else before.get(field)
+        return f" ({value - old:+.1f})" if old is not None else ""
+
+    print(f"commit {result['commit']}{' (dirty)' if result['dirty'] else ''}" + (f", compared with {before['commit']} from {before['created_at']}" if before else ""))
+    print(f"{'route':<12} {'req/s':>14} {'p50 ms':>9} {'p99 ms':>9} {'+p50 ms':>15} {'+p99 ms':>15} {'db/req':>7} {'errors':>6}")
+    for name, row in result["routes"].items():
+        print(
+            f"{name:<12} {row['throughput_rps']:>7.1f}{change(name, 'throughput_rps', row['throughput_rps']):>7} "
+            f"{row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} "
+            f"{row['added_p50_ms']:>7.2f}{change(name, 'added_p50_ms', row['added_p50_ms']):>8} "
+            f"{row['added_p99_ms']:>7.2f}{change(name, 'added_p99_ms', row['added_p99_ms']):>8} "
+            f"{row['db_statements_per_request']:>7.2f} {row['errors']:>6}"
+        )
+    memory = result["memory_per_stream_kb"]
+    print(f"memory per concurrent stream {memory:.1f} KB{change(None, 'memory_per_stream_kb', memory)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the gateway against a local mock of the OpenAI API")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--streams", type=int, default=100, help="concurrent streams to measure memory with")
+    parser.add_argument("--no-save", action="store_true", help=f"do not append the result to {os.path.relpath(RESULTS, ROOT)}")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.requests, args.concurrency, args.streams))
+    report(result, previous(result["settings"]))
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS), exist_ok=True)
+        with open(RESULTS, "ab") as f:
+            f.write(orjson.dumps(result) + b"\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+    Local stand-in for the OpenAI API, for benchmarking the gateway without spending anything.
+    Serves /v1/chat/completions (streamed or not), /v1/embeddings, /v1/models and /v1/batches.
+    Point the gateway at it with OPEN_AI_BASE_URL=http://127.0.0.1:8900/v1 and run it with
+    `python -m benchmarks.mock_openai [port]`.
+
+    MOCK_TTFB_MS          delay before the first byte of every response (default 50)
+    MOCK_TOKENS_PER_SECOND  rate streamed chat completions send tokens at (default 200)
+    MOCK_COMPLETION_TOKENS  tokens per completion unless max_tokens asks for fewer (default 16)
+    MOCK_EMBEDDING_DIMENSIONS  length of each embedding (default 1536)
+"""
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+import orjson
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+
+TTFB = float(os.getenv("MOCK_TTFB_MS", "50")) / 1000
+TOKENS_PER_SECOND = float(os.getenv("MOCK_TOKENS_PER_SECOND", "200"))
+COMPLETION_TOKENS = int(os.getenv("MOCK_COMPLETION_TOKENS", "16"))
+EMBEDDING_DIMENSIONS = int(os.getenv("MOCK_EMBEDDING_DIMENSIONS", "1536"))
+MODELS = ("gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo", "text-embedding-3-small", "dall-e-3")
+
+app = FastAPI(title="Mock OpenAI API")
+_ids = itertools.count(1)
+_batches = {}
+
+
+def prompt_tokens(messages) -> int:
+    # Roughly four characters to a token, good enough for usage numbers
+    return max(1, sum(len(str(message.get("content", ""))) for message in messages) // 4)
+
+
+def chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> bytes:
+    return b"data: " + orjson.dumps({
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }) + b"\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = orjson.loads(await request.body())
+    model = body.get("model", "gpt-4o")
+    completion_id = f"chatcmpl-mock{next(_ids)}"
+    prompt = prompt_tokens(body.get("messages", []))
+    tokens = min(COMPLETION_TOKENS, body.get("max_completion_tokens") or body.get("max_tokens") or COMPLETION_TOKENS)
+    usage = {"prompt_tokens": prompt, "completion_tokens": tokens, "total_tokens": prompt + tokens}
+    await asyncio.sleep(TTFB)
+
+    if not body.get("stream"):
+        await asyncio.sleep(tokens / TOKENS_PER_SECOND)
+        return ORJSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "lorem " * tokens}, "finish_reason": "length"}],
+            "usage": usage
+        })
+
+    async def events():
+        yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+        for _ in range(tokens):
+            await asyncio.sleep(1 / TOKENS_PER_SECOND)
+            yield chunk(completion_id, model, {"content": "lorem "})
+        yield chunk(completion_id, model, {}, "length")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield b"data: " + orjson.dumps({"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}) + b"\n\n"
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = orjson.loads(await request.body())
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    await asyncio.sleep(TTFB)
+    vector = [0.001 * i for i in range(EMBEDDING_DIMENSIONS)]
+    tokens = sum(max(1, len(str(text)) // 4) for text in inputs)
+    return ORJSONResponse({
+        "object": "list",
+        "model": body.get("model", "text-embedding-3-small"),
+        "data": [{"object": "embedding", "index": i, "embedding": vector} for i in range(len(inputs))],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+    })
+
+
+@app.get("/v1/models")
+async def models():
+    await asyncio.sleep(TTFB)
+    return ORJSONResponse({"object": "list", "data": [{"id": model, "object": "model", "owned_by": "mock"} for model in MODELS]})
+
+
+@app.get("/v1/models/{model}")
+async def model(model: str):
+    await asyncio.sleep(TTFB)
+    if model not in MODELS:
+        return ORJSONResponse({"error": {"message": f"The model {model} does not exist", "type": "invalid_request_error"}}, status_code=404)
+    return ORJSONResponse({"id": model, "object": "model", "owned_by": "mock"})
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    body = orjson.loads(await request.body())
+    await asyncio.sleep(TTFB)
+    batch_id = f"batch_mock{next(_ids)}"
+    _batches[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": body.get("endpoint"),
+        "input_file_id": body.get("input_file_id"),
+        "completion_window": body.get("completion_window", "24h"),
+        "status": "validating",
+        "created_at": int(time.time())
+    }
+    return ORJSONResponse(_batches[batch_id])
+
+
+@app.get("/v1/batches")
+async def list_batches():
+    await asyncio.sleep(TTFB)
+    return ORJSONResponse({"object": "list", "data": list(_batches.values()), "has_more": False})
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    await asyncio.sleep(TTFB)
+    batch = _batches.get(batch_id)
+    if batch is None:
+        # Unknown ids still answer, so load can be pointed at any id
+        batch = {"id": batch_id, "object": "batch", "status": "in_progress", "created_at": int(time.time())}
+    return ORJSONResponse(batch)
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    await asyncio.sleep(TTFB)
+    batch = _batches.get(batch_id)
+    if batch is None:
+        return ORJSONResponse({"error": {"message": f"No batch found with id {batch_id}", "type": "invalid_request_error"}}, status_code=404)
+    batch["status"] = "cancelling"
+    return ORJSONResponse(batch)
+
+
+@app.get("/health")
+async def health():
+    return Response(status_code=204)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Idle keep-alive connections are kept long enough that a pooled client never reuses a closing one
+    uvicorn.run(app, host="127.0.0.1", port=int(sys.argv[1]) if len(sys.argv) > 1 else 8900, log_level="warning", timeout_keep_alive=120)
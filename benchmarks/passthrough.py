@@ -0,0 +1,101 @@
+"""
+    CPU cost of handling a large request body: the old dict parse + re-serialize path against the
+    raw-bytes passthrough. Run with `python -m benchmarks.passthrough`.
+"""
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi import Depends, FastAPI, Request
+from pydantic import TypeAdapter
+
+from open_ai_token import passthrough
+
+
+def chat_body(messages: int, size: int) -> bytes:
+    text = "The quick brown fox jumps over the lazy dog. " * (size // 45)
+    return json.dumps({
+        "model": "gpt-4o",
+        "stream": True,
+        "messages": [{"role": "user" if i % 2 else "assistant", "content": text} for i in range(messages)],
+    }).encode()
+
+
+def embeddings_body(items: int) -> bytes:
+    return json.dumps({"model": "text-embedding-3-small", "input": [f"document number {i} " * 20 for i in range(items)]}).encode()
+
+
+_dict = TypeAdapter(dict)
+
+
+def old_path(raw: bytes) -> bytes:
+    # What FastAPI does for `data: dict`, then what httpx does for `json=data`
+    data = _dict.validate_python(json.loads(raw))
+    data = dict(data, stream_options={"include_usage": True})
+    return json.dumps(data).encode()
+
+
+def new_path(raw: bytes) -> bytes:
+    body = passthrough.JSONBody(raw)
+    return passthrough.with_stream_usage(body.raw)
+
+
+def cpu_per_call(fn, arg, rounds: int) -> float:
+    start = time.process_time()
+    for _ in range(rounds):
+        fn(arg)
+    return (time.process_time() - start) / rounds
+
+
+def micro():
+    print("body handling only")
+    for name, raw in [
+        ("chat, 200 x 2KB messages", chat_body(200, 2000)),
+        ("chat, 50 x 10KB messages", chat_body(50, 10000)),
+        ("embeddings, 2048 inputs", embeddings_body(2048)),
+    ]:
+        rounds = 50
+        old = cpu_per_call(old_path, raw, rounds)
+        new = cpu_per_call(new_path, raw, rounds)
+        print(f"  {name:<28} {len(raw) / 1024:8.0f} KB  dict {old * 1000:7.2f} ms  raw {new * 1000:7.2f} ms  {old / new:5.1f}x")
+
+
+def app(mode: str) -> FastAPI:
+    upstream = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})))
+    api = FastAPI()
+
+    if mode == "dict":
+        @api.post("/chat/completions")
+        async def chat(data: dict):
+            data = dict(data, stream_options={"include_usage": True})
+            resp = await upstream.post("http://upstream/v1/chat/completions", json=data)
+            return resp.json()
+    else:
+        async def json_body(request: Request) -> passthrough.JSONBody:
+            return passthrough.JSONBody(await request.body())
+
+        @api.post("/chat/completions")
+        async def chat(payload: passthrough.JSONBody = Depends(json_body)):
+            resp = await upstream.post("http://upstream/v1/chat/completions", content=passthrough.with_stream_usage(payload.raw))
+            return resp.json()
+
+    return api
+
+
+async def end_to_end():
+    print("whole request through FastAPI and httpx (no network)")
+    raw = chat_body(200, 2000)
+    for mode in ("dict", "raw"):
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app(mode)), base_url="http://gateway")
+        await client.post("/chat/completions", content=raw)
+        rounds = 50
+        start = time.process_time()
+        for _ in range(rounds):
+            await client.post("/chat/completions", content=raw)
+        print(f"  {mode:<4} {(time.process_time() - start) / rounds * 1000:7.2f} ms CPU per {len(raw) / 1024:.0f} KB request")
+
+
+if __name__ == "__main__":
+    micro()
+    asyncio.run(end_to_end())
@@ -0,0 +1,230 @@
+"""
+    Replays traffic recorded with CAPTURE_FILE against the gateway. Requests are sent at the
+    offsets they arrived at, divided by --speed, without waiting for earlier ones to finish, so
+    the recorded bursts and concurrency come back as they were. Bodies are rebuilt from the
+    recorded shape: same route, model, stream flag, number of messages or inputs and size.
+
+    By default starts benchmarks.mock_openai and a gateway on a throwaway SQLite database, with a
+    token for every recorded token hash so per-token caches and limits see the same spread. With
+    --gateway it replays against a running gateway instead, every request with --token.
+    Reports throughput and latency per route, how far sends fell behind schedule and the peak
+    concurrency reached next to the recorded one.
+    Run with `python -m benchmarks.replay capture.jsonl [--speed 1] [--limit N] [--gateway URL --token T] [--output report.json]`.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import orjson
+
+from benchmarks.gateway import COMPLETION_TOKENS, TOKEN, environment, free_port, percentile, seed, start_servers, wait_until_up
+
+# Ids the gateway forwards as they are; the mock answers for any batch id
+PATH_IDS = {"{batch_id}": "batch_replay{i}", "{job_id}": "ftjob-replay{i}"}
+
+
+def read(path: str, limit: Optional[int] = None) -> List[dict]:
+    with open(path, "rb") as f:
+        records = [orjson.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+
+def path(record: dict, i: int) -> str:
+    route = record["route"]
+    for placeholder, value in PATH_IDS.items():
+        route = route.replace(placeholder, value.format(i=i))
+    return route
+
+
+def _filled(texts: int, size: int, i: int) -> List[str]:
+    # Distinct per request, so the embeddings cache and single-flight do not answer in upstream's place
+    text = f"replay {i} "
+    pad = max(0, size // max(texts, 1) - len(text))
+    return [text + "x" * pad for _ in range(texts)]
+
+
+def body(record: dict, i: int) -> Optional[bytes]:
+    """
+        A body with the recorded shape, padded to about the recorded size
+    """
+    if record["method"] != "POST" or not record["body_bytes"]:
+        return None
+    route, model, items = record["route"], record.get("model"), record.get("items") or 1
+    data: Dict = {"model": model} if model else {}
+    if route == "/chat/completions":
+        data.update(messages=[{"role": "user", "content": ""}] * items, stream=record["stream"], max_tokens=record.get("max_tokens") or COMPLETION_TOKENS)
+        if record["stream"]:
+            data["stream_options"] = {"include_usage": True}
+    elif route == "/embeddings":
+        data["input"] = [""] * items
+    elif route == "/images/generations":
+        data["prompt"] = ""
+    elif route == "/batches":
+        data.update(input_file_id="file-replay", endpoint="/v1/chat/completions", completion_window="24h")
+    elif route == "/fine_tuning/jobs":
+        data["training_file"] = "file-replay"
+    size = record["body_bytes"] - len(orjson.dumps(data))
+    if route == "/chat/completions":
+        data["messages"] = [{"role": "user", "content": text} for text in _filled(items, size, i)]
+    elif route == "/embeddings":
+        data["input"] = _filled(items, size, i)
+    elif route == "/images/generations":
+        data["prompt"] = _filled(1, size, i)[0]
+    return orjson.dumps(data)
+
+
+def peak_concurrency(spans: List[tuple]) -> int:
+    events = sorted([(start, 1) for start, _ in spans] + [(end, -1) for _, end in spans])
+    peak = current = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+async def replay(client: httpx.AsyncClient, gateway: str, records: List[dict], speed: float, tokens: Dict[Optional[str], str]) -> dict:
+    """
+        Send every record at its offset from the first one, divided by `speed`
+    """
+    results: List[dict] = []
+    in_flight = peak = 0
+    first = records[0]["ts"]
+    loop = asyncio.get_running_loop()
+
+    async def send(i: int, record: dict, due: float):
+        nonlocal in_flight, peak
+        lag = loop.time() - due
+        in_flight += 1
+        peak = max(peak, in_flight)
+        started = time.perf_counter()
+        first_byte = None
+        status = None
+        try:
+            headers = {"Authorization": f"Bearer {tokens.get(record.get('token'), TOKEN)}", "Content-Type": "application/json"}
+            async with client.stream(record["method"], gateway + path(record, i), content=body(record, i), headers=headers) as resp:
+                async for _ in resp.aiter_raw():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+                status = resp.status_code
+        except httpx.HTTPError:
+            pass
+        finally:
+            in_flight -= 1
+        results.append({
+            "route": record["route"],
+            "stream": record["stream"],
+            "status": status,
+            "latency": time.perf_counter() - started,
+            "first_byte": first_byte,
+            "lag": lag,
+        })
+
+    started = loop.time()
+    tasks = []
+    for i, record in enumerate(records):
+        due = started + (record["ts"] - first) / speed
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(i, record, due)))
+    await asyncio.gather(*tasks)
+    return {"results": results, "elapsed": loop.time() - started, "peak_concurrency": peak}
+
+
+def summarize(records: List[dict], run: dict, speed: float) -> dict:
+    routes: Dict[str, List[dict]] = {}
+    for result in run["results"]:
+        name = result["route"] + (" (stream)" if result["stream"] else "")
+        routes.setdefault(name, []).append(result)
+    recorded = [(r["ts"], r["ts"] + r["total_ms"] / 1000) for r in records if r.get("total_ms") is not None]
+    lags = [result["lag"] for result in run["results"]]
+    return {
+        "requests": len(run["results"]),
+        "speed": speed,
+        "recorded_seconds": round(records[-1]["ts"] - records[0]["ts"], 3),
+        "elapsed_seconds": round(run["elapsed"], 3),
+        "throughput_rps": round(len(run["results"]) / run["elapsed"], 1) if run["elapsed"] else None,
+        "recorded_peak_concurrency": peak_concurrency(recorded) if recorded else None,
+        "peak_concurrency": run["peak_concurrency"],
+        "lag_p99_ms": round(percentile(lags, 0.99) * 1000, 2),
+        "routes": {
+            name: {
+                "requests": len(results),
+                "errors": sum(1 for result in results if result["status"] is None or result["status"] >= 400),
+                "throughput_rps": round(len(results) / run["elapsed"], 1) if run["elapsed"] else None,
+                "p50_ms": round(percentile([result["latency"] for result in results], 0.5) * 1000, 2),
+                "p99_ms": round(percentile([result["latency"] for result in results], 0.99) * 1000, 2),
+                "ttfb_p50_ms": round(percentile([result["first_byte"] for result in results if result["first_byte"] is not None] or [0.0], 0.5) * 1000, 2),
+            }
+            for name, results in sorted(routes.items())
+        },
+    }
+
+
+def report(summary: dict):
+    print(
+        f"{summary['requests']} requests recorded over {summary['recorded_seconds']:.1f}s replayed in {summary['elapsed_seconds']:.1f}s "
+        f"at {summary['speed']:g}x, {summary['throughput_rps']} req/s"
+    )
+    print(f"peak concurrency {summary['peak_concurrency']} (recorded {summary['recorded_peak_concurrency']}), p99 send lag {summary['lag_p99_ms']:.2f} ms")
+    print(f"{'route':<40} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'ttfb p50':>9}")
+    for name, row in summary["routes"].items():
+        print(
+            f"{name:<40} {row['requests']:>8} {row['errors']:>6} {row['throughput_rps']:>8.1f} "
+            f"{row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['ttfb_p50_ms']:>9.2f}"
+        )
+
+
+async def run(records: List[dict], speed: float, gateway: Optional[str], token: Optional[str]) -> dict:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=1000)
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        if gateway is not None:
+            result = await replay(client, gateway.rstrip("/"), records, speed, {None: token or TOKEN})
+            return summarize(records, result, speed)
+
+        hashes = {record["token"] for record in records if record.get("token")}
+        tokens = {token_hash: f"replay-{token_hash}" for token_hash in hashes}
+        mock_port, gateway_port = free_port(), free_port()
+        mock, gateway = f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{gateway_port}"
+        with tempfile.TemporaryDirectory() as directory:
+            seed(os.path.join(directory, "gateway.db"), tokens.values())
+            processes = start_servers(environment(directory, mock, MOCK_COMPLETION_TOKENS=str(COMPLETION_TOKENS)), mock_port, gateway_port)
+            try:
+                await wait_until_up(client, f"{mock}/health", processes[0])
+                await wait_until_up(client, f"{gateway}/metrics", processes[1])
+                result = await replay(client, gateway, records, speed, tokens)
+            finally:
+                for process in processes:
+                    process.terminate()
+                for process in processes:
+                    process.wait()
+        return summarize(records, result, speed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against the gateway")
+    parser.add_argument("capture", help="file written with CAPTURE_FILE")
+    parser.add_argument("--speed", type=float, default=1, help="how many times faster than recorded to send requests")
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("--gateway", help="URL of a running gateway to replay against, instead of starting one on the mock")
+    parser.add_argument("--token", help="token to send with --gateway")
+    parser.add_argument("--output", help="also write the report to this file as JSON")
+    args = parser.parse_args()
+
+    records = read(args.capture, args.limit)
+    if not records:
+        parser.error(f"{args.capture} has no requests")
+    summary = asyncio.run(run(records, args.speed, args.gateway, args.token))
+    report(summary)
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    main()
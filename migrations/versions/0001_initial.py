@@ -0,0 +1,60 @@
+"""
+    Initial schema, as created by Base.metadata.create_all before migrations existed
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("slack_id", sa.String(), primary_key=True),
+        sa.Column("name", sa.String()),
+        sa.Column("email", sa.String(), nullable=True),
+        sa.Column("is_admin", sa.Boolean()),
+        sa.Column("is_club_leader", sa.Boolean()),
+        sa.Column("can_use_superpowers", sa.Boolean()),
+        sa.Column("image_usage_allowed", sa.Boolean()),
+        sa.Column("gpt4_usage_allowed", sa.Boolean()),
+        sa.Column("is_banned", sa.Boolean()),
+        sa.Column("is_active", sa.Boolean()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_table(
+        "tokens",
+        sa.Column("token", sa.String(), primary_key=True),
+        sa.Column("user_id", sa.String(), sa.ForeignKey("users.slack_id")),
+        sa.Column("is_active", sa.Boolean()),
+        sa.Column("is_revoked", sa.Boolean()),
+        sa.Column("is_expired", sa.Boolean()),
+        sa.Column("is_blocked", sa.Boolean()),
+        sa.Column("uses_left", sa.Integer()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_table(
+        "usages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("request_data", sa.Text()),
+        sa.Column("response_data", sa.Text()),
+        sa.Column("token_id", sa.String(), sa.ForeignKey("tokens.token")),
+        sa.Column("endpoint", sa.String()),
+    )
+    op.create_index("ix_usages_id", "usages", ["id"])
+
+
+def downgrade():
+    op.drop_index("ix_usages_id", table_name="usages")
+    op.drop_table("usages")
+    op.drop_table("tokens")
+    op.drop_table("users")
@@ -0,0 +1,33 @@
+"""
+    Structured usage fields parsed from upstream responses
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("usages") as batch:
+        batch.add_column(sa.Column("model", sa.String(), nullable=True))
+        batch.add_column(sa.Column("prompt_tokens", sa.Integer(), nullable=True))
+        batch.add_column(sa.Column("completion_tokens", sa.Integer(), nullable=True))
+        batch.add_column(sa.Column("total_tokens", sa.Integer(), nullable=True))
+        batch.add_column(sa.Column("finish_reason", sa.String(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("usages") as batch:
+        batch.drop_column("finish_reason")
+        batch.drop_column("total_tokens")
+        batch.drop_column("completion_tokens")
+        batch.drop_column("prompt_tokens")
+        batch.drop_column("model")
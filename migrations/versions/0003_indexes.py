@@ -0,0 +1,30 @@
+"""
+    Indexes for token lookups by owner, users by email and usage by token and time
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_users_email", "users", ["email"])
+    op.create_index("ix_tokens_user_id", "tokens", ["user_id"])
+    # usages can be large, so on Postgres build these without blocking the usage writer
+    with op.get_context().autocommit_block():
+        op.create_index("ix_usages_token_id_created_at", "usages", ["token_id", "created_at"], postgresql_concurrently=True)
+        op.create_index("ix_usages_created_at", "usages", ["created_at"], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index("ix_usages_created_at", table_name="usages")
+    op.drop_index("ix_usages_token_id_created_at", table_name="usages")
+    op.drop_index("ix_tokens_user_id", table_name="tokens")
+    op.drop_index("ix_users_email", table_name="users")
@@ -0,0 +1,31 @@
+"""
+    Status and latency columns on usage, and columns for compressed or offloaded bodies
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("usages") as batch:
+        batch.add_column(sa.Column("status_code", sa.Integer(), nullable=True))
+        batch.add_column(sa.Column("latency_ms", sa.Integer(), nullable=True))
+        batch.add_column(sa.Column("body", sa.LargeBinary(), nullable=True))
+        batch.add_column(sa.Column("body_ref", sa.String(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("usages") as batch:
+        batch.drop_column("body_ref")
+        batch.drop_column("body")
+        batch.drop_column("latency_ms")
+        batch.drop_column("status_code")
@@ -0,0 +1,77 @@
+"""
+    Range partition usages by created_at on Postgres
+
+The existing table becomes the partition for everything up to the end of the current period,
+so no rows are copied. New partitions are created ahead of time by open_ai_token.partitions.
+Other databases are left as they are. Downgrading does copy every row back into a plain table,
+so it needs room for a second copy of usages and holds the table locked while it runs.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 00:00:00
+"""
+import datetime
+
+from alembic import op
+
+from open_ai_token import partitions
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    boundary = partitions.next_period(partitions.period_start(datetime.datetime.now(datetime.timezone.utc)))
+    op.execute("UPDATE usages SET created_at = now() WHERE created_at IS NULL")
+    op.execute("ALTER TABLE usages ALTER COLUMN created_at SET NOT NULL")
+
+    op.execute("ALTER TABLE usages RENAME TO usages_legacy")
+    op.execute("ALTER TABLE usages_legacy RENAME CONSTRAINT usages_pkey TO usages_legacy_pkey")
+    op.execute("ALTER INDEX ix_usages_id RENAME TO ix_usages_legacy_id")
+    op.execute("ALTER INDEX ix_usages_token_id_created_at RENAME TO ix_usages_legacy_token_id_created_at")
+    op.execute("ALTER INDEX ix_usages_created_at RENAME TO ix_usages_legacy_created_at")
+
+    op.execute("CREATE TABLE usages (LIKE usages_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)")
+    op.execute("ALTER SEQUENCE usages_id_seq OWNED BY usages.id")
+    # The partition key has to be part of the primary key
+    op.execute("ALTER TABLE usages ADD CONSTRAINT usages_pkey PRIMARY KEY (id, created_at)")
+    op.execute("ALTER TABLE usages ADD CONSTRAINT usages_token_id_fkey FOREIGN KEY (token_id) REFERENCES tokens (token)")
+    op.execute("CREATE INDEX ix_usages_id ON usages (id)")
+    op.execute("CREATE INDEX ix_usages_token_id_created_at ON usages (token_id, created_at)")
+    op.execute("CREATE INDEX ix_usages_created_at ON usages (created_at)")
+
+    op.execute("ALTER TABLE usages_legacy DROP CONSTRAINT usages_legacy_pkey")
+    op.execute("ALTER TABLE usages_legacy ADD PRIMARY KEY (id, created_at)")
+    op.execute(
+        f"ALTER TABLE usages ATTACH PARTITION usages_legacy FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')"
+    )
+    # Catches rows past the last partition if maintenance ever falls behind
+    op.execute("CREATE TABLE usages_default PARTITION OF usages DEFAULT")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("ALTER TABLE usages RENAME TO usages_partitioned")
+    op.execute("ALTER INDEX usages_pkey RENAME TO usages_partitioned_pkey")
+    op.execute("ALTER INDEX ix_usages_id RENAME TO ix_usages_partitioned_id")
+    op.execute("ALTER INDEX ix_usages_token_id_created_at RENAME TO ix_usages_partitioned_token_id_created_at")
+    op.execute("ALTER INDEX ix_usages_created_at RENAME TO ix_usages_partitioned_created_at")
+
+    op.execute("CREATE TABLE usages (LIKE usages_partitioned INCLUDING DEFAULTS)")
+    # Moved over before the partitioned table goes, which would take the sequence with it
+    op.execute("ALTER SEQUENCE usages_id_seq OWNED BY usages.id")
+    op.execute("INSERT INTO usages SELECT * FROM usages_partitioned")
+    op.execute("ALTER TABLE usages ADD CONSTRAINT usages_pkey PRIMARY KEY (id)")
+    op.execute("ALTER TABLE usages ADD CONSTRAINT usages_token_id_fkey FOREIGN KEY (token_id) REFERENCES tokens (token)")
+    op.execute("ALTER TABLE usages ALTER COLUMN created_at DROP NOT NULL")
+    op.execute("CREATE INDEX ix_usages_id ON usages (id)")
+    op.execute("CREATE INDEX ix_usages_token_id_created_at ON usages (token_id, created_at)")
+    op.execute("CREATE INDEX ix_usages_created_at ON usages (created_at)")
+    # Drops every partition along with it
+    op.execute("DROP TABLE usages_partitioned")
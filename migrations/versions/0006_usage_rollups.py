@@ -0,0 +1,39 @@
+"""
+    Hourly and daily usage rollups per token and model
+
+Run `python -m open_ai_token.rollups backfill` afterwards to fill them from existing usage.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "usage_rollups",
+        sa.Column("period", sa.String(), primary_key=True),
+        sa.Column("bucket", sa.DateTime(), primary_key=True),
+        sa.Column("token_id", sa.String(), primary_key=True),
+        sa.Column("model", sa.String(), primary_key=True),
+        sa.Column("user_id", sa.String(), nullable=False, server_default=""),
+        sa.Column("requests", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("errors", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("prompt_tokens", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("completion_tokens", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("total_tokens", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.create_index("ix_usage_rollups_user_id_period_bucket", "usage_rollups", ["user_id", "period", "bucket"])
+
+
+def downgrade():
+    op.drop_index("ix_usage_rollups_user_id_period_bucket", table_name="usage_rollups")
+    op.drop_table("usage_rollups")
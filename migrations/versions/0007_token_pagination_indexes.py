@@ -0,0 +1,37 @@
+"""
+    Indexes for keyset pagination and filtering of tokens
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Pages are keyed on created_at, which has always been filled in by the database
+    op.execute("UPDATE tokens SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
+    op.create_index("ix_tokens_created_at_token", "tokens", ["created_at", "token"])
+    op.create_index("ix_tokens_user_id_created_at_token", "tokens", ["user_id", "created_at", "token"])
+    op.create_index("ix_tokens_uses_left", "tokens", ["uses_left"])
+    op.create_index(
+        "ix_tokens_blocked_created_at_token", "tokens", ["created_at", "token"],
+        postgresql_where=sa.text("is_blocked"), sqlite_where=sa.text("is_blocked = 1")
+    )
+    # Covered by ix_tokens_user_id_created_at_token
+    op.drop_index("ix_tokens_user_id", table_name="tokens")
+
+
+def downgrade():
+    op.create_index("ix_tokens_user_id", "tokens", ["user_id"])
+    op.drop_index("ix_tokens_blocked_created_at_token", table_name="tokens")
+    op.drop_index("ix_tokens_uses_left", table_name="tokens")
+    op.drop_index("ix_tokens_user_id_created_at_token", table_name="tokens")
+    op.drop_index("ix_tokens_created_at_token", table_name="tokens")
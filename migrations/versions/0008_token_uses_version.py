@@ -0,0 +1,25 @@
+"""
+    Version of a token's uses_left, so quota leases are not given back after it is overwritten
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("tokens") as batch:
+        batch.add_column(sa.Column("uses_version", sa.Integer(), nullable=False, server_default="0"))
+
+
+def downgrade():
+    with op.batch_alter_table("tokens") as batch:
+        batch.drop_column("uses_version")
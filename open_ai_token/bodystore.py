@@ -0,0 +1,153 @@
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import zlib
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Where request and response bodies of usage rows go. The structured columns (model, token
+# counts, status, latency) are always written; the bodies are the bulk of the table.
+#   inline      request_data / response_data as text, as before
+#   compressed  one zlib frame per row in the `body` column
+#   segments    zlib frames appended to segment files, the row keeps "file:offset:length" in `body_ref`
+#   none        bodies are not kept
+MODE = os.getenv("USAGE_BODY_STORAGE", "inline")
+# Fraction of bodies kept at all; error responses are always kept unless this is 0
+SAMPLE_RATE = float(os.getenv("USAGE_BODY_SAMPLE_RATE", "1"))
+SEGMENT_DIR = os.getenv("USAGE_SEGMENT_DIR", "./usage-segments")
+SEGMENT_MAX_BYTES = int(os.getenv("USAGE_SEGMENT_MAX_BYTES", str(256 * 1024 * 1024)))
+COMPRESSION_LEVEL = int(os.getenv("USAGE_BODY_COMPRESSION_LEVEL", "6"))
+
+_SEGMENT_NAME = re.compile(r"^usage-(\d{8})-\d+-\d+\.seg$")
+_lock = threading.Lock()
+_segment: Optional[str] = None
+_segment_size = 0
+_segment_sequence = 0
+
+
+def _text(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        # Request bodies passed through as they arrived
+        return value.decode("utf-8", "replace")
+    if isinstance(value, str):
+        return value if value.strip() else None
+    return json.dumps(value, default=str)
+
+
+def _keep(record: dict) -> bool:
+    if SAMPLE_RATE <= 0:
+        return False
+    if (record.get("status_code") or 0) >= 400:
+        return True
+    return SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE
+
+
+def _frame(request: Optional[str], response: Optional[str]) -> bytes:
+    return zlib.compress(json.dumps([request, response]).encode(), COMPRESSION_LEVEL)
+
+
+def _unframe(frame: bytes) -> Tuple[Optional[str], Optional[str]]:
+    request, response = json.loads(zlib.decompress(frame))
+    return request, response
+
+
+def _open_segment(size: int) -> str:
+    """
+        The segment file to append `size` more bytes to, starting a new one when it would grow too big.
+        Files are per process so workers never interleave their writes.
+    """
+    global _segment, _segment_size, _segment_sequence
+    today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+    if _segment is None or _segment_size + size > SEGMENT_MAX_BYTES or not _segment.startswith(f"usage-{today}-"):
+        os.makedirs(SEGMENT_DIR, exist_ok=True)
+        while True:
+            _segment_sequence += 1
+            _segment = f"usage-{today}-{os.getpid()}-{_segment_sequence}.seg"
+            if not os.path.exists(os.path.join(SEGMENT_DIR, _segment)):
+                break
+        _segment_size = 0
+    return _segment
+
+
+def _append(frames: List[bytes]) -> List[str]:
+    """
+        Append frames to the current segment in one write and return their references
+    """
+    global _segment_size
+    with _lock:
+        name = _open_segment(sum(len(frame) for frame in frames))
+        refs = []
+        offset = _segment_size
+        for frame in frames:
+            refs.append(f"{name}:{offset}:{len(frame)}")
+            offset += len(frame)
+        with open(os.path.join(SEGMENT_DIR, name), "ab") as f:
+            f.write(b"".join(frames))
+        _segment_size = offset
+    return refs
+
+
+def prepare(batch: List[dict]) -> List[dict]:
+    """
+        Turn queued usage records into rows, storing their bodies according to MODE.
+        Runs in the usage writer's thread.
+    """
+    pending = []
+    for record in batch:
+        request = _text(record.pop("request_data", None))
+        response = _text(record.pop("response_data", None))
+        if MODE == "none" or (request is None and response is None) or not _keep(record):
+            continue
+        if MODE == "compressed":
+            record["body"] = _frame(request, response)
+        elif MODE == "segments":
+            pending.append((record, _frame(request, response)))
+        else:
+            record["request_data"] = request
+            record["response_data"] = response
+    if pending:
+        for (record, _), ref in zip(pending, _append([frame for _, frame in pending])):
+            record["body_ref"] = ref
+    return batch
+
+
+def load(usage) -> Tuple[Optional[str], Optional[str]]:
+    """
+        The request and response bodies of a usage row, wherever they were stored
+    """
+    if usage.body is not None:
+        return _unframe(usage.body)
+    if usage.body_ref:
+        name, offset, length = usage.body_ref.rsplit(":", 2)
+        try:
+            with open(os.path.join(SEGMENT_DIR, name), "rb") as f:
+                f.seek(int(offset))
+                return _unframe(f.read(int(length)))
+        except FileNotFoundError:
+            # Pruned by retention
+            return None, None
+    return usage.request_data, usage.response_data
+
+
+def prune_segments(cutoff: datetime.datetime) -> int:
+    """
+        Delete segment files from days entirely before `cutoff`
+    """
+    if not os.path.isdir(SEGMENT_DIR):
+        return 0
+    removed = 0
+    cutoff_day = cutoff.strftime("%Y%m%d")
+    for name in os.listdir(SEGMENT_DIR):
+        match = _SEGMENT_NAME.match(name)
+        if match and match.group(1) < cutoff_day and name != _segment:
+            os.remove(os.path.join(SEGMENT_DIR, name))
+            removed += 1
+    return removed
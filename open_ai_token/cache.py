@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+# Returned by TTLCache.get when nothing is cached, so None can be cached as a value
+MISSING = object()
+
+
+class TTLCache:
+    """
+        Bounded LRU cache whose entries expire after a time to live. maxsize bounds the number of
+        entries, or the total of weigh(value) over all entries when weigh is given.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None, weigh: Optional[Callable[[Any], int]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, value: Any):
+        if self.weigh is not None:
+            self.weight -= self.weigh(value)
+
+    def _full(self) -> bool:
+        return (self.weight if self.weigh is not None else len(self._data)) > self.maxsize
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._drop(value)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            old = self._data.get(key, MISSING)
+            if old is not MISSING:
+                self._drop(old[0])
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            if self.weigh is not None:
+                self.weight += self.weigh(value)
+            while self._data and self._full():
+                self._drop(self._data.popitem(last=False)[1][0])
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, MISSING)
+            if entry is not MISSING:
+                self._drop(entry[0])
+        return default if entry is MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+        if self.weigh is not None:
+            stats["weight"] = self.weight
+        return stats
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import random
+import secrets
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+import anyio
+import orjson
+from dotenv import load_dotenv
+
+from open_ai_token import metrics
+
+load_dotenv()
+
+# Opt-in capture of request shapes for replaying realistic load (see benchmarks/replay.py).
+# When CAPTURE_FILE is set, a sample of requests to the OpenAI routes is appended to it as JSON
+# lines: when each arrived, its route, body size, model, stream flag and a few sizes, never
+# message contents. Tokens are recorded as a keyed hash, set the same CAPTURE_SALT on every
+# worker so one token hashes the same everywhere. Lines are buffered in memory and appended by a
+# background task in whole-line writes, so workers can share one file.
+FILE = os.getenv("CAPTURE_FILE")
+ENABLED = bool(FILE)
+SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "1"))
+SALT = os.getenv("CAPTURE_SALT", "").encode() or secrets.token_bytes(16)
+FLUSH_INTERVAL = float(os.getenv("CAPTURE_FLUSH_INTERVAL_MS", "1000")) / 1000
+# Lines waiting to be written past this are dropped rather than held in memory
+MAX_BUFFERED = int(os.getenv("CAPTURE_MAX_BUFFERED", "10000"))
+
+ROUTES = frozenset((
+    "/models",
+    "/chat/completions",
+    "/images/generations",
+    "/embeddings",
+    "/fine_tuning/jobs",
+    "/fine_tuning/jobs/{job_id}",
+    "/fine_tuning/jobs/{job_id}/events",
+    "/fine_tuning/jobs/{job_id}/checkpoints",
+    "/fine_tuning/jobs/{job_id}/cancel",
+    "/batches",
+    "/batches/{batch_id}",
+    "/batches/{batch_id}/cancel",
+))
+
+_lines: List[bytes] = []
+_writer = None
+_stats = {"captured": 0, "written": 0, "dropped": 0, "failed": 0}
+
+
+def token_hash(token: str) -> str:
+    return hmac.new(SALT, token.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _items(data: dict) -> Optional[int]:
+    for field in ("messages", "input", "prompt"):
+        value = data.get(field)
+        if isinstance(value, list):
+            return len(value)
+        if value is not None:
+            return 1
+    return None
+
+
+class _Capture:
+    __slots__ = ("body",)
+
+    def __init__(self):
+        self.body = None
+
+
+_current: ContextVar[Optional[_Capture]] = ContextVar("capture_request", default=None)
+
+
+class CaptureMiddleware:
+    """
+        Records the shape of sampled requests to the OpenAI routes. Only added when CAPTURE_FILE is set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or random.random() >= SAMPLE_RATE:
+            return await self.app(scope, receive, send)
+        current = _Capture()
+        reset = _current.set(current)
+        arrived = time.time()
+        started = time.perf_counter()
+        status = 500
+        first_byte: Optional[float] = None
+
+        async def send_with_status(message):
+            nonlocal status, first_byte
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                first_byte = time.perf_counter() - started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _current.reset(reset)
+            route = metrics.route_label(scope)
+            if route in ROUTES:
+                _record(scope, route, current.body, arrived, status, first_byte, time.perf_counter() - started)
+
+
+def _record(scope, route: str, body, arrived: float, status: int, first_byte: Optional[float], elapsed: float):
+    authorization = next((value for name, value in scope["headers"] if name == b"authorization"), b"")
+    token = authorization.decode("latin-1").partition(" ")[2]
+    data = body.data if body is not None else {}
+    line = {
+        "ts": round(arrived, 6),
+        "method": scope["method"],
+        "route": route,
+        "token": token_hash(token) if token else None,
+        "body_bytes": len(body.raw) if body is not None else 0,
+        "model": data.get("model") if isinstance(data.get("model"), str) else None,
+        "stream": data.get("stream") is True,
+        "items": _items(data),
+        "max_tokens": data.get("max_completion_tokens") or data.get("max_tokens"),
+        "status": status,
+        "first_byte_ms": round(first_byte * 1000, 1) if first_byte is not None else None,
+        "total_ms": round(elapsed * 1000, 1)
+    }
+    if len(_lines) >= MAX_BUFFERED:
+        _stats["dropped"] += 1
+        return
+    _lines.append(orjson.dumps(line, option=orjson.OPT_APPEND_NEWLINE))
+    _stats["captured"] += 1
+
+
+def set_body(body):
+    current = _current.get()
+    if current is not None:
+        current.body = body
+
+
+def _append(data: bytes):
+    fd = os.open(FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+async def _flush():
+    global _lines
+    if not _lines:
+        return
+    lines, _lines = _lines, []
+    try:
+        await anyio.to_thread.run_sync(_append, b"".join(lines))
+        _stats["written"] += len(lines)
+    except OSError as e:
+        _stats["failed"] += len(lines)
+        print(f"Writing captured requests failed: {e}")
+
+
+async def _run():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await _flush()
+
+
+async def startup():
+    global _writer
+    if ENABLED and _writer is None:
+        _writer = asyncio.create_task(_run())
+
+
+async def shutdown():
+    global _writer
+    if _writer is not None:
+        _writer.cancel()
+        try:
+            await _writer
+        except asyncio.CancelledError:
+            pass
+        _writer = None
+    if ENABLED:
+        await _flush()
+
+
+def stats() -> dict:
+    return dict(_stats, enabled=ENABLED, buffered=len(_lines))
@@ -0,0 +1,108 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+# send(data, items) -> (status, body, per-item results or None on an upstream error)
+Send = Callable[[dict, list], Awaitable[Tuple[int, dict, Optional[list]]]]
+
+
+class _Batch:
+    __slots__ = ("data", "items", "waiters", "timer")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.items: list = []
+        self.waiters: List[Tuple[asyncio.Future, int, int]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class Coalescer:
+    """
+        Hold small requests with identical parameters for up to `window` seconds and send their
+        items upstream as one array request, handing each caller back its own slice.
+
+        If the combined request fails, every caller is retried on its own, so one bad input only
+        fails the request it came from.
+    """
+
+    def __init__(self, send: Send, window: float, max_items: int):
+        self.send = send
+        self.window = window
+        self.max_items = max_items
+        self._pending: Dict[bytes, _Batch] = {}
+        self._stats = {"requests": 0, "batches": 0, "items": 0, "isolated_retries": 0}
+
+    async def submit(self, data: dict, items: list) -> Tuple[int, dict, Optional[list]]:
+        self._stats["requests"] += 1
+        if len(items) >= self.max_items:
+            self._stats["batches"] += 1
+            self._stats["items"] += len(items)
+            return await self.send(data, items)
+
+        key = orjson.dumps({k: v for k, v in data.items() if k != "input"}, option=orjson.OPT_SORT_KEYS)
+        batch = self._pending.get(key)
+        if batch is not None and len(batch.items) + len(items) > self.max_items:
+            self._dispatch(key, batch)
+            batch = None
+        loop = asyncio.get_running_loop()
+        if batch is None:
+            batch = _Batch(data)
+            batch.timer = loop.call_later(self.window, self._dispatch, key, batch)
+            self._pending[key] = batch
+
+        future = loop.create_future()
+        batch.waiters.append((future, len(batch.items), len(items)))
+        batch.items.extend(items)
+        if len(batch.items) >= self.max_items:
+            self._dispatch(key, batch)
+        return await future
+
+    def _dispatch(self, key: bytes, batch: _Batch):
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        self._stats["batches"] += 1
+        self._stats["items"] += len(batch.items)
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: _Batch):
+        try:
+            status, body, results = await self.send(batch.data, batch.items)
+        except Exception as e:
+            for future, _, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if results is None and len(batch.waiters) > 1:
+            self._stats["isolated_retries"] += len(batch.waiters)
+            await asyncio.gather(*(
+                self._alone(batch.data, batch.items[start:start + count], future)
+                for future, start, count in batch.waiters
+            ))
+            return
+
+        for future, start, count in batch.waiters:
+            if not future.done():
+                future.set_result((status, body, results[start:start + count] if results is not None else None))
+
+    async def _alone(self, data: dict, items: list, future: asyncio.Future):
+        try:
+            result = await self.send(data, items)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        batches = self._stats["batches"]
+        return dict(
+            self._stats,
+            pending=len(self._pending),
+            requests_per_batch=self._stats["requests"] / batches if batches else 0.0
+        )
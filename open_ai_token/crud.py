@@ -1,46 +1,66 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import cast, String
-
-from open_ai_token import models, schemas
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import String, and_, func, literal, or_, select, tuple_, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from dotenv import load_dotenv
+import os
+
+from open_ai_token import models, schemas, quota
+from open_ai_token.cache import TTLCache, MISSING
 import uuid
 
+load_dotenv()
+
+# Validated token state, so authentication does not hit the database on every request.
+# Unknown tokens are cached separately so junk traffic cannot evict real tokens.
+token_cache = TTLCache(
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL", "30"))
+)
+invalid_token_cache = TTLCache(
+    maxsize=int(os.getenv("INVALID_TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("INVALID_TOKEN_CACHE_TTL", "60"))
+)
+
 def check_token(db: Session, token: str):
-    que = db.query(models.Token).filter(cast(models.Token.token, String) == token)
-    if que.count() == 0:
-        return False
-    return True
+    return db.scalar(select(models.Token.token).where(models.Token.token == token)) is not None
 
 def get_user_by_slack_id(db: Session, slack_id: str):
-    que = db.query(models.User).filter(models.User.slack_id == slack_id)
-    if que.count() == 0:
-        return None
-    return que.first()
+    return db.get(models.User, slack_id)
 
 def get_user_by_email(db: Session, email: str):
-    que = db.query(models.User).filter(models.User.email == email)
-    if que.count() == 0:
-        return None
-    return que.first()
+    return db.query(models.User).filter(models.User.email == email).first()
 
 def get_user_by_slack_id_and_email(db: Session, slack_id: str, email: str):
-    que = db.query(models.User).filter(models.User.slack_id == slack_id, models.User.email == email)
-    if que.count() == 0:
+    db_user = db.get(models.User, slack_id)
+    if db_user is None or db_user.email != email:
         return None
-    return que.first()
+    return db_user
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
+def get_users(db: Session, skip: int = 0, limit: int = 100, after: str = None):
+    """
+    A page of users in slack_id order, starting after the slack_id `after` if given
+    """
     if limit > 100:
         limit = 100
     if skip < 0:
         skip = 0
-    que = db.query(models.User).offset(skip).limit(limit)
-    return que.all()
+    query = select(models.User).order_by(models.User.slack_id)
+    if after is not None:
+        query = query.where(models.User.slack_id > after)
+    if skip:
+        query = query.offset(skip)
+    return db.scalars(query.limit(limit)).all()
+
+def export_users_query(chunk_size: int = 1000):
+    """
+    Every user, to be streamed chunk_size rows at a time through a server-side cursor
+    """
+    return select(models.User.__table__).order_by(models.User.slack_id).execution_options(yield_per=chunk_size)
 
 def create_user(db: Session, user: schemas.UserCreate):
     # check if user exists
-    db_user = db.query(models.User).filter(models.User.slack_id == user.slack_id).first()
-    if db_user:
+    if db.get(models.User, user.slack_id) is not None:
         raise ValueError("User already exists")
     db_user = models.User(slack_id=user.slack_id, name=user.name, email=user.email, is_admin=user.is_admin, is_club_leader=user.is_club_leader, can_use_superpowers=user.can_use_superpowers, image_usage_allowed=user.image_usage_allowed, gpt4_usage_allowed=user.gpt4_usage_allowed, is_banned=user.is_banned, is_active=user.is_active)
     db.add(db_user)
@@ -49,116 +69,345 @@ def create_user(db: Session, user: schemas.UserCreate):
     return db_user
 
 def get_token(db: Session, token: str):
-    return db.query(models.Token).filter(models.Token.token == token).first()
+    return db.get(models.Token, token)
+
+def get_cached_token_state(token: str):
+    """
+    Return the cached state of a token, None if it is known to be invalid, or MISSING
+    """
+    state = token_cache.get(token, MISSING)
+    if state is not MISSING:
+        return state
+    if invalid_token_cache.get(token, MISSING) is not MISSING:
+        return None
+    return MISSING
 
-def get_tokens(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Token).offset(skip).limit(limit).all()
+def get_token_state(db: Session, token: str):
+    state = get_cached_token_state(token)
+    if state is not MISSING:
+        return state
 
-def create_token(db: Session, token: schemas.TokenCreate):
-    tk = uuid.uuid4()
-    if check_token(db, str(tk)):
-        raise ValueError("Token already exists")
+    db_token = db.query(models.Token).options(joinedload(models.Token.user)).filter(models.Token.token == token).first()
+    if db_token is None:
+        invalid_token_cache.set(token, True)
+        return None
 
-    print(tk)
-    db_token = models.Token(token=tk, user_id=token.user_id)
+    user = db_token.user
+    user_flags = {}
+    if user is not None:
+        user_flags = dict(
+            is_admin=user.is_admin,
+            is_club_leader=user.is_club_leader,
+            can_use_superpowers=user.can_use_superpowers,
+            image_usage_allowed=user.image_usage_allowed,
+            gpt4_usage_allowed=user.gpt4_usage_allowed,
+            is_banned=user.is_banned
+        )
+    state = schemas.TokenState(
+        token=str(db_token.token),
+        user_id=db_token.user_id,
+        is_active=db_token.is_active,
+        is_revoked=db_token.is_revoked,
+        is_expired=db_token.is_expired,
+        is_blocked=db_token.is_blocked,
+        uses_left=db_token.uses_left,
+        **user_flags
+    )
+    token_cache.set(token, state)
+    return state
+
+def invalidate_token(token: str):
+    token_cache.pop(token)
+    invalid_token_cache.pop(token)
+
+def token_filters(user_id: str = None, is_blocked: bool = None, min_uses_left: int = None, max_uses_left: int = None):
+    """
+    Conditions on tokens, each one served by an index
+    """
+    conditions = []
+    if user_id is not None:
+        conditions.append(models.Token.user_id == user_id)
+    if is_blocked is not None:
+        # `is_blocked` on its own matches the partial index on blocked tokens
+        conditions.append(models.Token.is_blocked if is_blocked else models.Token.is_blocked.is_(False))
+    if min_uses_left is not None:
+        conditions.append(models.Token.uses_left >= min_uses_left)
+    if max_uses_left is not None:
+        conditions.append(models.Token.uses_left <= max_uses_left)
+    return conditions
+
+def get_tokens(db: Session, skip: int = 0, limit: int = 100, after: tuple = None, **filters):
+    """
+    A page of tokens in (created_at, token) order, starting after the (created_at, token) `after` if given
+    """
+    query = select(models.Token).where(*token_filters(**filters)).order_by(models.Token.created_at, models.Token.token)
+    if after is not None:
+        created_at, token = after
+        if db.get_bind().dialect.name == "sqlite" and not created_at.microsecond:
+            # SQLite compares datetimes as text. Its CURRENT_TIMESTAMP default has no fractional
+            # seconds but rows written by SQLAlchemy have ".000000", so the same second has two spellings.
+            second = created_at.strftime("%Y-%m-%d %H:%M:%S")
+            # The shorter one sorts first, so the range starts there and can still use the index
+            query = query.where(
+                models.Token.created_at >= literal(second, String),
+                or_(models.Token.created_at > literal(second + ".000000", String), models.Token.token > token),
+            )
+        else:
+            query = query.where(tuple_(models.Token.created_at, models.Token.token) > tuple_(created_at, token))
+    if skip:
+        query = query.offset(skip)
+    return db.scalars(query.limit(limit)).all()
+
+def export_tokens_query(chunk_size: int = 1000, **filters):
+    """
+    Every matching token, to be streamed chunk_size rows at a time through a server-side cursor
+    """
+    return (
+        select(models.Token.__table__)
+        .where(*token_filters(**filters))
+        .order_by(models.Token.created_at, models.Token.token)
+        .execution_options(yield_per=chunk_size)
+    )
+
+def create_token(db: Session, token: schemas.TokenCreate):
+    db_token = models.Token(token=str(uuid.uuid4()), user_id=token.user_id)
     db.add(db_token)
     db.commit()
     db.refresh(db_token)
+    invalidate_token(str(db_token.token))
     return db_token
 
-def use_token(db: Session, token: schemas.TokenUse, uses: int = 1):
-    if not check_token(db, token.token):
-        raise ValueError("Token does not exist")
+BULK_CHUNK_SIZE = 500
+
+def _chunks(items: list):
+    for start in range(0, len(items), BULK_CHUNK_SIZE):
+        yield items[start:start + BULK_CHUNK_SIZE]
+
+def create_users(db: Session, users: list):
+    """
+    Create many users in one transaction, skipping slack_ids that already exist.
+    Returns the created slack_ids.
+    """
+    created = set()
+    rows = [user.model_dump() for user in users]
+    for chunk in _chunks(rows):
+        statement = upsert(db, models.User).on_conflict_do_nothing(index_elements=["slack_id"]).returning(models.User.slack_id)
+        created.update(db.scalars(statement, chunk).all())
+    db.commit()
+    return created
+
+def create_tokens(db: Session, user_ids: list, uses_left: int = None):
+    """
+    Create a token for each user_id in one transaction. Returns the new tokens and the user_ids that do not exist.
+    """
+    existing = set()
+    for chunk in _chunks(list(set(user_ids))):
+        existing.update(db.scalars(select(models.User.slack_id).where(models.User.slack_id.in_(chunk))).all())
+    rows = [{"token": str(uuid.uuid4()), "user_id": user_id} for user_id in user_ids if user_id in existing]
+    if uses_left is not None:
+        for row in rows:
+            row["uses_left"] = uses_left
+    tokens = []
+    for chunk in _chunks(rows):
+        tokens.extend(db.execute(insert(models.Token).returning(*models.Token.__table__.c), chunk).mappings().all())
+    db.commit()
+    return tokens, [user_id for user_id in user_ids if user_id not in existing]
+
+def update_tokens(db: Session, values: dict, tokens: list = None, **filters):
+    """
+    Apply values to the listed tokens, or to every token matching the filters, in one transaction.
+    Returns the updated rows.
+    """
+    if "uses_left" in values:
+        # Leases taken before the overwrite must not be given back on top of it
+        values = dict(values, uses_version=models.Token.uses_version + 1)
+    statement = update(models.Token).values(**values).returning(*models.Token.__table__.c)
+    conditions = token_filters(**filters)
+    if tokens is None:
+        if not conditions:
+            raise ValueError("List tokens or give a filter")
+        updated = db.execute(statement.where(*conditions)).mappings().all()
+    else:
+        updated = []
+        for chunk in _chunks(tokens):
+            updated.extend(db.execute(statement.where(models.Token.token.in_(chunk), *conditions)).mappings().all())
+    db.commit()
+    for row in updated:
+        if "uses_left" in values:
+            quota.discard(row["token"])
+        invalidate_token(row["token"])
+    return updated
 
-    db_token = db.query(models.Token).filter(models.Token.token == token.token, models.Token.user_id == token.user_id).first()
-    if db_token.uses_left == 0:
+def use_token(db: Session, token: schemas.TokenUse, uses: int = 1):
+    """
+    Charge uses to a token directly. The proxy routes go through quota.consume instead.
+    """
+    db_token = db.scalars(
+        update(models.Token)
+        .where(models.Token.token == token.token, models.Token.user_id == token.user_id, models.Token.uses_left >= uses)
+        .values(uses_left=models.Token.uses_left - uses)
+        .returning(models.Token)
+    ).first()
+    if db_token is None:
+        db.rollback()
+        if not check_token(db, token.token):
+            raise ValueError("Token does not exist")
         raise ValueError("Token has no uses left")
-
-    db_token.uses_left -= uses
     db.commit()
-    db.refresh(db_token)
+    state = token_cache.get(token.token)
+    if state is not None:
+        token_cache.set(token.token, state.model_copy(update={"uses_left": db_token.uses_left}))
     return db_token
 
 def log_usage(db: Session, usage: schemas.UsageCreate):
-    db_usage = models.Usage(**usage.dict())
+    data = usage.dict()
+    data["token_id"] = data.pop("token")
+    db_usage = models.Usage(**data)
     db.add(db_usage)
     db.commit()
     db.refresh(db_usage)
     return db_usage
 
-def revoke_token(db: Session, token: schemas.TokenUse):
-    if not check_token(db, token.token):
+def log_usages(db: Session, usages: list, rollups: list = ()):
+    """
+    Insert many usage rows in one multi-row INSERT, and add them to the rollups in the same transaction
+    """
+    if not usages:
+        return
+    db.execute(insert(models.Usage), usages)
+    add_rollups(db, rollups)
+    db.commit()
+
+def upsert(db: Session, model):
+    """
+    An INSERT that can take ON CONFLICT clauses, for the databases that have them
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    raise ValueError(f"ON CONFLICT is not supported on {dialect}")
+
+def add_rollups(db: Session, rollups: list):
+    """
+    Add increments to the usage rollups, creating the rows that do not exist yet
+    """
+    if not rollups:
+        return
+    statement = upsert(db, models.UsageRollup)
+    table = models.UsageRollup.__table__
+    counters = ("requests", "errors", "prompt_tokens", "completion_tokens", "total_tokens")
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={name: table.c[name] + statement.excluded[name] for name in counters}
+        ),
+        rollups
+    )
+
+def get_usage_summary(db: Session, ranges: list, group_by: list, user_id: str = None, model: str = None):
+    """
+    Usage totals over (period, start, end) ranges of the rollups, grouped by columns of usage_rollups
+    """
+    rollup = models.UsageRollup
+    if not ranges:
+        return []
+    keys = [getattr(rollup, column) for column in group_by]
+    query = select(
+        *keys,
+        func.sum(rollup.requests).label("requests"),
+        func.sum(rollup.errors).label("errors"),
+        func.sum(rollup.prompt_tokens).label("prompt_tokens"),
+        func.sum(rollup.completion_tokens).label("completion_tokens"),
+        func.sum(rollup.total_tokens).label("total_tokens")
+    ).where(or_(*(
+        and_(rollup.period == period, rollup.bucket >= start, rollup.bucket < end) for period, start, end in ranges
+    )))
+    if user_id is not None:
+        query = query.where(rollup.user_id == user_id)
+    if model is not None:
+        query = query.where(rollup.model == model)
+    query = query.group_by(*keys).order_by(func.sum(rollup.total_tokens).desc())
+    return db.execute(query).mappings().all()
+
+def get_owned_token(db: Session, token: str, user_id: str):
+    """
+    Primary key lookup of a token that must belong to user_id
+    """
+    db_token = db.get(models.Token, token)
+    if db_token is None or db_token.user_id != user_id:
         raise ValueError("Token does not exist")
+    return db_token
 
-    db_token = db.query(models.Token).filter(models.Token.token == token.token, models.Token.user_id == token.user_id).first()
+def revoke_token(db: Session, token: schemas.TokenUse):
+    db_token = get_owned_token(db, token.token, token.user_id)
     db_token.is_revoked = True
     db.commit()
     db.refresh(db_token)
+    invalidate_token(token.token)
     return db_token
 
 def block_token(db: Session, token: schemas.TokenUse):
-    if not check_token(db, token.token):
-        raise ValueError("Token does not exist")
-
-    db_token = db.query(models.Token).filter(models.Token.token == token.token, models.Token.user_id == token.user_id).first()
+    db_token = get_owned_token(db, token.token, token.user_id)
     db_token.is_blocked = True
     db.commit()
     db.refresh(db_token)
+    invalidate_token(token.token)
     return db_token
 
 def unblock_token(db: Session, token: schemas.TokenUse):
-    if not check_token(db, token.token):
-        raise ValueError("Token does not exist")
-
-    db_token = db.query(models.Token).filter(models.Token.token == token.token, models.Token.user_id == token.user_id).first()
+    db_token = get_owned_token(db, token.token, token.user_id)
     db_token.is_blocked = False
     db.commit()
     db.refresh(db_token)
+    invalidate_token(token.token)
     return db_token
 
 def delete_token(db: Session, token: schemas.TokenUse):
-    if not check_token(db, token.token):
-        raise ValueError("Token does not exist")
-
-    db_token = db.query(models.Token).filter(models.Token.token == token.token, models.Token.user_id == token.user_id).first()
+    db_token = get_owned_token(db, token.token, token.user_id)
     db.delete(db_token)
     db.commit()
+    quota.discard(token.token)
+    invalidate_token(token.token)
     return db_token
 
 def delete_user(db: Session, user: schemas.UserCreate):
-    if not get_user_by_slack_id_and_email(db, user.slack_id, user.email):
+    db_user = get_user_by_slack_id_and_email(db, user.slack_id, user.email)
+    if db_user is None:
         raise ValueError("User does not exist")
-
-    db_user = db.query(models.User).filter(models.User.slack_id == user.slack_id, models.User.email == user.email).first()
     db.delete(db_user)
     db.commit()
+    token_cache.clear()
     return db_user
 
 def update_user(db: Session, user: schemas.UserCreate):
-    if not get_user_by_slack_id_and_email(db, user.slack_id, user.email):
+    db_user = get_user_by_slack_id_and_email(db, user.slack_id, user.email)
+    if db_user is None:
         raise ValueError("User does not exist")
-
-    db_user = db.query(models.User).filter(models.User.slack_id == user.slack_id, models.User.email == user.email).first()
     db_user.name = user.name
     db.commit()
     db.refresh(db_user)
     return db_user
 
 def update_token(db: Session, token: schemas.TokenCreate):
-    if not check_token(db, token.token):
-        raise ValueError("Token does not exist")
-
-    db_token = db.query(models.Token).filter(models.Token.token == token.token, models.Token.user_id == token.user_id).first()
+    db_token = get_owned_token(db, token.token, token.user_id)
     db_token.uses_left = token.uses_left
+    db_token.uses_version = models.Token.uses_version + 1
     db.commit()
     db.refresh(db_token)
+    quota.discard(token.token)
+    invalidate_token(token.token)
     return db_token
 
 def get_tokens_by_owner(db: Session, user_id: str):
     return db.query(models.Token).filter(models.Token.user_id == user_id).all()
 
 def get_token_by_owner_and_token(db: Session, user_id: str, token: str):
-    return db.query(models.Token).filter(models.Token.user_id == user_id, models.Token.token == token).first()
+    db_token = db.get(models.Token, token)
+    if db_token is None or db_token.user_id != user_id:
+        return None
+    return db_token
 
 def get_tokens_by_owner_and_token_and_uses_left(db: Session, user_id: str, token: str, uses_left: int):
     return db.query(models.Token).filter(models.Token.user_id == user_id, models.Token.token == token, models.Token.uses_left == uses_left).first()
@@ -170,4 +419,4 @@ def get_tokens_by_owner_and_token_and_is_blocked(db: Session, user_id: str, toke
     return db.query(models.Token).filter(models.Token.user_id == user_id, models.Token.token == token, models.Token.is_blocked == is_blocked).first()
 
 def get_token_by_usage(db: Session, usage: schemas.UsageCreate):
-    return db.query(models.Token).filter(models.Token.token == usage.token).first()
+    return db.get(models.Token, usage.token)
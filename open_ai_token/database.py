@@ -1,18 +1,122 @@
-from sqlalchemy import create_engine
+import time
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from dotenv import load_dotenv
 import os
 
+from open_ai_token import metrics
+
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DB_URL", "sqlite:///./test.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, pool_pre_ping=True
+# Requests use the async engine, one session per request. The sync engine is for work that
+# already runs in a thread: the usage writer, retention, backfills and migrations.
+# Both pools are sized the same, so a worker holds at most twice this many connections.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections older than this many seconds are replaced, before a proxy or the server drops them
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Compiled statements cached by SQLAlchemy, and prepared statements per connection on asyncpg
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
+_ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+class _TimedCheckout:
+    """
+        Pool mixin recording how long checkouts wait, including for a new connection to open
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = {"checkouts": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_stats["timeouts"] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            stats = self.checkout_stats
+            stats["checkouts"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def async_url(url: str):
+    """
+        The same database through its asyncio driver, unless ASYNC_DB_URL names one
+    """
+    override = os.getenv("ASYNC_DB_URL")
+    if override:
+        return make_url(override)
+    url = make_url(url)
+    driver = _ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No asyncio driver known for {url.get_backend_name()}, set ASYNC_DB_URL")
+    url = url.set(drivername=f"{url.get_backend_name()}+{driver}")
+    if driver == "asyncpg":
+        url = url.update_query_dict({"prepared_statement_cache_size": str(STATEMENT_CACHE_SIZE)})
+    return url
+
+
+_pool_options = dict(
+    pool_pre_ping=True,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    query_cache_size=STATEMENT_CACHE_SIZE
 )
 
+engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=TimedQueuePool, **_pool_options)
+async_engine = create_async_engine(async_url(SQLALCHEMY_DATABASE_URL), poolclass=TimedAsyncQueuePool, **_pool_options)
+metrics.watch_engine(engine, "sync")
+metrics.watch_engine(async_engine.sync_engine, "async")
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Objects stay readable after commit, lazy loads cannot happen outside the session's greenlet
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
+
+
+def _pool_stats(pool) -> dict:
+    stats = dict(pool.checkout_stats)
+    stats["avg_wait_seconds"] = stats["wait_seconds"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    return dict(
+        stats,
+        size=pool.size(),
+        in_use=pool.checkedout(),
+        idle=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+        max_connections=pool.size() + MAX_OVERFLOW
+    )
+
+
+async def shutdown():
+    await async_engine.dispose()
+    engine.dispose()
+
+
+def stats() -> dict:
+    return {"async": _pool_stats(async_engine.pool), "sync": _pool_stats(engine.pool)}
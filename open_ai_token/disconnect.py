@@ -0,0 +1,102 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+
+import orjson
+from starlette.requests import Request
+
+from open_ai_token.sse import UsageParser
+
+# When a client goes away we stop the upstream call instead of letting it run to the end.
+# How much that saved is estimated from how long responses for the same model usually run.
+_stats = {"aborted_before_response": 0, "aborted_mid_stream": 0, "tokens_saved": 0, "seconds_saved": 0.0}
+_typical_completion: Dict[str, float] = {}
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def _wait_for_disconnect(request: Request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _abandon(task: asyncio.Future, discard: Callable[[object], Awaitable]):
+    task.cancel()
+    try:
+        result = await task
+    except (asyncio.CancelledError, Exception):
+        return
+    # The call finished before it could be cancelled, clean up what it returned
+    await discard(result)
+
+
+async def until_disconnected(request: Request, start: Callable[[], Awaitable], discard: Callable[[object], Awaitable]):
+    """
+        Run `start()` unless the client disconnects first, in which case it is cancelled and
+        ClientDisconnected is raised. `discard` cleans up a result nobody will read.
+    """
+    task = asyncio.ensure_future(start())
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        watcher.cancel()
+        await _abandon(task, discard)
+        raise
+    watcher.cancel()
+    if task.done():
+        return task.result()
+    _stats["aborted_before_response"] += 1
+    await _abandon(task, discard)
+    raise ClientDisconnected()
+
+
+def completed(parser: Optional[UsageParser]):
+    """
+        Remember how long a finished response ran, to estimate what cutting others short saves
+    """
+    if parser is None or parser.model is None or not parser.usage:
+        return
+    tokens = parser.usage.get("completion_tokens")
+    if tokens is None:
+        return
+    typical = _typical_completion.get(parser.model)
+    _typical_completion[parser.model] = tokens if typical is None else typical * 0.9 + tokens * 0.1
+
+
+def interrupted(request_data, parser: Optional[UsageParser], elapsed: float) -> dict:
+    """
+        Count a response the client walked away from and return the usage fields to log for it.
+        Streams carry no usage until the end, so completion tokens are estimated at one per event.
+    """
+    _stats["aborted_mid_stream"] += 1
+    fields = {"finish_reason": "client_disconnected"}
+    if parser is None or not parser.streaming or parser.usage is not None:
+        return fields
+
+    generated = parser.events
+    fields["completion_tokens"] = generated
+    expected = _typical_completion.get(parser.model)
+    if isinstance(request_data, (bytes, str)):
+        # Passed-through bodies are only decoded on this rare path
+        try:
+            request_data = orjson.loads(request_data)
+        except orjson.JSONDecodeError:
+            request_data = None
+    if isinstance(request_data, dict):
+        limit = request_data.get("max_completion_tokens") or request_data.get("max_tokens")
+        if limit:
+            expected = min(expected, limit) if expected is not None else limit
+    if expected is not None and expected > generated:
+        saved = int(expected - generated)
+        _stats["tokens_saved"] += saved
+        if generated and elapsed > 0:
+            _stats["seconds_saved"] += saved * elapsed / generated
+    return fields
+
+
+def stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,248 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+
+import open_ai_token.openai as openai_module
+from open_ai_token.cache import TTLCache, MISSING
+from open_ai_token.coalesce import Coalescer
+
+load_dotenv()
+
+# Embeddings are cached per input item, keyed on everything that changes the vector.
+# A request for several items only sends the items nobody has embedded before upstream.
+# Vectors are kept packed as float32, the precision upstream computes them in, about 6 KiB for
+# 1536 dimensions, and the memory tier is bounded by those bytes rather than by entry count.
+MEMORY_BYTES = int(os.getenv("EMBEDDINGS_CACHE_MEMORY_BYTES", str(32 * 1024 ** 2)))
+DISK_PATH = os.getenv("EMBEDDINGS_CACHE_PATH")
+DISK_MAX_BYTES = int(os.getenv("EMBEDDINGS_CACHE_MAX_BYTES", str(1024 ** 3)))
+# Opt-in: hold cache misses this long so concurrent small requests share one upstream call
+COALESCE_WINDOW = float(os.getenv("EMBEDDINGS_COALESCE_MS", "0")) / 1000
+COALESCE_MAX_ITEMS = int(os.getenv("EMBEDDINGS_COALESCE_MAX_ITEMS", "256"))
+
+# Key, tuple and dict slot, roughly, on top of the packed vector
+_ENTRY_OVERHEAD = 200
+
+
+def _weigh(entry: Tuple[bytes, int]) -> int:
+    return len(entry[0]) + _ENTRY_OVERHEAD
+
+
+_memory = TTLCache(maxsize=MEMORY_BYTES, weigh=_weigh)
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "upstream_requests": 0, "upstream_items": 0}
+
+
+class DiskCache:
+    """
+        SQLite-backed second tier, evicting least recently used entries past max_bytes
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, value BLOB NOT NULL, tokens INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+        self.size = self._db.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Tuple[bytes, int]]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, value, tokens FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, value, tokens in rows:
+                    found[key] = (value, tokens)
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+        return found
+
+    def set_many(self, entries: Dict[bytes, Tuple[bytes, int]]):
+        now = time.time()
+        rows = [(key, packed, tokens, now) for key, (packed, tokens) in entries.items()]
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO embeddings (key, value, tokens, accessed) VALUES (?, ?, ?, ?)", rows)
+            self._db.execute("COMMIT")
+            self.size += sum(len(row[1]) for row in rows)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = int(self.max_bytes * 0.9)
+        while self.size > target:
+            rows = self._db.execute("SELECT key, LENGTH(value) FROM embeddings ORDER BY accessed LIMIT 1000").fetchall()
+            if not rows:
+                self.size = 0
+                break
+            self._db.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key, _ in rows])
+            self.size -= sum(size for _, size in rows)
+
+
+def _encode(embedding) -> bytes:
+    if isinstance(embedding, str):
+        return b"s" + embedding.encode()
+    return b"f" + array("f", embedding).tobytes()
+
+
+def _decode(value: bytes):
+    kind = value[:1]
+    if kind == b"s":
+        return value[1:].decode()
+    # "d" is float64, written to disk by earlier versions
+    return array("f" if kind == b"f" else "d", value[1:]).tolist()
+
+
+_disk: Optional[DiskCache] = DiskCache(DISK_PATH, DISK_MAX_BYTES) if DISK_PATH else None
+
+
+def enabled() -> bool:
+    return MEMORY_BYTES > 0 or _disk is not None or _coalescer is not None
+
+
+def _items(data: dict) -> Optional[list]:
+    """
+        Split an embeddings input into items, or None if it is not something we can cache
+    """
+    inp = data.get("input")
+    if isinstance(inp, str):
+        return [inp]
+    if isinstance(inp, list) and inp:
+        if all(isinstance(x, int) for x in inp):
+            return [inp]
+        if all(isinstance(x, str) or (isinstance(x, list) and all(isinstance(t, int) for t in x)) for x in inp):
+            return inp
+    return None
+
+
+def cache_key(data: dict, item) -> bytes:
+    return hashlib.sha256(orjson.dumps([
+        data.get("model"), data.get("dimensions"), data.get("encoding_format", "float"), item
+    ])).digest()
+
+
+def _apportion(total: int, items: list) -> List[int]:
+    """
+        Split one usage figure across several inputs in proportion to their length
+    """
+    weights = [max(len(item), 1) for item in items]
+    scale = sum(weights)
+    shares = [total * weight // scale for weight in weights]
+    order = sorted(range(len(items)), key=lambda i: (total * weights[i]) % scale, reverse=True)
+    for i in order[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def _json(resp) -> dict:
+    try:
+        return orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        return {"error": resp.text}
+
+
+async def fetch(data: dict, items: list) -> Tuple[int, dict, Optional[List[Tuple[object, int]]]]:
+    """
+        Embed items upstream in one call, returning (status, body, [(embedding, tokens), ...])
+    """
+    _stats["upstream_requests"] += 1
+    _stats["upstream_items"] += len(items)
+    resp = await openai_module.create_embeddings(dict(data, input=items))
+    body = _json(resp)
+    if resp.status_code != 200:
+        return resp.status_code, body, None
+    vectors = [entry["embedding"] for entry in sorted(body["data"], key=lambda entry: entry["index"])]
+    tokens = _apportion(body.get("usage", {}).get("prompt_tokens", 0), items)
+    return resp.status_code, body, list(zip(vectors, tokens))
+
+
+_coalescer: Optional[Coalescer] = Coalescer(fetch, COALESCE_WINDOW, COALESCE_MAX_ITEMS) if COALESCE_WINDOW > 0 else None
+
+
+async def create(data: dict) -> Tuple[int, dict, dict]:
+    """
+        Serve an embeddings request from the cache, sending only the misses upstream.
+        Returns (status, body, usage fields for the usage log).
+    """
+    items = _items(data)
+    if items is None:
+        _stats["upstream_requests"] += 1
+        resp = await openai_module.create_embeddings(data)
+        body = _json(resp)
+        return resp.status_code, body, {"model": data.get("model"), "prompt_tokens": body.get("usage", {}).get("prompt_tokens")}
+
+    keys = [cache_key(data, item) for item in items]
+    found: Dict[bytes, Tuple[bytes, int]] = {}
+    for key in keys:
+        entry = _memory.get(key, MISSING)
+        if entry is not MISSING:
+            found[key] = entry
+    memory_hits = len(found)
+    unresolved = [key for key in dict.fromkeys(keys) if key not in found]
+    if unresolved and _disk is not None:
+        from_disk = await run_in_threadpool(_disk.get_many, unresolved)
+        for key, entry in from_disk.items():
+            _memory.set(key, entry)
+        found.update(from_disk)
+    disk_hits = len(found) - memory_hits
+
+    missing = {}
+    for key, item in zip(keys, items):
+        if key not in found and key not in missing:
+            missing[key] = item
+    _stats["memory_hits"] += memory_hits
+    _stats["disk_hits"] += disk_hits
+    _stats["misses"] += len(missing)
+
+    # Cached vectors are unpacked once each, fresh ones are returned as upstream sent them
+    entries_by_key = {key: (_decode(packed), tokens) for key, (packed, tokens) in found.items()}
+    spent = 0
+    if missing:
+        send = _coalescer.submit if _coalescer is not None else fetch
+        status, body, results = await send(data, list(missing.values()))
+        if results is None:
+            return status, body, {"model": data.get("model")}
+        fresh = dict(zip(missing.keys(), results))
+        packed = {key: (_encode(embedding), tokens) for key, (embedding, tokens) in fresh.items()}
+        for key, entry in packed.items():
+            _memory.set(key, entry)
+        if _disk is not None:
+            await run_in_threadpool(_disk.set_many, packed)
+        entries_by_key.update(fresh)
+        spent = sum(tokens for _, tokens in results)
+
+    entries = [entries_by_key[key] for key in keys]
+    prompt_tokens = sum(tokens for _, tokens in entries)
+    body = {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": embedding} for i, (embedding, _) in enumerate(entries)],
+        "model": data.get("model"),
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+    }
+    return 200, body, {"model": data.get("model"), "prompt_tokens": spent, "total_tokens": spent}
+
+def stats() -> dict:
+    lookups = _stats["memory_hits"] + _stats["disk_hits"] + _stats["misses"]
+    hits = _stats["memory_hits"] + _stats["disk_hits"]
+    return dict(
+        _stats,
+        hit_ratio=hits / lookups if lookups else 0.0,
+        memory=_memory.stats(),
+        disk={"bytes": _disk.size, "max_bytes": _disk.max_bytes} if _disk is not None else None,
+        coalescer=_coalescer.stats() if _coalescer is not None else None
+    )
@@ -0,0 +1,165 @@
+import fnmatch
+import json
+import os
+import re
+import time
+from typing import Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Upstream keys are configured as a JSON list in OPEN_AI_KEYS, e.g.
+#   [{"key": "sk-...", "organization": "org-...", "models": ["gpt-4*"]}, {"key": "sk-..."}]
+# "models" restricts a key to matching models; keys without it serve everything.
+# OPEN_AI_KEY on its own still works as a pool of one.
+
+_DURATION = re.compile(r"([\d.]+)(ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+        Parse an OpenAI reset header such as "6m0s", "1.5s" or "20ms" into seconds
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _UNITS[unit] for amount, unit in parts)
+
+
+def _int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class UpstreamKey:
+    def __init__(self, key: str, organization: Optional[str] = None, models: Optional[List[str]] = None, name: str = "key-0"):
+        self.key = key
+        self.organization = organization
+        self.models = models
+        # Shown in /stats, so never derived from the key itself
+        self.name = name
+        self.limit_requests: Optional[int] = None
+        self.limit_tokens: Optional[int] = None
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.reset_requests_at = 0.0
+        self.reset_tokens_at = 0.0
+        self.throttled_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+
+    def serves(self, model: Optional[str]) -> bool:
+        if self.models is None or model is None:
+            return True
+        return any(fnmatch.fnmatchcase(model, pattern) for pattern in self.models)
+
+    def headers(self) -> dict:
+        headers = {"Authorization": f"Bearer {self.key}"}
+        if self.organization:
+            headers["OpenAI-Organization"] = self.organization
+        return headers
+
+    def headroom(self, now: float) -> float:
+        """
+            Fraction of this key's request and token budget still left, 1.0 when unknown
+        """
+        if self.throttled_until > now:
+            return -1.0
+        fractions = [1.0]
+        if self.limit_requests and self.remaining_requests is not None and self.reset_requests_at > now:
+            fractions.append(self.remaining_requests / self.limit_requests)
+        if self.limit_tokens and self.remaining_tokens is not None and self.reset_tokens_at > now:
+            fractions.append(self.remaining_tokens / self.limit_tokens)
+        return min(fractions)
+
+    def observe(self, headers, now: Optional[float] = None):
+        """
+            Update the budget from the x-ratelimit-* headers of an upstream response
+        """
+        now = time.monotonic() if now is None else now
+        limit_requests = _int(headers.get("x-ratelimit-limit-requests"))
+        if limit_requests is not None:
+            self.limit_requests = limit_requests
+        limit_tokens = _int(headers.get("x-ratelimit-limit-tokens"))
+        if limit_tokens is not None:
+            self.limit_tokens = limit_tokens
+        remaining_requests = _int(headers.get("x-ratelimit-remaining-requests"))
+        if remaining_requests is not None:
+            self.remaining_requests = remaining_requests
+            self.reset_requests_at = now + (parse_duration(headers.get("x-ratelimit-reset-requests")) or 60)
+        remaining_tokens = _int(headers.get("x-ratelimit-remaining-tokens"))
+        if remaining_tokens is not None:
+            self.remaining_tokens = remaining_tokens
+            self.reset_tokens_at = now + (parse_duration(headers.get("x-ratelimit-reset-tokens")) or 60)
+
+    def throttle(self, headers, now: Optional[float] = None):
+        """
+            Take the key out of rotation after a 429 until its limits reset
+        """
+        now = time.monotonic() if now is None else now
+        self.throttled += 1
+        wait = parse_duration(headers.get("retry-after"))
+        if wait is None:
+            resets = [parse_duration(headers.get(h)) for h in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+            resets = [r for r in resets if r]
+            wait = max(resets) if resets else 1.0
+        self.throttled_until = now + wait
+
+    def stats(self, now: float) -> dict:
+        return {
+            "name": self.name,
+            "models": self.models,
+            "headroom": round(self.headroom(now), 3),
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "throttled_for": max(self.throttled_until - now, 0.0),
+            "requests": self.requests,
+            "throttled": self.throttled
+        }
+
+
+def _load() -> List[UpstreamKey]:
+    configured = os.getenv("OPEN_AI_KEYS")
+    if configured:
+        return [
+            UpstreamKey(entry["key"], entry.get("organization"), entry.get("models"), entry.get("name") or f"key-{i}")
+            for i, entry in enumerate(json.loads(configured))
+        ]
+    return [UpstreamKey(os.getenv("OPEN_AI_KEY") or "")]
+
+
+pool: List[UpstreamKey] = _load()
+
+
+def pick(model: Optional[str] = None, exclude: Iterable[UpstreamKey] = (), allow_throttled: bool = True) -> Optional[UpstreamKey]:
+    """
+        Choose the key with the most headroom that may serve `model`
+    """
+    now = time.monotonic()
+    candidates = [
+        key for key in pool
+        if key.serves(model) and key not in exclude and (allow_throttled or key.throttled_until <= now)
+    ]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda key: (key.headroom(now), -key.throttled_until, -key.requests))
+    best.requests += 1
+    if best.remaining_requests:
+        # Count the request straight away so concurrent picks spread across keys
+        best.remaining_requests -= 1
+    return best
+
+
+def stats() -> List[dict]:
+    now = time.monotonic()
+    return [key.stats(now) for key in pool]
@@ -1,14 +1,22 @@
 from typing_extensions import Tuple, Union
-from fastapi import FastAPI, HTTPException, Query, Response, Depends
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, HTTPException, Query, Response, Depends, Request
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
+import itertools
 import os
+import threading
+import time
+import anyio
+import httpx
+from contextlib import asynccontextmanager
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import StreamingResponse
 import open_ai_token.openai as openai_module
-from typing import Annotated
-from open_ai_token import schemas, crud
+from typing import Annotated, Awaitable, Callable
+from open_ai_token import schemas, crud, quota, usage, embeddings_cache, singleflight, keys, ratelimit, scheduler, disconnect, passthrough, rollups, pagination, policy, resilience, metrics, profiler, capture
+from open_ai_token.sse import UsageParser
 from datetime import datetime
 
 load_dotenv()
@@ -17,11 +25,28 @@ origins = ["*"]
 
 security = HTTPBearer()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await openai_module.startup()
+    await ratelimit.startup()
+    await quota.startup()
+    await usage.startup()
+    await capture.startup()
+    yield
+    await capture.shutdown()
+    await usage.shutdown()
+    await quota.shutdown()
+    await ratelimit.shutdown()
+    await openai_module.shutdown()
+    await database.shutdown()
+    metrics.shutdown()
+
 app = FastAPI(
     title="OpenAI Gateway",
     description="API Gateway for OpenAI",
     version="0.1.0",
-    contact={"name": "Arpan Pandey", "email": "arpan@hackclub.com"}
+    contact={"name": "Arpan Pandey", "email": "arpan@hackclub.com"},
+    lifespan=lifespan
 )
 app.add_middleware(
     CORSMiddleware,
@@ -30,47 +55,250 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+if capture.ENABLED:
+    app.add_middleware(capture.CaptureMiddleware)
 from open_ai_token import schemas, crud, models
-from open_ai_token.database import SessionLocal, engine
+from open_ai_token import database
+from open_ai_token.database import AsyncSessionLocal
 
-models.Base.metadata.create_all(bind=engine)
+# The schema is managed with Alembic, run `alembic upgrade head` before starting the app
 check_if_prod = bool(os.getenv("PRODUCTION"))
 show_in_docs_for_priv_routes = not check_if_prod
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    """
+    One session per request, closed when the request is done
+    """
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def authenticate(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def authenticate(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
-    db = SessionLocal()
+    with metrics.span("auth"):
+        state = crud.get_cached_token_state(token)
+        if state is crud.MISSING:
+            async with AsyncSessionLocal() as db:
+                state = await db.run_sync(crud.get_token_state, token)
+    if state is None:
+        raise ValueError("Invalid token")
+    if state.uses_left == 0 and not quota.remaining(token):
+        metrics.rejected("quota")
+        raise ValueError("No uses left")
+    if state.is_expired or not state.is_active or state.is_revoked or state.is_blocked:
+        raise ValueError("Token is expired or disabled")
+    return state
+
+async def require_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Authenticate an admin token, for routes that read or change everyone's users, tokens and usage
+    """
+    try:
+        sec = await authenticate(credentials)
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    if not sec.is_admin:
+        raise HTTPException(status_code=403, detail="Only admins can use this endpoint")
+    return sec
+
+async def json_body(request: Request) -> passthrough.JSONBody:
+    """
+    Read the request body once as bytes so it can be forwarded upstream as it is
+    """
+    try:
+        payload = passthrough.JSONBody(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    metrics.set_model(payload.data.get("model"))
+    capture.set_body(payload)
+    return payload
+
+async def checked_body(request: Request, payload: passthrough.JSONBody = Depends(json_body), sec: schemas.TokenState = Depends(authenticate)) -> passthrough.JSONBody:
+    """
+    The request body, once the policy allows the caller its model and parameters.
+    Routes list it before rate_limited, so a refused request is not charged.
+    """
+    policy.authorize(request.url.path, sec)
+    policy.check_body(request.url.path, payload.data, sec)
+    return payload
+
+async def rate_limited(request: Request, sec: schemas.TokenState = Depends(authenticate)):
+    """
+    Authenticate and take the request out of the caller's rate limit buckets.
+    The charge is kept on the request so routes can settle it against real usage.
+    Banned users and endpoints the user may not call are refused before anything is charged.
+    """
+    policy.authorize(request.url.path, sec)
+    with metrics.span("ratelimit"):
+        request.state.rate_charge = await ratelimit.check(sec, ratelimit.estimate_tokens(request.headers.get("content-length")))
+    return sec
+
+async def log_usage(token: schemas.TokenState, endpoint: str, request_data=" ", response_data=" ", created_at: Union[datetime, None] = None, **fields):
+    """
+    Queue a usage record for the background writer
+    """
+    with metrics.span("usage"):
+        await usage.log({
+            "token_id": token.token,
+            "user_id": token.user_id,
+            "created_at": created_at or datetime.now(),
+            "request_data": request_data,
+            "response_data": response_data,
+            "endpoint": endpoint,
+            **fields
+        })
+
+async def send_upstream(sec: schemas.TokenState, model: Union[str, None], start: Callable[[], Awaitable], request: Union[Request, None] = None):
+    """
+    Wait for a scheduler slot for the model's family, then start the upstream call.
+    Returns the call's result and the slot, which is given back if the call fails.
+    If a request is given, the wait and the call are abandoned as soon as its client disconnects.
+    """
+    async def admitted():
+        with metrics.span("queue"):
+            slot = await scheduler.acquire(sec, model)
+        try:
+            return await start(), slot
+        except BaseException:
+            slot.release()
+            raise
+
+    if request is None:
+        return await admitted()
+    return await disconnect.until_disconnected(request, admitted, discard_upstream)
+
+async def discard_upstream(result):
+    """
+    Close an upstream response nobody is going to read and give back its slot
+    """
+    resp, slot = result
     try:
-        if not crud.check_token(db, token):
-            raise ValueError("Invalid token")
-        token = crud.get_token(db, token)
-        if token is None:
-            raise ValueError("Invalid token")
-        if token.uses_left == 0:
-            raise ValueError("No uses left")
-        if token.is_expired or not token.is_active or token.is_revoked or token.is_blocked:
-            raise ValueError("Token is expired or disabled")
-        return token
-    except Exception as e:
-        raise e
-
-def log_usage(token: schemas.TokenUse, db: Session = Depends(get_db), request_data: str = " ", response_data: str = " ", endpoint: str = " "):
-    usage = schemas.UsageCreate(
-        token=token.token,
-        created_at=datetime.now(),
-        request_data=request_data,
-        response_data=response_data,
-        endpoint=endpoint
+        if hasattr(resp, "aclose"):
+            await resp.aclose()
+    finally:
+        slot.release()
+
+class RelayResponse(StreamingResponse):
+    """
+    StreamingResponse that closes the upstream response and gives its scheduler slot back however
+    the response ends, even if the client is gone before the body is ever started
+    """
+    def __init__(self, *args, upstream=None, slot: Union[scheduler.Slot, None] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upstream = upstream
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        started = metrics.stream_started()
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            metrics.stream_finished(started)
+            with anyio.CancelScope(shield=True):
+                try:
+                    if self.upstream is not None:
+                        await self.upstream.aclose()
+                finally:
+                    if self.slot is not None:
+                        self.slot.release()
+
+def stream_upstream(resp: Union[httpx.Response, singleflight.Subscription], sec: schemas.TokenState, endpoint: str, request_data=" ", media_type: Union[str, None] = None, parser: Union[UsageParser, None] = None, charge: Union[ratelimit.Charge, None] = None, slot: Union[scheduler.Slot, None] = None):
+    """
+    Relay an upstream response to the client without buffering it, logging usage once it is done.
+    If a parser is given every chunk goes through it and what it returns is relayed. Its summary
+    is logged too, and the rate limit charge is settled against the tokens actually used.
+
+    If the client goes away mid-response the upstream request is aborted straight away and
+    whatever was relayed up to then is logged.
+    """
+    created_at = datetime.now()
+    started = time.monotonic()
+
+    chunks = resp.__aiter__() if isinstance(resp, singleflight.Subscription) else openai_module.iter_response(resp)
+
+    async def body():
+        complete = False
+        try:
+            async for chunk in chunks:
+                if parser is not None:
+                    chunk = parser.feed(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if parser is not None:
+                rest = parser.close()
+                if rest:
+                    yield rest
+            complete = True
+        finally:
+            # Cancelled when the client disconnects, so the cleanup has to be shielded to finish
+            with anyio.CancelScope(shield=True):
+                if not complete:
+                    await chunks.aclose()
+                fields = {}
+                if parser is not None:
+                    parser.close()
+                    fields = parser.summary()
+                if complete:
+                    disconnect.completed(parser)
+                else:
+                    fields.update(disconnect.interrupted(request_data, parser, time.monotonic() - started))
+                await log_usage(
+                    sec, endpoint, request_data=request_data, response_data=fields or " ", created_at=created_at,
+                    status_code=resp.status_code, latency_ms=int((time.monotonic() - started) * 1000), **fields
+                )
+                if charge is not None:
+                    await charge.settle(fields.get("total_tokens"))
+
+    return RelayResponse(
+        body(),
+        status_code=resp.status_code,
+        media_type=media_type or resp.headers.get("content-type", "application/json"),
+        upstream=resp,
+        slot=slot
+    )
+
+
+@app.exception_handler(disconnect.ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: disconnect.ClientDisconnected):
+    # Nobody is left to read this, 499 is what nginx logs for a client that closed the request
+    return Response(status_code=499)
+
+@app.exception_handler(ratelimit.RateLimited)
+async def rate_limited_handler(request: Request, exc: ratelimit.RateLimited):
+    metrics.rejected("rate_limit")
+    return JSONResponse(
+        status_code=429,
+        content={"error": "Rate limit exceeded, slow down"},
+        headers={"Retry-After": ratelimit.retry_after(exc.retry_after)}
+    )
+
+@app.exception_handler(policy.PolicyDenied)
+async def policy_denied_handler(request: Request, exc: policy.PolicyDenied):
+    metrics.rejected("policy")
+    return JSONResponse(status_code=exc.status_code, content={"error": str(exc)})
+
+@app.exception_handler(scheduler.Overloaded)
+async def overloaded_handler(request: Request, exc: scheduler.Overloaded):
+    metrics.rejected("overloaded")
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(exc)},
+        headers={"Retry-After": ratelimit.retry_after(exc.retry_after)}
     )
-    crud.log_usage(db, usage)
 
+@app.exception_handler(resilience.CircuitOpen)
+async def circuit_open_handler(request: Request, exc: resilience.CircuitOpen):
+    metrics.rejected("circuit_open")
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(exc)},
+        headers={"Retry-After": ratelimit.retry_after(exc.retry_after)}
+    )
+
+@app.exception_handler(httpx.HTTPError)
+async def upstream_error_handler(request: Request, exc: httpx.HTTPError):
+    return JSONResponse(status_code=502, content={"error": f"Upstream request failed: {exc}"})
 
 @app.get("/")
 def read_root():
@@ -78,49 +306,222 @@ def read_root():
 
 @app.exception_handler(ValueError)
 @app.post("/register", include_in_schema=show_in_docs_for_priv_routes, response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     try:
-        db_user = crud.create_user(db, user)
+        db_user = await db.run_sync(crud.create_user, user)
         return db_user
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/users", include_in_schema=show_in_docs_for_priv_routes, response_model=list[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+async def read_users(response: Response, skip: int = 0, limit: int = 100, cursor: Union[str, None] = None, db: AsyncSession = Depends(get_db)):
+    """
+    A page of users. Pass the X-Next-Cursor header of a page as `cursor` to get the next one.
+    """
+    try:
+        after = pagination.decode_cursor(cursor, 1)[0] if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    users = await db.run_sync(crud.get_users, skip=skip, limit=limit, after=after)
     if len(users) == 0:
         raise HTTPException(status_code=404, detail="No users found")
+    if len(users) == min(limit, 100):
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(users[-1].slack_id)
     return users
 
+@app.get("/users/export", include_in_schema=show_in_docs_for_priv_routes)
+def export_users(sec=Depends(require_admin)):
+    """
+    Every user as newline delimited JSON, streamed with constant memory. Admin tokens only.
+    """
+    async def rows():
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(crud.export_users_query(pagination.EXPORT_CHUNK_SIZE))
+            async for chunk in pagination.ndjson_stream(result):
+                yield chunk
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
 @app.get("/user/{slack_id}", include_in_schema=show_in_docs_for_priv_routes, response_model=schemas.User)
-def read_user(slack_id: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_slack_id(db, slack_id)
+async def read_user(slack_id: str, db: AsyncSession = Depends(get_db)):
+    db_user = await db.run_sync(crud.get_user_by_slack_id, slack_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 @app.get("/token/{token}", include_in_schema=show_in_docs_for_priv_routes, response_model=schemas.Token)
-def read_token(token: str, db: Session = Depends(get_db)):
-    db_token = crud.get_token(db, token)
+async def read_token(token: str, db: AsyncSession = Depends(get_db)):
+    db_token = await db.run_sync(crud.get_token, token)
     if db_token is None:
         raise HTTPException(status_code=404, detail="Token not found")
     return db_token
 
+def token_filters(
+    user_id: Union[str, None] = None,
+    is_blocked: Union[bool, None] = None,
+    min_uses_left: Union[int, None] = None,
+    max_uses_left: Union[int, None] = None
+):
+    return {"user_id": user_id, "is_blocked": is_blocked, "min_uses_left": min_uses_left, "max_uses_left": max_uses_left}
+
 @app.get("/tokens", include_in_schema=show_in_docs_for_priv_routes, response_model=list[schemas.Token])
-def read_tokens(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    tokens = crud.get_tokens(db, skip=skip, limit=limit)
+async def read_tokens(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Union[str, None] = None,
+    filters: dict = Depends(token_filters),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    A page of tokens, oldest first. Pass the X-Next-Cursor header of a page as `cursor` to get the next one.
+    """
+    try:
+        after = pagination.decode_time_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tokens = await db.run_sync(crud.get_tokens, skip=skip, limit=limit, after=after, **filters)
     if len(tokens) == 0:
         raise HTTPException(status_code=404, detail="No tokens found")
+    if len(tokens) == limit:
+        last = tokens[-1]
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(last.created_at, last.token)
     return tokens
 
+@app.get("/tokens/export", include_in_schema=show_in_docs_for_priv_routes)
+def export_tokens(filters: dict = Depends(token_filters), sec=Depends(require_admin)):
+    """
+    Every matching token as newline delimited JSON, streamed with constant memory. Admin tokens only.
+    """
+    async def rows():
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(crud.export_tokens_query(pagination.EXPORT_CHUNK_SIZE, **filters))
+            async for chunk in pagination.ndjson_stream(result):
+                yield chunk
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
 @app.post("/token", include_in_schema=show_in_docs_for_priv_routes, response_model=schemas.Token)
-def create_token(token: schemas.TokenCreate, db: Session = Depends(get_db)):
+async def create_token(token: schemas.TokenCreate, db: AsyncSession = Depends(get_db)):
     try:
-        db_token = crud.create_token(db, token)
+        db_token = await db.run_sync(crud.create_token, token)
         return db_token
     except ValueError as e:
         return {"Error": str(e)}
 
+@app.post("/users/bulk", include_in_schema=show_in_docs_for_priv_routes)
+async def create_users_bulk(users: list[schemas.UserCreate], db: AsyncSession = Depends(get_db), sec=Depends(require_admin)):
+    """
+    Create many users in one transaction. Streams one NDJSON result per user. Admin tokens only.
+    """
+    # A slack_id listed twice is created once, and reported as a duplicate after the first
+    unique = {}
+    for user in users:
+        unique.setdefault(user.slack_id, user)
+    created = await db.run_sync(crud.create_users, list(unique.values()))
+
+    def results():
+        reported = set()
+        for user in users:
+            if user.slack_id in reported:
+                yield {"slack_id": user.slack_id, "created": False, "error": "Duplicate in request"}
+            elif user.slack_id in created:
+                yield {"slack_id": user.slack_id, "created": True}
+            else:
+                yield {"slack_id": user.slack_id, "created": False, "error": "User already exists"}
+            reported.add(user.slack_id)
+
+    return StreamingResponse(pagination.ndjson(results()), media_type="application/x-ndjson")
+
+@app.post("/tokens/bulk", include_in_schema=show_in_docs_for_priv_routes)
+async def create_tokens_bulk(request: schemas.TokensBulkCreate, db: AsyncSession = Depends(get_db), sec=Depends(require_admin)):
+    """
+    Create a token for each listed user in one transaction. Streams the new tokens, then the users that do not exist.
+    Admin tokens only.
+    """
+    tokens, missing = await db.run_sync(crud.create_tokens, request.user_ids, uses_left=request.uses_left)
+    results = itertools.chain(tokens, ({"user_id": user_id, "error": "User does not exist"} for user_id in missing))
+    return StreamingResponse(pagination.ndjson(results), media_type="application/x-ndjson")
+
+@app.post("/tokens/bulk/update", include_in_schema=show_in_docs_for_priv_routes)
+async def update_tokens_bulk(request: schemas.TokensBulkUpdate, db: AsyncSession = Depends(get_db), sec=Depends(require_admin)):
+    """
+    Set uses_left, is_blocked or is_revoked on the listed tokens, or on every token matching the filter,
+    in one transaction. Streams the updated tokens, then the listed tokens that were not found. Admin tokens only.
+    """
+    values = {field: getattr(request, field) for field in ("uses_left", "is_blocked", "is_revoked") if getattr(request, field) is not None}
+    if not values:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    filters = request.filter.model_dump() if request.filter is not None else {}
+    try:
+        updated = await db.run_sync(crud.update_tokens, values, tokens=request.tokens, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    found = {row["token"] for row in updated}
+    missing = ({"token": token, "error": "Token does not exist"} for token in request.tokens or () if token not in found)
+    return StreamingResponse(pagination.ndjson(itertools.chain(updated, missing)), media_type="application/x-ndjson")
+
+@app.get("/usage/summary", include_in_schema=show_in_docs_for_priv_routes, response_model=list[schemas.UsageSummary])
+async def read_usage_summary(
+    start: datetime,
+    end: Union[datetime, None] = None,
+    group_by: str = "user,model",
+    user_id: Union[str, None] = None,
+    model: Union[str, None] = None,
+    db: AsyncSession = Depends(get_db),
+    sec=Depends(require_admin)
+):
+    """
+    Usage totals between start and end (default now), to the hour, grouped by any of user, token and model.
+    Admin tokens only.
+    """
+    groups = [group.strip() for group in group_by.split(",") if group.strip()]
+    unknown = [group for group in groups if group not in rollups.GROUPS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot group by {', '.join(unknown)}, use {', '.join(rollups.GROUPS)}")
+    ranges = rollups.ranges(start, end or datetime.now())
+    return await db.run_sync(crud.get_usage_summary, ranges, [rollups.GROUPS[group] for group in groups], user_id=user_id, model=model)
+
+@app.get("/stats", include_in_schema=show_in_docs_for_priv_routes)
+def read_stats():
+    return {
+        "token_cache": crud.token_cache.stats(),
+        "invalid_token_cache": crud.invalid_token_cache.stats(),
+        "usage_logger": usage.stats(),
+        "embeddings_cache": embeddings_cache.stats(),
+        "single_flight": singleflight.stats(),
+        "upstream_keys": keys.stats(),
+        "rate_limit": ratelimit.stats(),
+        "scheduler": scheduler.stats(),
+        "client_disconnects": disconnect.stats(),
+        "database": database.stats(),
+        "policy": policy.stats(),
+        "upstream_resilience": resilience.stats(),
+        "profiler": profiler.stats(),
+        "capture": capture.stats()
+    }
+
+@app.get("/metrics", include_in_schema=show_in_docs_for_priv_routes)
+def read_metrics():
+    """
+    Prometheus metrics, merged across workers when PROMETHEUS_MULTIPROC_DIR is set
+    """
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/debug/profile", include_in_schema=show_in_docs_for_priv_routes)
+async def profile(seconds: float = Query(10, gt=0, le=profiler.MAX_SECONDS), sec=Depends(require_admin)):
+    """
+    Sample this worker's event loop for a while and return the folded stacks, for admin tokens
+    when PROFILER_ENABLED is set
+    """
+    if not profiler.ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        counts = await anyio.to_thread.run_sync(profiler.sample, threading.get_ident(), seconds)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(profiler.folded(counts), media_type="text/plain")
+
 # Now we create the public routes
 # These routes are always included in the documentation
 # These mirror the OpenAI API routes
@@ -128,230 +529,237 @@ def create_token(token: schemas.TokenCreate, db: Session = Depends(get_db)):
 #
 
 @app.get("/models")
-def models(
+async def models(
     response: Response,
-    credentials=Depends(security),
-    db: Session = Depends(get_db)
+    sec=Depends(rate_limited)
 ):
     """
     Get the list of models available on OpenAI API
     """
-    sec = authenticate(credentials)
-    res: Tuple = openai_module.models()
-
-    # Register the use of the token
-    log_usage(sec, db, response_data=str(res), endpoint="/models", request_data="GET Request to /models")
+    started = time.monotonic()
+    res, slot = await send_upstream(sec, None, lambda: singleflight.call(singleflight.request_key("/models"), openai_module.models))
+    slot.release()
+
+    # Register the use of the token, the model list itself is not worth keeping
+    await log_usage(
+        sec, "/models", request_data="GET Request to /models",
+        status_code=res[1], latency_ms=int((time.monotonic() - started) * 1000)
+    )
 
     return res
 
 @app.post("/model/{model_name}")
-def model(
+async def model(
     model_name: str,
     response: Response
 ):
     """
     Get the details of a model available on OpenAI API
     """
-    res: Tuple = openai_module.model(model_name)
+    res: Tuple = await openai_module.model(model_name)
     return res
 
 
 
 @app.post("/chat/completions")
-def post_chat_completions(
-    data: dict, response: Response, credentials=Depends(security), db: Session = Depends(get_db)
+async def post_chat_completions(
+    request: Request, response: Response, payload: passthrough.JSONBody = Depends(checked_body), sec=Depends(rate_limited)
 ):
     """
     Get the completions for a chat model
     """
-    sec = authenticate(credentials)
-
+    data = payload.data
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.post_chat_completions(data, sec)
-
     # Register the use of the token
-    crud.use_token(db, sec)
+    try:
+        with metrics.span("quota"):
+            await quota.consume(sec.token)
+    except ValueError as e:
+        metrics.rejected("quota")
+        raise HTTPException(status_code=429, detail=str(e))
 
-    if isinstance(resp, tuple) and resp[1] != 200:
-        response.status_code = resp[1]
-        return resp[0]
+    if singleflight.chat_eligible(data):
+        # Identical deterministic requests share one upstream stream
+        key = singleflight.request_key("/chat/completions", payload.raw)
+        start = lambda: singleflight.stream(key, lambda: openai_module.send_chat_completions(data, payload.raw))
+    else:
+        start = lambda: openai_module.send_chat_completions(data, payload.raw)
+    resp, slot = await send_upstream(sec, data.get("model"), start, request=request)
 
-    return StreamingResponse(resp, media_type="application/json")
+    parser = UsageParser(streaming="text/event-stream" in resp.headers.get("content-type", ""), strip_usage=passthrough.adds_stream_usage(data))
+    return stream_upstream(resp, sec, "/chat/completions", request_data=payload.raw, parser=parser, charge=request.state.rate_charge, slot=slot)
 
 @app.post("/images/generations")
-def create_image(data: dict, response: Response, credentials=Depends(security)):
+async def create_image(request: Request, response: Response, payload: passthrough.JSONBody = Depends(checked_body), sec=Depends(rate_limited)):
     """
     Create an image on OpenAI API
     """
-    sec = authenticate(credentials)
-
+    data = payload.data
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.create_image(data)
-    return StreamingResponse(resp, media_type="image/png")
+    resp, slot = await send_upstream(sec, data.get("model"), lambda: openai_module.create_image(data, payload.raw), request=request)
+    return stream_upstream(resp, sec, "/images/generations", request_data=payload.raw, slot=slot)
 
 @app.post("/embeddings")
-def embeddings(data: dict, response: Response, credentials=Depends(security)):
+async def embeddings(request: Request, response: Response, payload: passthrough.JSONBody = Depends(checked_body), sec=Depends(rate_limited)):
     """
     Get the embeddings of a text on OpenAI API
     """
-    sec = authenticate(credentials)
-
+    data = payload.data
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.embeddings(data)
-    return StreamingResponse(resp, media_type="application/json")
+    if not embeddings_cache.enabled():
+        resp, slot = await send_upstream(sec, data.get("model"), lambda: openai_module.embeddings(data, payload.raw), request=request)
+        return stream_upstream(resp, sec, "/embeddings", request_data=payload.raw, slot=slot)
+
+    started = time.monotonic()
+    (status, body, fields), slot = await send_upstream(sec, data.get("model"), lambda: embeddings_cache.create(data), request=request)
+    slot.release()
+    await log_usage(
+        sec, "/embeddings", request_data=payload.raw, response_data=fields,
+        status_code=status, latency_ms=int((time.monotonic() - started) * 1000), **fields
+    )
+    if request.state.rate_charge is not None:
+        await request.state.rate_charge.settle(fields.get("total_tokens"))
+    return ORJSONResponse(body, status_code=status)
 
 @app.post("/fine_tuning/jobs")
-def create_fine_tuning_jobs(data: dict, response: Response, credentials=Depends(security)):
+async def create_fine_tuning_jobs(response: Response, payload: passthrough.JSONBody = Depends(checked_body), sec=Depends(rate_limited)):
     """
     Create a fine tuning job on OpenAI API
     """
-    sec = authenticate(credentials)
-
+    data = payload.data
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.create_fine_tuning(data)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.create_fine_tuning(data, payload.raw))
+    return stream_upstream(resp, sec, "/fine_tuning/jobs", request_data=payload.raw, slot=slot)
 
 # List all fine tuning jobs
 @app.get("/fine_tuning/jobs")
-def list_fine_tuning_jobs(response: Response, credentials=Depends(security)):
+async def list_fine_tuning_jobs(response: Response, sec=Depends(rate_limited)):
     """
     List all fine tuning jobs on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.list_fine_tuning()
-    return resp
+    resp, slot = await send_upstream(sec, None, openai_module.list_fine_tuning)
+    return stream_upstream(resp, sec, "/fine_tuning/jobs", request_data="GET Request to /fine_tuning/jobs", slot=slot)
 
 # List fine tuning events
 @app.get("/fine_tuning/jobs/{job_id}/events")
-def list_fine_tuning_events(job_id: str, response: Response, credentials=Depends(security)):
+async def list_fine_tuning_events(job_id: str, response: Response, sec=Depends(rate_limited)):
     """
     List all fine tuning events on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.list_fine_tuning_events(job_id)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.list_fine_tuning_events(job_id))
+    return stream_upstream(resp, sec, f"/fine_tuning/jobs/{job_id}/events", request_data=f"GET Request to /fine_tuning/jobs/{job_id}/events", slot=slot)
 
 # list fine tuning checkpoints
 @app.get("/fine_tuning/jobs/{job_id}/checkpoints")
-def list_fine_tuning_checkpoints(job_id: str, response: Response, credentials=Depends(security)):
+async def list_fine_tuning_checkpoints(job_id: str, response: Response, sec=Depends(rate_limited)):
     """
     List all fine tuning checkpoints on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.list_fine_tuning_checkpoints(job_id)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.list_fine_tuning_checkpoints(job_id))
+    return stream_upstream(resp, sec, f"/fine_tuning/jobs/{job_id}/checkpoints", request_data=f"GET Request to /fine_tuning/jobs/{job_id}/checkpoints", slot=slot)
 
 # retrieve a fine tuning job
 @app.get("/fine_tuning/jobs/{job_id}")
-def get_fine_tuning_job(job_id: str, response: Response, credentials=Depends(security)):
+async def get_fine_tuning_job(job_id: str, response: Response, sec=Depends(rate_limited)):
     """
     Retrieve a fine tuning job on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.retrieve_fine_tuning(job_id)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.retrieve_fine_tuning(job_id))
+    return stream_upstream(resp, sec, f"/fine_tuning/jobs/{job_id}", request_data=f"GET Request to /fine_tuning/jobs/{job_id}", slot=slot)
 
 # cancel a fine tuning job
 @app.post("/fine_tuning/jobs/{job_id}/cancel")
-def cancel_fine_tuning_job(job_id: str, response: Response, credentials=Depends(security)):
+async def cancel_fine_tuning_job(job_id: str, response: Response, sec=Depends(rate_limited)):
     """
     Cancel a fine tuning job on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.cancel_fine_tuning(job_id)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.cancel_fine_tuning(job_id))
+    return stream_upstream(resp, sec, f"/fine_tuning/jobs/{job_id}/cancel", request_data=f"POST Request to /fine_tuning/jobs/{job_id}/cancel", slot=slot)
 
 # Batch endpoints
 
 @app.post("/batches")
-def create_batch(data: dict, response: Response, credentials=Depends(security)):
+async def create_batch(response: Response, payload: passthrough.JSONBody = Depends(checked_body), sec=Depends(rate_limited)):
     """
     Create a batch on OpenAI API
     """
-    sec = authenticate(credentials)
-
+    data = payload.data
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.create_batch(data)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.create_batch(data, payload.raw))
+    return stream_upstream(resp, sec, "/batches", request_data=payload.raw, slot=slot)
 
 @app.get("/batches")
-def list_batches(response: Response, credentials=Depends(security)):
+async def list_batches(response: Response, sec=Depends(rate_limited)):
     """
     List all batches on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.list_batches()
-    return resp
+    resp, slot = await send_upstream(sec, None, openai_module.list_batches)
+    return stream_upstream(resp, sec, "/batches", request_data="GET Request to /batches", slot=slot)
 
 @app.get("/batches/{batch_id}")
-def get_batch(batch_id: str, response: Response, credentials=Depends(security)):
+async def get_batch(batch_id: str, response: Response, sec=Depends(rate_limited)):
     """
     Retrieve a batch on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.retrieve_batch(batch_id)
-    return resp
+    if singleflight.ENABLED:
+        key = singleflight.request_key(f"/batches/{batch_id}")
+        start = lambda: singleflight.stream(key, lambda: openai_module.retrieve_batch(batch_id))
+    else:
+        start = lambda: openai_module.retrieve_batch(batch_id)
+    resp, slot = await send_upstream(sec, None, start)
+    return stream_upstream(resp, sec, f"/batches/{batch_id}", request_data=f"GET Request to /batches/{batch_id}", slot=slot)
 
 @app.post("/batches/{batch_id}/cancel")
-def cancel_batch(batch_id: str, response: Response, credentials=Depends(security)):
+async def cancel_batch(batch_id: str, response: Response, sec=Depends(rate_limited)):
     """
     Cancel a batch on OpenAI API
     """
-    sec = authenticate(credentials)
-
     if not sec:
         response.status_code = 401
         return {"message": "Invalid token"}
 
-    resp = openai_module.cancel_batch(batch_id)
-    return resp
+    resp, slot = await send_upstream(sec, None, lambda: openai_module.cancel_batch(batch_id))
+    return stream_upstream(resp, sec, f"/batches/{batch_id}/cancel", request_data=f"POST Request to /batches/{batch_id}/cancel", slot=slot)
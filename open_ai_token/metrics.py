@@ -0,0 +1,267 @@
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+import orjson
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+
+# prometheus_client decides between in-process and shared file values when it is imported,
+# so PROMETHEUS_MULTIPROC_DIR has to be in the environment before this import
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess  # noqa: E402
+
+# Metrics for /metrics in the Prometheus text format. With several workers, point
+# PROMETHEUS_MULTIPROC_DIR at a directory they share and that is emptied before they start:
+# every worker then keeps its samples in memory mapped files there and /metrics merges them,
+# whichever worker answers the scrape.
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Model names are client input, past this many distinct ones they are labelled "other"
+MAX_MODELS = int(os.getenv("METRICS_MAX_MODELS", "64"))
+
+# Each request also times its phases (auth, policy, queue, upstream connect, ...). Those done
+# before the response starts are sent back in a Server-Timing header; requests slower than
+# SLOW_REQUEST_MS to start their response are logged with every phase, a sample of them if
+# SLOW_REQUEST_SAMPLE_RATE is below 1.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "5000"))
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", "1"))
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+_SLOW_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+REQUEST_SECONDS = Histogram(
+    "gateway_request_duration_seconds", "Time from receiving a request to the last byte of its response",
+    ("route", "model"), buckets=_SLOW_BUCKETS
+)
+STREAM_SECONDS = Histogram(
+    "gateway_stream_duration_seconds", "Time spent relaying an upstream response to the client",
+    ("route", "model"), buckets=_SLOW_BUCKETS
+)
+UPSTREAM_TTFB_SECONDS = Histogram(
+    "gateway_upstream_ttfb_seconds", "Time for upstream to send response headers, the whole response for non-streamed calls, per attempt",
+    ("endpoint", "model"), buckets=_SLOW_BUCKETS
+)
+AUTH_SECONDS = Histogram(
+    "gateway_auth_duration_seconds", "Time spent authenticating a request's token, including any database lookup",
+    ("route", "model"), buckets=_FAST_BUCKETS
+)
+DB_SECONDS = Histogram(
+    "gateway_db_duration_seconds", "Time a request spent executing database statements",
+    ("route", "model"), buckets=_FAST_BUCKETS
+)
+DB_STATEMENTS = Counter("gateway_db_statements", "Database statements run while handling requests, by route", ("route",))
+RESPONSES = Counter("gateway_responses", "Responses sent, by route and status code", ("route", "status"))
+UPSTREAM_RESPONSES = Counter("gateway_upstream_responses", "Upstream responses, by endpoint and status code", ("endpoint", "status"))
+REJECTIONS = Counter("gateway_rejections", "Requests refused before reaching upstream, by reason", ("reason",))
+STREAMS_IN_FLIGHT = Gauge("gateway_streams_in_flight", "Upstream responses being relayed to clients", multiprocess_mode="livesum")
+UPSTREAM_SLOTS_IN_USE = Gauge("gateway_upstream_slots_in_use", "Scheduler slots held, by model family", ("family",), multiprocess_mode="livesum")
+DB_CONNECTIONS_IN_USE = Gauge("gateway_db_connections_in_use", "Database connections checked out, by pool", ("pool",), multiprocess_mode="livesum")
+
+_models = set()
+_routes: Dict[Callable, str] = {}
+
+
+def model_label(model) -> str:
+    if not isinstance(model, str) or not model:
+        return ""
+    if model in _models:
+        return model
+    if len(_models) < MAX_MODELS and len(model) <= 64:
+        _models.add(model)
+        return model
+    return "other"
+
+
+def route_label(scope) -> str:
+    """
+        The path template of the route that handled a request, so /batches/{batch_id} is one series
+    """
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    route = _routes.get(endpoint)
+    if route is None:
+        _routes.update((getattr(r, "endpoint", None), r.path) for r in scope["app"].routes)
+        route = _routes.get(endpoint, "unmatched")
+    return route
+
+
+class _Request:
+    __slots__ = ("scope", "started", "model", "spans", "db_seconds", "db_statements")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.model = ""
+        self.spans: Dict[str, float] = {}
+        self.db_seconds = 0.0
+        self.db_statements = 0
+
+    def labels(self):
+        return route_label(self.scope), self.model
+
+    def timings(self) -> Dict[str, float]:
+        timings = dict(self.spans)
+        if self.db_seconds:
+            timings["db"] = self.db_seconds
+        return timings
+
+    def server_timing(self) -> bytes:
+        timings = self.timings()
+        timings["total"] = time.perf_counter() - self.started
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()).encode()
+
+
+_current: ContextVar[Optional[_Request]] = ContextVar("metrics_request", default=None)
+
+
+class MetricsMiddleware:
+    """
+        Times every HTTP request and its phases and counts its status. Plain ASGI so streamed
+        bodies pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        current = _Request(scope)
+        reset = _current.set(current)
+        status = 500
+        first_byte: Optional[float] = None
+
+        async def send_with_status(message):
+            nonlocal status, first_byte
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                first_byte = time.perf_counter() - current.started
+                if SERVER_TIMING:
+                    message = dict(message, headers=[*message.get("headers", ()), (b"server-timing", current.server_timing())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _current.reset(reset)
+            elapsed = time.perf_counter() - current.started
+            route, model = current.labels()
+            REQUEST_SECONDS.labels(route, model).observe(elapsed)
+            RESPONSES.labels(route, str(status)).inc()
+            if "auth" in current.spans:
+                AUTH_SECONDS.labels(route, model).observe(current.spans["auth"])
+            if current.db_statements:
+                DB_SECONDS.labels(route, model).observe(current.db_seconds)
+                DB_STATEMENTS.labels(route).inc(current.db_statements)
+            if (first_byte or elapsed) * 1000 >= SLOW_REQUEST_MS and random.random() < SLOW_REQUEST_SAMPLE_RATE:
+                _log_slow(current, route, status, first_byte, elapsed)
+
+
+def _log_slow(current: _Request, route: str, status: int, first_byte: Optional[float], elapsed: float):
+    print("Slow request " + orjson.dumps({
+        "method": current.scope["method"],
+        "path": current.scope["path"],
+        "route": route,
+        "model": current.model,
+        "status": status,
+        "first_byte_ms": round(first_byte * 1000, 1) if first_byte is not None else None,
+        "total_ms": round(elapsed * 1000, 1),
+        "spans_ms": {name: round(seconds * 1000, 1) for name, seconds in current.timings().items()}
+    }).decode())
+
+
+def set_model(model):
+    current = _current.get()
+    if current is not None:
+        current.model = model_label(model)
+
+
+def add_span(name: str, seconds: float):
+    current = _current.get()
+    if current is not None:
+        current.spans[name] = current.spans.get(name, 0.0) + seconds
+
+
+class span:
+    """
+        Time a phase of the current request, added to any time already spent in the same phase
+    """
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        add_span(self.name, time.perf_counter() - self.started)
+
+
+def stream_started() -> float:
+    STREAMS_IN_FLIGHT.inc()
+    return time.perf_counter()
+
+
+def stream_finished(started: float):
+    STREAMS_IN_FLIGHT.dec()
+    seconds = time.perf_counter() - started
+    add_span("stream", seconds)
+    current = _current.get()
+    route, model = current.labels() if current is not None else ("unmatched", "")
+    STREAM_SECONDS.labels(route, model).observe(seconds)
+
+
+def upstream_response(endpoint: str, model, status_code: int, seconds: float):
+    UPSTREAM_TTFB_SECONDS.labels(endpoint, model_label(model)).observe(seconds)
+    UPSTREAM_RESPONSES.labels(endpoint, str(status_code)).inc()
+
+
+def rejected(reason: str):
+    REJECTIONS.labels(reason).inc()
+
+
+def watch_engine(engine, pool: str):
+    """
+        Track an engine's connections in use, and the statement time of whichever request runs them
+    """
+    in_use = DB_CONNECTIONS_IN_USE.labels(pool)
+    event.listen(engine, "checkout", lambda *args: in_use.inc())
+    event.listen(engine, "checkin", lambda *args: in_use.dec())
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def started(conn, *args):
+        if _current.get() is not None:
+            conn.info["metrics_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def finished(conn, *args):
+        began = conn.info.pop("metrics_started", None)
+        current = _current.get()
+        if began is not None and current is not None:
+            current.db_seconds += time.perf_counter() - began
+            current.db_statements += 1
+
+
+def render() -> bytes:
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def shutdown():
+    """
+        Drop this worker's live gauges from the shared files
+    """
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
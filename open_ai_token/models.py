@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, LargeBinary, String, DateTime, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID
 import datetime
@@ -12,7 +12,7 @@ class User(Base):
     __tablename__ = "users"
     slack_id = Column(String, primary_key=True)
     name = Column(String)
-    email = Column(String, nullable=True)
+    email = Column(String, nullable=True, index=True)
     is_admin = Column(Boolean, default=False)
     is_club_leader = Column(Boolean, default=False)
     can_use_superpowers = Column(Boolean, default=False)
@@ -26,13 +26,22 @@ class User(Base):
 
 class Token(Base):
     __tablename__ = "tokens"
-    token = Column(String, primary_key=True, default=uuid.uuid4)
+    __table_args__ = (
+        # Keyset pagination orders tokens by (created_at, token), optionally within an owner
+        Index("ix_tokens_created_at_token", "created_at", "token"),
+        Index("ix_tokens_user_id_created_at_token", "user_id", "created_at", "token"),
+        Index("ix_tokens_uses_left", "uses_left"),
+        # Few tokens are blocked, so only those are indexed. SQLite compares booleans with 1.
+        Index("ix_tokens_blocked_created_at_token", "created_at", "token", postgresql_where=text("is_blocked"), sqlite_where=text("is_blocked = 1")),
+    )
+    token = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = Column(String, ForeignKey("users.slack_id"))
     is_active = Column(Boolean, default=True)
     is_revoked = Column(Boolean, default=False) # This is for the user to revoke the token
     is_expired = Column(Boolean, default=False) # This is for the system to revoke the token
     is_blocked = Column(Boolean, default=False) # This is for the system to block the token due to abuse
     uses_left = Column(Integer, default=500)
+    uses_version = Column(Integer, nullable=False, default=0, server_default="0") # Bumped when uses_left is overwritten, see quota.py
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     user = relationship("User", back_populates="tokens")
     usages = relationship("Usage", backref="token")
@@ -40,9 +49,45 @@ class Token(Base):
 
 class Usage(Base):
     __tablename__ = "usages"
+    __table_args__ = (
+        # A token's usage over a time range, and time-range scans across all tokens
+        Index("ix_usages_token_id_created_at", "token_id", "created_at"),
+        Index("ix_usages_created_at", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     request_data = Column(Text)
     response_data = Column(Text)
     token_id = Column(String, ForeignKey("tokens.token"))
     endpoint = Column(String)
+    model = Column(String, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    total_tokens = Column(Integer, nullable=True)
+    finish_reason = Column(String, nullable=True)
+    status_code = Column(Integer, nullable=True)
+    latency_ms = Column(Integer, nullable=True)
+    # Bodies live in request_data/response_data, compressed in body, or in a segment file
+    # referenced by body_ref, depending on USAGE_BODY_STORAGE (see bodystore.py)
+    body = Column(LargeBinary, nullable=True)
+    body_ref = Column(String, nullable=True)
+
+
+class UsageRollup(Base):
+    """
+    Usage totals per token and model for each hour and each day, kept up to date by the usage writer
+    """
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        Index("ix_usage_rollups_user_id_period_bucket", "user_id", "period", "bucket"),
+    )
+    period = Column(String, primary_key=True) # "hour" or "day"
+    bucket = Column(DateTime, primary_key=True) # Start of the period, UTC
+    token_id = Column(String, primary_key=True)
+    model = Column(String, primary_key=True) # "" when the request had no model
+    user_id = Column(String, nullable=False, server_default="")
+    requests = Column(Integer, nullable=False, server_default="0")
+    errors = Column(Integer, nullable=False, server_default="0")
+    prompt_tokens = Column(Integer, nullable=False, server_default="0")
+    completion_tokens = Column(Integer, nullable=False, server_default="0")
+    total_tokens = Column(Integer, nullable=False, server_default="0")
@@ -1,204 +1,286 @@
 from typing import Optional
-from typing_extensions import Generator
-import requests
+from typing_extensions import AsyncIterator
+import anyio
+import httpx
 from dotenv import load_dotenv
 import os
+import time
 
-from open_ai_token.schemas import Token, User
-from open_ai_token.crud import get_token
-from open_ai_token.database import SessionLocal
-from open_ai_token.models import User as UserModel
-
-db = SessionLocal()
+from open_ai_token import keys, metrics, passthrough, resilience
 
 load_dotenv()
 
 # Request to OpenAI API to get the answer, basically act as an API gateway to OpenAI API
 
+# Any OpenAI compatible server can stand in, e.g. `python -m benchmarks.mock_openai` for benchmarks
+BASE_URL = os.getenv("OPEN_AI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+
+# Upstream connection pool, shared by every route for the lifetime of the app
+MAX_CONNECTIONS = int(os.getenv("OPEN_AI_MAX_CONNECTIONS", "200"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPEN_AI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+KEEPALIVE_EXPIRY = float(os.getenv("OPEN_AI_KEEPALIVE_EXPIRY", "30"))
+CONNECT_TIMEOUT = float(os.getenv("OPEN_AI_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("OPEN_AI_READ_TIMEOUT", "600"))
+POOL_TIMEOUT = float(os.getenv("OPEN_AI_POOL_TIMEOUT", "30"))
+HTTP2 = os.getenv("OPEN_AI_HTTP2", "true").lower() not in ("0", "false", "no")
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=HTTP2 and _http2_available(),
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT),
+    )
+
+
+async def startup():
+    """
+        Open the shared upstream client
+    """
+    global _client
+    if _client is None:
+        _client = _create_client()
+
+
+async def shutdown():
+    """
+        Close the shared upstream client and every pooled connection
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+        Get the shared upstream client, creating it if the app lifespan has not
+    """
+    global _client
+    if _client is None:
+        _client = _create_client()
+    return _client
+
+
+class _ConnectTrace:
+    """
+        httpcore trace hook timing how long opening a new connection took, TCP and TLS.
+        Nothing is reported when a pooled connection is reused.
+    """
+
+    __slots__ = ("started", "seconds")
+
+    def __init__(self):
+        self.started: Optional[float] = None
+        self.seconds = 0.0
+
+    async def __call__(self, name: str, info: dict):
+        if name == "connection.connect_tcp.started":
+            self.started = time.perf_counter()
+        elif name in ("connection.connect_tcp.complete", "connection.start_tls.complete") and self.started is not None:
+            self.seconds = time.perf_counter() - self.started
+
+
+async def _send_once(method: str, path: str, data: Optional[dict] = None, stream: bool = True, raw: Optional[bytes] = None) -> httpx.Response:
+    """
+        Send a request upstream once with the pooled key that has the most headroom, failing over to
+        another key on 429. Streamed requests return as soon as the response headers arrive.
+        If the original body bytes are given they are sent as they are instead of encoding `data`.
+    """
+    client = get_client()
+    model = data.get("model") if isinstance(data, dict) else None
+    tried = []
+    resp = None
+    while True:
+        # After a 429 only fail over to keys that are not throttled themselves
+        key = keys.pick(model, exclude=tried, allow_throttled=not tried)
+        if key is None:
+            if resp is not None:
+                return resp
+            return httpx.Response(403, json={"error": {"message": f"No upstream key is configured for model {model}"}})
+        if resp is not None:
+            await resp.aclose()
+        if raw is not None:
+            req = client.build_request(method, f"{BASE_URL}{path}", content=raw, headers={**key.headers(), "Content-Type": "application/json"})
+        else:
+            req = client.build_request(method, f"{BASE_URL}{path}", json=data, headers=key.headers())
+        trace = _ConnectTrace()
+        req.extensions["trace"] = trace
+        started = time.perf_counter()
+        resp = await client.send(req, stream=stream)
+        elapsed = time.perf_counter() - started
+        metrics.add_span("connect", trace.seconds)
+        metrics.add_span("ttfb", elapsed - trace.seconds)
+        metrics.upstream_response(resilience.endpoint_of(path), model, resp.status_code, elapsed)
+        key.observe(resp.headers)
+        if resp.status_code != 429:
+            return resp
+        key.throttle(resp.headers)
+        tried.append(key)
+
+
+async def _send(method: str, path: str, data: Optional[dict] = None, stream: bool = True, raw: Optional[bytes] = None, retry: Optional[str] = None) -> httpx.Response:
+    """
+        Send a request upstream through the resilience layer. Reads may always be retried, other
+        calls only when upstream never got them or refused them, unless `retry` says otherwise.
+        Non-streamed calls are short enough to hedge.
+    """
+    if retry is None:
+        retry = "all" if method == "GET" else "safe"
+    return await resilience.call(path, lambda: _send_once(method, path, data, stream, raw), retry=retry, hedge=not stream)
+
+
+async def _stream(method: str, path: str, data: Optional[dict] = None, raw: Optional[bytes] = None, retry: Optional[str] = None) -> httpx.Response:
+    """
+        Send a request upstream and return as soon as the response headers arrive
+    """
+    return await _send(method, path, data, stream=True, raw=raw, retry=retry)
+
+
+async def iter_response(resp: httpx.Response) -> AsyncIterator[bytes]:
+    """
+        Yield the upstream body as it arrives and release the connection back to the pool
+    """
+    try:
+        async for chunk in resp.aiter_bytes():
+            yield chunk
+    finally:
+        # Shielded so an abandoned stream still gets its connection closed
+        with anyio.CancelScope(shield=True):
+            await resp.aclose()
+
 #* Models
 
-def models():
+async def models():
     """
         Get the list of models available on OpenAI API
     """
-    req = requests.get('https://api.openai.com/v1/models', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"})
-    if req.status_code != 200:
-        raise Exception(req.json())
+    req = await _send("GET", "/models", stream=False)
     return req.json(), req.status_code, req.headers
 
 
-def model(model_name):
+async def model(model_name):
     """
         Get the details of a model available on OpenAI API
     """
-    req = requests.get(f'https://api.openai.com/v1/models/{model_name}', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"})
-    if req.status_code != 200:
-        raise Exception(req.json())
+    req = await _send("GET", f"/models/{model_name}", stream=False)
     return req.json(), req.status_code, req.headers
 
 #* Chat
 
-def post_chat_completions(data: dict, sec: Token):
+async def send_chat_completions(data: dict, raw: Optional[bytes] = None) -> httpx.Response:
     """
-        Post a chat to OpenAI API
+        Post a chat to OpenAI API. The route has already applied the policy.
     """
-    blocked_models=["gpt-4-turbo-preview","gpt-4o", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo", "gpt-4-1106-preview", "gpt-4-0613", "gpt-4o-2024-05-13"]
-
-    usr: UserModel = get_token(db, sec.token)
-    if data["model"] in blocked_models and not usr.user.gpt4_usage_allowed:
-        return {"error": "This model is not available for use at this time."}, 403, {"error": "This model is not available for use at this time."}
+    if passthrough.adds_stream_usage(data):
+        # Ask for a final usage event so streamed requests can be accounted for
+        if raw is not None and "stream_options" not in data:
+            raw = passthrough.with_stream_usage(raw)
+        else:
+            data = dict(data, stream_options=dict(data.get("stream_options") or {}, include_usage=True))
+            raw = None
 
-    try:
-        def gen():
-            with requests.post('https://api.openai.com/v1/chat/completions', json=data, headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-                if req.status_code != 200:
-                    raise Exception(req.json())
-                for chunk in req.iter_content(chunk_size=1024):
-                    yield chunk
-        return gen()
-
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("POST", "/chat/completions", data, raw)
 
 #* Image
 
-def create_image(data):
+async def create_image(data, raw: Optional[bytes] = None):
     """
         Create an image on OpenAI API
     """
-    try:
-        with requests.post('https://api.openai.com/v1/images/generations', json=data, headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("POST", "/images/generations", data, raw)
 
     # Todo: Add more endpoints that are available on OpenAI API, particularly which require file upload
 
 #* Embeddings
 
-def embeddings(data):
+async def embeddings(data, raw: Optional[bytes] = None):
     """
         Get the embeddings of a text on OpenAI API
     """
-    try:
-        with requests.post('https://api.openai.com/v1/embeddings', json=data, headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("POST", "/embeddings", data, raw)
 
 
-def create_fine_tuning(data):
+async def create_embeddings(data) -> httpx.Response:
+    """
+        Get the embeddings of a text on OpenAI API, reading the whole response
+    """
+    return await _send("POST", "/embeddings", data, stream=False)
+
+
+async def create_fine_tuning(data, raw: Optional[bytes] = None):
     """
         Create a fine tuning on OpenAI API
     """
-    try:
-        with requests.post('https://api.openai.com/v1/fine_tuning/jobs', json=data, headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    # A retried create could start a second job
+    return await _stream("POST", "/fine_tuning/jobs", data, raw, retry="never")
 
-def list_fine_tuning():
+async def list_fine_tuning():
     """
         List all fine tuning on OpenAI API
     """
-    try:
-        with requests.get('https://api.openai.com/v1/fine_tuning/jobs', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("GET", "/fine_tuning/jobs")
 
-def list_fine_tuning_events(job_id):
+async def list_fine_tuning_events(job_id):
     """
         List all fine tuning events on OpenAI API
     """
-    try:
-        with requests.get(f'https://api.openai.com/v1/fine_tuning/jobs/{job_id}/events', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("GET", f"/fine_tuning/jobs/{job_id}/events")
 
-def list_fine_tuning_checkpoints(job_id):
+async def list_fine_tuning_checkpoints(job_id):
     """
         List all fine tuning checkpoints on OpenAI API
     """
-    try:
-        with requests.get(f'https://api.openai.com/v1/fine_tuning/jobs/{job_id}/checkpoints', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("GET", f"/fine_tuning/jobs/{job_id}/checkpoints")
 
-def retrieve_fine_tuning(job_id):
+async def retrieve_fine_tuning(job_id):
     """
         Retrieve a fine tuning on OpenAI API
     """
-    try:
-        with requests.get(f'https://api.openai.com/v1/fine_tuning/jobs/{job_id}', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("GET", f"/fine_tuning/jobs/{job_id}")
 
-def cancel_fine_tuning(job_id):
+async def cancel_fine_tuning(job_id):
     """
         Cancel a fine tuning on OpenAI API
     """
-    try:
-        with requests.post(f'https://api.openai.com/v1/fine_tuning/jobs/{job_id}/cancel', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("POST", f"/fine_tuning/jobs/{job_id}/cancel")
 
 # Batch Endpoints
 
-def create_batch(data):
+async def create_batch(data, raw: Optional[bytes] = None):
     """
         Create a batch on OpenAI API
     """
-    try:
-        with requests.post('https://api.openai.com/v1/batches', json=data, headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("POST", "/batches", data, raw, retry="never")
 
-def retrieve_batch(job_id):
+async def retrieve_batch(job_id):
     """
         Retrieve a batch on OpenAI API
     """
-    try:
-        with requests.get(f'https://api.openai.com/v1/batches/{job_id}', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("GET", f"/batches/{job_id}")
 
-def cancel_batch(job_id):
+async def cancel_batch(job_id):
     """
         Cancel a batch on OpenAI API
     """
-    try:
-        with requests.post(f'https://api.openai.com/v1/batches/{job_id}/cancel', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("POST", f"/batches/{job_id}/cancel")
 
-def list_batches():
+async def list_batches():
     """
         List all batches on OpenAI API
     """
-    try:
-        with requests.get('https://api.openai.com/v1/batches', headers={"Authorization": f"Bearer {os.getenv('OPEN_AI_KEY')}"}, stream=True) as req:
-            for chunk in req.iter_content(chunk_size=1024):
-                yield chunk
-    except Exception as e:
-        return {"error": str(e)}, 500, {"error": str(e)}
+    return await _stream("GET", "/batches")
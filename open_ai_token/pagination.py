@@ -0,0 +1,64 @@
+import base64
+import datetime
+import os
+from typing import AsyncIterator, Iterable, Iterator, Mapping, Tuple
+
+import orjson
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# List routes page with opaque cursors holding the sort key of the last row returned, so each page
+# is an index range scan instead of an OFFSET that reads and throws away every earlier row.
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> tuple:
+    """
+        The values in a cursor made by encode_cursor. Raises ValueError if it is not one.
+    """
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return tuple(values)
+
+
+def decode_time_cursor(cursor: str) -> Tuple[datetime.datetime, str]:
+    """
+        A (created_at, key) cursor
+    """
+    created_at, key = decode_cursor(cursor, 2)
+    try:
+        return datetime.datetime.fromisoformat(created_at), key
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+async def ndjson_stream(result) -> AsyncIterator[bytes]:
+    """
+        Encode a streamed result as newline delimited JSON, one chunk per partition it is fetched in
+    """
+    async for rows in result.mappings().partitions():
+        yield b"".join(orjson.dumps(dict(row)) + b"\n" for row in rows)
+
+
+def ndjson(rows: Iterable[Mapping], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+        Encode rows as newline delimited JSON, a chunk of rows per yield so a sync generator
+        does not hop threads for every row
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(orjson.dumps(dict(row)))
+        if len(chunk) >= chunk_size:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
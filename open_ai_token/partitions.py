@@ -0,0 +1,150 @@
+import datetime
+import os
+import re
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from open_ai_token import bodystore
+from open_ai_token.database import engine
+
+load_dotenv()
+
+# On Postgres `usages` is range partitioned by created_at (migration 0005). Partitions are
+# created ahead of time and retention drops whole partitions, so old usage never goes
+# through a large DELETE. Other databases fall back to deleting old rows in batches.
+INTERVAL = os.getenv("USAGE_PARTITION_INTERVAL", "month")
+AHEAD = int(os.getenv("USAGE_PARTITIONS_AHEAD", "2"))
+# 0 keeps usage forever
+RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "0"))
+DELETE_BATCH_SIZE = int(os.getenv("USAGE_RETENTION_DELETE_BATCH_SIZE", "5000"))
+
+# Any constant works, it only has to be the same in every worker
+_LOCK_ID = 0x75736167
+_BOUND = re.compile(r"FOR VALUES FROM \((.+)\) TO \((.+)\)")
+
+_stats = {"partitions_created": 0, "partitions_dropped": 0, "rows_deleted": 0, "segments_removed": 0, "runs": 0}
+
+
+def period_start(moment: datetime.datetime) -> datetime.datetime:
+    moment = moment.astimezone(datetime.timezone.utc)
+    if INTERVAL == "day":
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_period(start: datetime.datetime) -> datetime.datetime:
+    if INTERVAL == "day":
+        return start + datetime.timedelta(days=1)
+    return (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start: datetime.datetime) -> str:
+    return "usages_" + start.strftime("%Y%m%d" if INTERVAL == "day" else "%Y%m")
+
+
+def _parse_bound(value: str):
+    value = value.strip()
+    if value in ("MINVALUE", "MAXVALUE"):
+        return value
+    # '2026-11-01 00:00:00+00'
+    return datetime.datetime.fromisoformat(value.strip("'")).astimezone(datetime.timezone.utc)
+
+
+def _partitions(conn: Connection) -> List[Tuple[str, object, object]]:
+    rows = conn.execute(text(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'usages'"
+    )).all()
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND.match(bound)
+        if match:
+            # The DEFAULT partition has no range and is never dropped
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return partitions
+
+
+def is_partitioned(conn: Connection) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return bool(conn.scalar(text("SELECT relkind = 'p' FROM pg_class WHERE relname = 'usages'")))
+
+
+def ensure(conn: Connection, now: datetime.datetime):
+    """
+        Create partitions up to AHEAD periods past now, continuing from the latest one
+    """
+    uppers = [upper for _, _, upper in _partitions(conn) if isinstance(upper, datetime.datetime)]
+    start = max(uppers) if uppers else period_start(now)
+    horizon = period_start(now)
+    for _ in range(AHEAD + 1):
+        horizon = next_period(horizon)
+    while start < horizon:
+        end = next_period(start)
+        conn.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{partition_name(start)}" PARTITION OF usages '
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        _stats["partitions_created"] += 1
+        start = end
+
+
+def prune(conn: Connection, cutoff: datetime.datetime):
+    """
+        Drop partitions that end at or before cutoff
+    """
+    for name, _, upper in _partitions(conn):
+        if isinstance(upper, datetime.datetime) and upper <= cutoff:
+            conn.execute(text(f'DROP TABLE "{name}"'))
+            _stats["partitions_dropped"] += 1
+
+
+def delete_before(conn: Connection, cutoff: datetime.datetime):
+    """
+        Unpartitioned fallback: delete old rows a batch at a time so no single statement holds locks for long
+    """
+    while True:
+        deleted = conn.execute(text(
+            "DELETE FROM usages WHERE id IN (SELECT id FROM usages WHERE created_at < :cutoff LIMIT :limit)"
+        ), {"cutoff": cutoff, "limit": DELETE_BATCH_SIZE}).rowcount
+        conn.commit()
+        _stats["rows_deleted"] += deleted
+        if deleted < DELETE_BATCH_SIZE:
+            return
+
+
+def maintain():
+    """
+        Create upcoming partitions and apply retention. Blocking, run it in a thread.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(days=RETENTION_DAYS) if RETENTION_DAYS else None
+    with engine.connect() as conn:
+        if is_partitioned(conn):
+            # Every worker runs this, one at a time is enough
+            if not conn.scalar(text("SELECT pg_try_advisory_lock(:id)"), {"id": _LOCK_ID}):
+                return
+            try:
+                ensure(conn, now)
+                if cutoff is not None:
+                    prune(conn, cutoff)
+                conn.commit()
+            finally:
+                # No-op after the commit, clears a failed transaction otherwise
+                conn.rollback()
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": _LOCK_ID})
+                conn.commit()
+        elif cutoff is not None:
+            delete_before(conn, cutoff)
+    if cutoff is not None:
+        _stats["segments_removed"] += bodystore.prune_segments(cutoff)
+    _stats["runs"] += 1
+
+
+def stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,37 @@
+import orjson
+
+# Request bodies are read once as bytes and forwarded upstream untouched. They are decoded with
+# orjson only so the gateway can look at the fields it needs (model, stream, n, ...); nothing is
+# validated or re-serialized on the way through.
+
+_STREAM_USAGE = b'"stream_options":{"include_usage":true},'
+
+
+class JSONBody:
+    __slots__ = ("raw", "data")
+
+    def __init__(self, raw: bytes):
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            raise ValueError("Request body is not valid JSON")
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object")
+        self.raw = raw
+        self.data = data
+
+
+def adds_stream_usage(data: dict) -> bool:
+    """
+        Whether the gateway asks upstream for the usage event of a streamed request itself, because
+        the client did not. The event is then recorded and dropped rather than relayed.
+    """
+    return bool(data.get("stream")) and not (data.get("stream_options") or {}).get("include_usage")
+
+
+def with_stream_usage(raw: bytes) -> bytes:
+    """
+        Add stream_options.include_usage to a body that has no stream_options, without re-encoding it
+    """
+    start = raw.index(b"{") + 1
+    return raw[:start] + _STREAM_USAGE + raw[start:]
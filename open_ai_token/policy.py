@@ -0,0 +1,214 @@
+import fnmatch
+import json
+import os
+import time
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from open_ai_token import metrics, ratelimit
+from open_ai_token.schemas import TokenState
+
+load_dotenv()
+
+# Who may call which model, compiled from a JSON policy into lookup tables and checked against the
+# token state authentication already loaded. POLICY_FILE is re-read when it changes, at most every
+# POLICY_RELOAD_INTERVAL seconds; a file that fails to compile is reported and the last good policy kept.
+#
+#   models     [{"match": "gpt-4*", "requires": ["gpt4_usage_allowed"]}, ...]  exact names or globs,
+#              every matching rule applies
+#   tiers      {"default": {"max_tokens": 4096, "n": 4}, ...}  caps per rate limit tier
+#   endpoints  {"/images/generations": {"requires": ["image_usage_allowed"], "models": ["dall-e-*"]}}
+POLICY_FILE = os.getenv("POLICY_FILE", "policy.json")
+RELOAD_INTERVAL = float(os.getenv("POLICY_RELOAD_INTERVAL", "5"))
+
+DEFAULT_POLICY = {
+    "models": [
+        {
+            "match": [
+                "gpt-4-turbo-preview", "gpt-4o", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo",
+                "gpt-4-1106-preview", "gpt-4-0613", "gpt-4o-2024-05-13"
+            ],
+            "requires": ["gpt4_usage_allowed"]
+        }
+    ],
+    "tiers": {},
+    "endpoints": {
+        "/images/generations": {"requires": ["image_usage_allowed"]}
+    }
+}
+
+# TokenState flags a rule can require
+CAPABILITIES = frozenset(("gpt4_usage_allowed", "image_usage_allowed", "can_use_superpowers", "is_admin", "is_club_leader"))
+CAPS = ("max_tokens", "n")
+
+_stats = {"allowed": 0, "denied": 0, "reloads": 0, "reload_errors": 0}
+
+
+class PolicyDenied(Exception):
+    def __init__(self, message: str, status_code: int = 403):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _requirements(rule: dict) -> FrozenSet[str]:
+    requires = rule.get("requires") or []
+    if isinstance(requires, str):
+        requires = [requires]
+    unknown = set(requires) - CAPABILITIES
+    if unknown:
+        raise ValueError(f"Unknown capabilities {sorted(unknown)}, use {sorted(CAPABILITIES)}")
+    return frozenset(requires)
+
+
+def _patterns(value) -> List[str]:
+    return [value] if isinstance(value, str) else list(value)
+
+
+class ModelTable:
+    """
+        Model names and patterns to values: exact names in a dict, trailing-* prefixes longest
+        first, anything else through fnmatch. Lookups are memoized per model name.
+    """
+
+    def __init__(self, entries: List[Tuple[str, object]]):
+        self.exact: Dict[str, List[object]] = {}
+        self.prefixes: List[Tuple[str, object]] = []
+        self.globs: List[Tuple[str, object]] = []
+        for pattern, value in entries:
+            if not any(c in pattern for c in "*?["):
+                self.exact.setdefault(pattern, []).append(value)
+            elif pattern.endswith("*") and not any(c in pattern[:-1] for c in "*?["):
+                self.prefixes.append((pattern[:-1], value))
+            else:
+                self.globs.append((pattern, value))
+        self.prefixes.sort(key=lambda entry: len(entry[0]), reverse=True)
+        self.lookup = lru_cache(maxsize=4096)(self._lookup)
+
+    def _lookup(self, model: str) -> tuple:
+        found = list(self.exact.get(model, ()))
+        found += [value for prefix, value in self.prefixes if model.startswith(prefix)]
+        found += [value for pattern, value in self.globs if fnmatch.fnmatchcase(model, pattern)]
+        return tuple(found)
+
+
+class Policy:
+    def __init__(self, config: dict):
+        self.models = ModelTable([
+            (pattern, _requirements(rule)) for rule in config.get("models", []) for pattern in _patterns(rule["match"])
+        ])
+        self.tiers: Dict[str, Dict[str, int]] = {}
+        for name, caps in config.get("tiers", {}).items():
+            unknown = set(caps) - set(CAPS)
+            if unknown:
+                raise ValueError(f"Unknown caps {sorted(unknown)} for tier {name}, use {list(CAPS)}")
+            self.tiers[name] = {cap: int(limit) for cap, limit in caps.items() if limit is not None}
+        self.endpoints: Dict[str, Tuple[FrozenSet[str], Optional[ModelTable]]] = {}
+        for endpoint, rule in config.get("endpoints", {}).items():
+            allowed = rule.get("models")
+            table = ModelTable([(pattern, True) for pattern in _patterns(allowed)]) if allowed is not None else None
+            self.endpoints[endpoint] = (_requirements(rule), table)
+
+    def authorize(self, endpoint: str, state: TokenState):
+        if state.is_banned:
+            raise PolicyDenied("This account has been banned.")
+        requires, _ = self.endpoints.get(endpoint, (frozenset(), None))
+        for capability in requires:
+            if not getattr(state, capability):
+                raise PolicyDenied("This endpoint is not available for use at this time.")
+
+    def check_body(self, endpoint: str, data: dict, state: TokenState):
+        _, allowed = self.endpoints.get(endpoint, (frozenset(), None))
+        model = data.get("model")
+        if isinstance(model, str):
+            if allowed is not None and not allowed.lookup(model):
+                raise PolicyDenied(f"The model {model} cannot be used with {endpoint}.")
+            for requirement in self.models.lookup(model):
+                for capability in requirement:
+                    if not getattr(state, capability):
+                        raise PolicyDenied("This model is not available for use at this time.")
+
+        caps = self.tiers.get(ratelimit.tier(state))
+        if caps:
+            limit = caps.get("max_tokens")
+            requested = data.get("max_completion_tokens") or data.get("max_tokens")
+            if limit is not None and isinstance(requested, int) and requested > limit:
+                raise PolicyDenied(f"max_tokens is limited to {limit} for your account.", 400)
+            limit = caps.get("n")
+            requested = data.get("n")
+            if limit is not None and isinstance(requested, int) and requested > limit:
+                raise PolicyDenied(f"n is limited to {limit} for your account.", 400)
+
+
+def _read() -> Tuple[Optional[float], dict]:
+    try:
+        mtime = os.stat(POLICY_FILE).st_mtime
+    except FileNotFoundError:
+        return None, DEFAULT_POLICY
+    with open(POLICY_FILE) as f:
+        return mtime, json.load(f)
+
+
+_mtime, _config = _read()
+_policy = Policy(_config)
+_checked = time.monotonic()
+_error: Optional[str] = None
+
+
+def current() -> Policy:
+    """
+        The compiled policy, recompiled first if POLICY_FILE has changed since it was last looked at
+    """
+    global _policy, _mtime, _checked, _error
+    now = time.monotonic()
+    if now - _checked < RELOAD_INTERVAL:
+        return _policy
+    _checked = now
+    try:
+        mtime = os.stat(POLICY_FILE).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime == _mtime:
+        return _policy
+    try:
+        mtime, config = _read()
+        policy = Policy(config)
+    except Exception as e:
+        _stats["reload_errors"] += 1
+        _error = f"{type(e).__name__}: {e}"
+        print(f"Failed to reload policy from {POLICY_FILE}, keeping the previous one: {_error}")
+        _mtime = mtime
+        return _policy
+    _policy, _mtime, _error = policy, mtime, None
+    _stats["reloads"] += 1
+    return _policy
+
+
+def authorize(endpoint: str, state: TokenState):
+    """
+        Raise PolicyDenied if the token may not call this endpoint at all
+    """
+    try:
+        with metrics.span("policy"):
+            current().authorize(endpoint, state)
+    except PolicyDenied:
+        _stats["denied"] += 1
+        raise
+
+
+def check_body(endpoint: str, data: dict, state: TokenState):
+    """
+        Raise PolicyDenied if the token may not make this request, given its model and parameters
+    """
+    try:
+        with metrics.span("policy"):
+            current().check_body(endpoint, data, state)
+    except PolicyDenied:
+        _stats["denied"] += 1
+        raise
+    _stats["allowed"] += 1
+
+
+def stats() -> dict:
+    return dict(_stats, source=POLICY_FILE if _mtime is not None else "default", last_error=_error)
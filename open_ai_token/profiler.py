@@ -0,0 +1,64 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# On-demand sampling profiler for admins. While a profile runs, a background thread looks at the
+# event loop thread's stack every PROFILER_INTERVAL_MS and counts the stacks it sees, so the
+# loop is never paused or traced. Results are folded stacks, one "frame;frame;frame count" line
+# per stack, the input flamegraph.pl and speedscope take. Off unless PROFILER_ENABLED is set.
+ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+INTERVAL = float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000
+MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+_running = threading.Lock()
+_stats = {"profiles": 0, "samples": 0}
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample(thread_id: int, seconds: float, interval: float = INTERVAL) -> Dict[str, int]:
+    """
+        Sample a thread's stack for `seconds`, blocking the calling thread. Returns how often each
+        stack was seen, outermost frame first. Raises ProfilerBusy if a profile is already running.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        counts = Counter()
+        deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        _stats["profiles"] += 1
+        _stats["samples"] += sum(counts.values())
+        return counts
+    finally:
+        _running.release()
+
+
+def folded(counts: Dict[str, int]) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+
+def stats() -> dict:
+    return dict(_stats, enabled=ENABLED, running=_running.locked())
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import time
+from typing import Dict, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from open_ai_token import models
+from open_ai_token.database import AsyncSessionLocal
+
+load_dotenv()
+
+# Each worker takes uses from Token.uses_left in blocks and spends them locally, so a busy
+# token costs one database write per LEASE_SIZE requests. Unspent uses go back to the
+# database when the lease expires or the worker shuts down, unless uses_left was overwritten
+# in the meantime: every lease carries the token's uses_version, which each overwrite bumps.
+LEASE_SIZE = int(os.getenv("QUOTA_LEASE_SIZE", "20"))
+LEASE_TTL = float(os.getenv("QUOTA_LEASE_TTL", "60"))
+
+
+class Lease:
+    __slots__ = ("remaining", "version", "expires_at")
+
+    def __init__(self, remaining: int, version: int, expires_at: float):
+        self.remaining = remaining
+        self.version = version
+        self.expires_at = expires_at
+
+
+_leases: Dict[str, Lease] = {}
+# Tokens a lease is being taken for, each event set once it is stored or has failed
+_refilling: Dict[str, asyncio.Event] = {}
+_sweeper = None
+
+
+def lease_uses(db: Session, token: str, uses: int, minimum: int = 1) -> Tuple[int, int]:
+    """
+        Atomically take up to `uses`, and at least `minimum`, from a token.
+        Returns how many were taken and the token's uses_version.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return _lease_uses_sqlite(db, token, uses, minimum)
+    # One UPDATE. RETURNING sees the new row, so the amount comes from a locked read of the row
+    # joined in as `held`.
+    held = select(models.Token.token, models.Token.uses_left).where(models.Token.token == token).with_for_update().subquery("held")
+    amount = func.least(held.c.uses_left, uses)
+    taken = db.execute(
+        update(models.Token)
+        .where(models.Token.token == held.c.token, held.c.uses_left >= minimum)
+        .values(uses_left=models.Token.uses_left - amount)
+        .returning(amount, models.Token.uses_version)
+    ).first()
+    db.commit()
+    if taken is None:
+        return 0, 0
+    return taken[0], taken[1]
+
+
+def _lease_uses_sqlite(db: Session, token: str, uses: int, minimum: int) -> Tuple[int, int]:
+    # SQLite's RETURNING cannot see the tables joined in, so read the row and take from it only if
+    # nobody wrote it in between
+    while True:
+        row = db.execute(select(models.Token.uses_left, models.Token.uses_version).where(models.Token.token == token)).first()
+        if row is None or row.uses_left is None or row.uses_left < minimum:
+            # Still commits, for uses _exchange gave back in the same transaction
+            db.commit()
+            return 0, 0
+        amount = min(row.uses_left, uses)
+        taken = db.execute(
+            update(models.Token)
+            .where(models.Token.token == token, models.Token.uses_left == row.uses_left, models.Token.uses_version == row.uses_version)
+            .values(uses_left=models.Token.uses_left - amount)
+            .returning(models.Token.uses_version)
+        ).first()
+        db.commit()
+        if taken is not None:
+            return amount, taken[0]
+
+
+def _give_back(db: Session, token: str, uses: int, version: int):
+    db.execute(
+        update(models.Token)
+        .where(models.Token.token == token, models.Token.uses_version == version)
+        .values(uses_left=models.Token.uses_left + uses)
+    )
+
+
+def return_uses(db: Session, token: str, uses: int, version: int):
+    """
+        Give unspent leased uses back to a token, unless its uses_left was overwritten since they were leased
+    """
+    _give_back(db, token, uses, version)
+    db.commit()
+
+
+def _exchange(db: Session, token: str, returned: int, version: int, uses: int, minimum: int) -> Tuple[int, int]:
+    # The uses given back are committed with the new lease, so a failure in between loses neither
+    if returned:
+        _give_back(db, token, returned, version)
+    return lease_uses(db, token, uses, minimum)
+
+
+def _return_all(db: Session, returns: Dict[str, Tuple[int, int]]):
+    for token, (uses, version) in returns.items():
+        return_uses(db, token, uses, version)
+
+
+async def _lease(token: str, returned: int, version: int, uses: int, minimum: int) -> Tuple[int, int]:
+    async with AsyncSessionLocal() as db:
+        return await db.run_sync(_exchange, token, returned, version, uses, minimum)
+
+
+async def _return(returns: Dict[str, Tuple[int, int]]):
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(_return_all, returns)
+
+
+def remaining(token: str) -> int:
+    """
+        Uses this worker still holds for a token
+    """
+    lease = _leases.get(token)
+    if lease is None or lease.expires_at <= time.monotonic():
+        return 0
+    return lease.remaining
+
+
+def _spend(token: str, uses: int) -> bool:
+    lease = _leases.get(token)
+    if lease is not None and lease.expires_at > time.monotonic() and lease.remaining >= uses:
+        lease.remaining -= uses
+        return True
+    return False
+
+
+async def consume(token: str, uses: int = 1):
+    """
+        Spend uses of a token, leasing another block from the database when the local lease runs dry
+    """
+    if _spend(token, uses):
+        return
+    # One request per token leases at a time, the others wait and spend from its block
+    while token in _refilling:
+        await _refilling[token].wait()
+        if _spend(token, uses):
+            return
+    refilled = _refilling[token] = asyncio.Event()
+    try:
+        await _refill(token, uses)
+    finally:
+        del _refilling[token]
+        refilled.set()
+
+
+async def _refill(token: str, uses: int):
+    # Carry over what is left of a live lease; an expired one goes back to the database
+    stale = _leases.pop(token, None)
+    carried, returned, version = 0, 0, 0
+    if stale is not None:
+        version = stale.version
+        if stale.expires_at > time.monotonic():
+            carried = stale.remaining
+        else:
+            returned = stale.remaining
+
+    needed = uses - carried
+    try:
+        granted, version = await _lease(token, returned, version, max(LEASE_SIZE, needed), needed)
+    except Exception:
+        # Nothing was exchanged, keep the lease so its uses are spent or given back later
+        if stale is not None:
+            _leases.setdefault(token, stale)
+        raise
+    if granted == 0:
+        if carried:
+            _leases[token] = stale
+        raise ValueError("Token has no uses left")
+    # This request spends whatever was carried over, so what is left all comes from the new block
+    _leases[token] = Lease(carried + granted - uses, version, time.monotonic() + LEASE_TTL)
+
+
+def discard(token: str):
+    """
+        Forget a token's lease without returning it, e.g. after its uses_left was overwritten
+    """
+    _leases.pop(token, None)
+
+
+async def release_expired():
+    now = time.monotonic()
+    expired = {token: lease for token, lease in _leases.items() if lease.expires_at <= now}
+    for token in expired:
+        del _leases[token]
+    returns = {token: (lease.remaining, lease.version) for token, lease in expired.items() if lease.remaining}
+    if returns:
+        await _return(returns)
+
+
+async def release_all():
+    returns = {token: (lease.remaining, lease.version) for token, lease in _leases.items() if lease.remaining}
+    _leases.clear()
+    if returns:
+        await _return(returns)
+
+
+async def _sweep():
+    while True:
+        await asyncio.sleep(LEASE_TTL / 2)
+        try:
+            await release_expired()
+        except Exception as e:
+            print(f"Failed to release expired quota leases: {e}")
+
+
+async def startup():
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep())
+
+
+async def shutdown():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        _sweeper = None
+    await release_all()
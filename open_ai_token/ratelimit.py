@@ -0,0 +1,266 @@
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from open_ai_token.schemas import TokenState
+
+load_dotenv()
+
+# Token buckets for requests per minute and estimated tokens per minute, kept both per token
+# and per user so one user cannot get around the limit by spreading load over several tokens.
+# Each bucket holds a minute's worth and refills continuously.
+ENABLED = os.getenv("RATE_LIMIT", "true").lower() not in ("0", "false", "no")
+TIERS = {
+    "default": {"requests": 60, "tokens": 100000},
+    "club_leader": {"requests": 180, "tokens": 300000},
+    "superpowers": {"requests": 600, "tokens": 1000000},
+}
+for _tier, _limits in json.loads(os.getenv("RATE_LIMIT_TIERS", "{}")).items():
+    TIERS.setdefault(_tier, {}).update(_limits)
+# A user's buckets are this many times larger than those of any one of their tokens
+USER_MULTIPLIER = float(os.getenv("RATE_LIMIT_USER_MULTIPLIER", "2"))
+# Buckets untouched for this long are full again (or close enough) and are forgotten
+IDLE_TTL = float(os.getenv("RATE_LIMIT_IDLE_TTL", "120"))
+MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+# Optional shared backend so limits hold across workers, e.g. redis://localhost:6379/0
+REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+
+# (bucket key, capacity, refill per second, cost)
+Limit = Tuple[str, float, float, float]
+
+_stats = {"allowed": 0, "limited": 0, "backend_errors": 0}
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Rate limit exceeded")
+        self.retry_after = retry_after
+
+
+class Bucket:
+    __slots__ = ("level", "updated")
+
+    def __init__(self, level: float, updated: float):
+        self.level = level
+        self.updated = updated
+
+
+class LocalBackend:
+    """
+        In-process buckets, least recently used first so idle ones can be dropped from the front
+    """
+
+    name = "local"
+
+    def __init__(self):
+        self._buckets: "OrderedDict[str, Bucket]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if len(buckets) <= MAX_BUCKETS and now - bucket.updated < IDLE_TTL:
+                break
+            del buckets[key]
+
+    async def acquire(self, limits: List[Limit], force: bool = False) -> float:
+        now = time.monotonic()
+        self._evict(now)
+        buckets = []
+        wait = 0.0
+        for key, capacity, rate, cost in limits:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = Bucket(capacity, now)
+            else:
+                self._buckets.move_to_end(key)
+                bucket.level = min(capacity, bucket.level + (now - bucket.updated) * rate)
+                bucket.updated = now
+            if bucket.level < cost:
+                wait = max(wait, (cost - bucket.level) / rate)
+            buckets.append(bucket)
+        if wait and not force:
+            return wait
+        for bucket, (_, _, _, cost) in zip(buckets, limits):
+            bucket.level -= cost
+        return 0.0
+
+    async def close(self):
+        self._buckets.clear()
+
+
+# All buckets of a request are checked and charged in one round trip. Levels may go below zero
+# when actual usage is settled after the fact; that debt is paid off before the next request.
+_REDIS_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local force = ARGV[1] == '1'
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    local state = redis.call('HMGET', key, 'level', 'updated')
+    local level = capacity
+    if state[1] then
+        level = math.min(capacity, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+    end
+    if level < cost then
+        wait = math.max(wait, (cost - level) / rate)
+    end
+    levels[i] = level
+end
+if wait > 0 and not force then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local level = levels[i] - tonumber(ARGV[i * 3 + 1])
+    redis.call('HSET', key, 'level', level, 'updated', now)
+    redis.call('PEXPIRE', key, math.ceil((capacity - level) / rate * 1000) + 1000)
+end
+return '0'
+"""
+
+
+class RedisBackend:
+    """
+        Buckets shared by every worker through Redis; keys expire once they would be full again
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url)
+        self._script = self._redis.register_script(_REDIS_SCRIPT)
+
+    def __len__(self):
+        return 0
+
+    async def acquire(self, limits: List[Limit], force: bool = False) -> float:
+        args = ["1" if force else "0"]
+        for _, capacity, rate, cost in limits:
+            args += [capacity, rate, cost]
+        wait = await self._script(keys=[f"ratelimit:{key}" for key, _, _, _ in limits], args=args)
+        return float(wait)
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+_local = LocalBackend()
+_backend = _local
+
+
+def tier(state: TokenState) -> str:
+    if state.can_use_superpowers:
+        return "superpowers"
+    if state.is_club_leader:
+        return "club_leader"
+    return "default"
+
+
+def _limits(state: TokenState, requests: float, tokens: float) -> List[Limit]:
+    limits = TIERS[tier(state)]
+    owners = [(f"t:{state.token}", 1.0)]
+    if state.user_id is not None:
+        owners.append((f"u:{state.user_id}", USER_MULTIPLIER))
+    result = []
+    for owner, scale in owners:
+        for kind, cost in (("requests", requests), ("tokens", tokens)):
+            capacity = limits[kind] * scale
+            if capacity > 0:
+                # Never ask for more than a full bucket, or a large request could never pass
+                result.append((f"{owner}:{kind}", capacity, capacity / 60, min(cost, capacity)))
+    return result
+
+
+async def _acquire(limits: List[Limit], force: bool = False) -> float:
+    try:
+        return await _backend.acquire(limits, force)
+    except Exception:
+        # Keep limiting on our own rather than failing requests while the shared backend is down
+        _stats["backend_errors"] += 1
+        return await _local.acquire(limits, force)
+
+
+class Charge:
+    """
+        Tokens taken for a request on an estimate, settled against its real usage once known
+    """
+
+    __slots__ = ("state", "estimate")
+
+    def __init__(self, state: TokenState, estimate: int):
+        self.state = state
+        self.estimate = estimate
+
+    async def settle(self, total_tokens: Optional[int]):
+        if total_tokens is None or total_tokens == self.estimate:
+            return
+        extra = total_tokens - self.estimate
+        self.estimate = total_tokens
+        limits = [(key, capacity, rate, extra) for key, capacity, rate, _ in _limits(self.state, 0, 0) if key.endswith(":tokens")]
+        await _acquire(limits, force=True)
+
+
+def estimate_tokens(content_length: Optional[str]) -> int:
+    """
+        Rough prompt size from the request body length, about four bytes per token
+    """
+    try:
+        return int(content_length or 0) // 4
+    except ValueError:
+        return 0
+
+
+async def check(state: TokenState, tokens: int = 0) -> Optional[Charge]:
+    """
+        Take one request and `tokens` estimated tokens from the caller's buckets.
+        Raises RateLimited with the number of seconds to wait if any bucket is short.
+    """
+    if not ENABLED:
+        return None
+    wait = await _acquire(_limits(state, 1, tokens))
+    if wait > 0:
+        _stats["limited"] += 1
+        raise RateLimited(wait)
+    _stats["allowed"] += 1
+    return Charge(state, min(tokens, TIERS[tier(state)]["tokens"]))
+
+
+def retry_after(wait: float) -> str:
+    return str(max(1, math.ceil(wait)))
+
+
+async def startup():
+    """
+        Connect to the shared backend if one is configured
+    """
+    global _backend
+    if ENABLED and REDIS_URL and _backend is _local:
+        _backend = RedisBackend(REDIS_URL)
+
+
+async def shutdown():
+    global _backend
+    if _backend is not _local:
+        await _backend.close()
+        _backend = _local
+    await _local.close()
+
+
+def stats() -> dict:
+    return dict(_stats, enabled=ENABLED, backend=_backend.name, local_buckets=len(_local))
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from open_ai_token.keys import parse_duration
+
+load_dotenv()
+
+# Upstream calls are retried with jittered exponential backoff, or after Retry-After when upstream
+# gives one, but only while nothing has been relayed yet and only where repeating the request is
+# harmless. Short non-streamed calls can be hedged: a second copy is sent if the first is slow and
+# whichever answers first wins. A breaker per endpoint fails fast while upstream keeps failing.
+RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.25"))
+# Longer waits, including a longer Retry-After, are not worth holding the client for
+RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+# Send a second copy of a non-streamed call after this many ms without an answer, 0 to disable
+HEDGE_AFTER = float(os.getenv("UPSTREAM_HEDGE_AFTER_MS", "0")) / 1000
+BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "30"))
+
+# Failures where the request never reached upstream, safe to repeat for any request that may be retried
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_stats = {"retries": 0, "retries_exhausted": 0, "hedges": 0, "hedges_won": 0}
+
+
+class CircuitOpen(Exception):
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"Upstream {endpoint} is failing, try again shortly")
+        self.retry_after = retry_after
+
+
+class Breaker:
+    """
+        Opens after BREAKER_FAILURES failures in a row. After BREAKER_COOLDOWN one probe is let
+        through: success closes it again, failure keeps it open for another cooldown.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def before(self) -> bool:
+        """
+            Raises CircuitOpen while open. Returns True if the call let through is the probe.
+        """
+        if self.opened_at is None:
+            return False
+        waited = time.monotonic() - self.opened_at
+        if waited < BREAKER_COOLDOWN or self.probing:
+            self.stats["rejected"] += 1
+            raise CircuitOpen(self.name, max(BREAKER_COOLDOWN - waited, 1.0))
+        self.probing = True
+        return True
+
+    def abandon(self):
+        """
+            The probe ended without hearing from upstream, e.g. it was cancelled: let the next call probe
+        """
+        self.probing = False
+
+    def success(self):
+        self.stats["successes"] += 1
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.stats["failures"] += 1
+        self.failures += 1
+        if self.probing or self.failures >= BREAKER_FAILURES:
+            if self.opened_at is None or self.probing:
+                self.stats["opened"] += 1
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def snapshot(self) -> dict:
+        if self.opened_at is None:
+            state = "closed"
+        elif self.probing:
+            state = "half_open"
+        else:
+            state = "open"
+        return dict(self.stats, state=state, consecutive_failures=self.failures)
+
+
+_breakers: Dict[str, Breaker] = {}
+
+
+def breaker(endpoint: str) -> Breaker:
+    found = _breakers.get(endpoint)
+    if found is None:
+        found = _breakers[endpoint] = Breaker(endpoint)
+    return found
+
+
+def endpoint_of(path: str) -> str:
+    """
+        The endpoint a path belongs to for the breaker, e.g. /fine_tuning/jobs/ftjob-1/events -> fine_tuning
+    """
+    return path.strip("/").split("/", 1)[0]
+
+
+def _is_failure(resp: httpx.Response) -> bool:
+    # A 429 means our keys are over their limits, not that upstream is unwell
+    return resp.status_code >= 500
+
+
+def retry_delay(attempt: int, resp: Optional[httpx.Response] = None) -> Optional[float]:
+    """
+        How long to wait before the next attempt, or None if upstream asked for longer than we wait
+    """
+    if resp is not None:
+        retry_after = resp.headers.get("retry-after-ms")
+        wait = float(retry_after) / 1000 if retry_after else parse_duration(resp.headers.get("retry-after"))
+        if wait is not None:
+            return wait if wait <= RETRY_MAX_DELAY else None
+    # Full jitter, so clients that failed together do not retry together
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def _hedged(send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+    first = asyncio.ensure_future(send())
+    done, _ = await asyncio.wait((first,), timeout=HEDGE_AFTER)
+    if done:
+        return first.result()
+    _stats["hedges"] += 1
+    tasks = (first, asyncio.ensure_future(send()))
+    winner = None
+    try:
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in tasks if task in done and task.exception() is None), None)
+        if winner is None:
+            # Both failed
+            raise first.exception()
+        if winner is tasks[1]:
+            _stats["hedges_won"] += 1
+        return winner.result()
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            task.cancel()
+            try:
+                resp = await task
+            except (asyncio.CancelledError, Exception):
+                continue
+            await resp.aclose()
+
+
+async def call(path: str, send: Callable[[], Awaitable[httpx.Response]], retry: str = "safe", hedge: bool = False) -> httpx.Response:
+    """
+        Run `send` through the endpoint's breaker with retries. `send` must return before the body
+        is read by anyone, so a retried response has relayed nothing.
+
+        retry is "all" for reads, where any failure may be retried, "safe" for calls that may be
+        repeated if upstream refused them or never got them, and "never" for calls that create things.
+    """
+    gate = breaker(endpoint_of(path))
+    probe = gate.before()
+    attempts = 1 + (RETRIES if retry != "never" else 0)
+    try:
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                resp = await (_hedged(send) if hedge and HEDGE_AFTER > 0 else send())
+            except httpx.TransportError as e:
+                gate.failure()
+                probe = False
+                retryable = retry == "all" or (retry == "safe" and isinstance(e, _NOT_SENT))
+                # Once the breaker opens the failure in hand is passed on rather than retried
+                delay = retry_delay(attempt) if retryable and not last and not gate.open else None
+                if delay is None:
+                    if retryable:
+                        _stats["retries_exhausted"] += 1
+                    raise
+                _stats["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+
+            if _is_failure(resp):
+                gate.failure()
+            else:
+                gate.success()
+            probe = False
+            if resp.status_code not in RETRY_STATUSES or retry == "never":
+                return resp
+            delay = retry_delay(attempt, resp) if not last and not gate.open else None
+            if delay is None:
+                _stats["retries_exhausted"] += 1
+                return resp
+            _stats["retries"] += 1
+            await resp.aclose()
+            await asyncio.sleep(delay)
+        return resp
+    except BaseException as e:
+        # A probe that ends any other way must still settle the breaker, or it stays half open for good
+        if probe:
+            if isinstance(e, asyncio.CancelledError):
+                gate.abandon()
+            else:
+                gate.failure()
+        raise
+
+def stats() -> dict:
+    return dict(_stats, breakers={name: gate.snapshot() for name, gate in _breakers.items()})
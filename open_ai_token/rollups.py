@@ -0,0 +1,128 @@
+import argparse
+import datetime
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, select, text
+
+from open_ai_token import crud, models
+from open_ai_token.database import SessionLocal
+
+load_dotenv()
+
+# Usage totals per token and model, per hour and per day, in usage_rollups. The usage writer
+# adds each batch to them in the same transaction as the rows themselves, so summaries never
+# have to scan usages. Summaries use whole days where they can and hours at the edges.
+PERIODS = ("hour", "day")
+BACKFILL_CHUNK_SIZE = int(os.getenv("USAGE_ROLLUP_BACKFILL_CHUNK_SIZE", "10000"))
+GROUPS = {"user": "user_id", "token": "token_id", "model": "model"}
+
+_COUNTERS = ("requests", "errors", "prompt_tokens", "completion_tokens", "total_tokens")
+
+
+def _utc(moment: datetime.datetime) -> datetime.datetime:
+    """
+        Naive UTC. Naive times are taken as local time, which is what the usage logger records.
+    """
+    return moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def bucket(moment: datetime.datetime, period: str) -> datetime.datetime:
+    moment = _utc(moment).replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if period == "day" else moment
+
+
+def collect(records: Iterable[dict], users: Optional[Dict[str, str]] = None) -> List[dict]:
+    """
+        Add up usage records into rollup increments. Takes the `user_id` key out of each record;
+        `users` maps token to owner for records that have none.
+    """
+    totals: Dict[Tuple, dict] = {}
+    for record in records:
+        user_id = record.pop("user_id", None) or (users or {}).get(record.get("token_id")) or ""
+        created_at = record.get("created_at") or datetime.datetime.now()
+        for period in PERIODS:
+            key = (period, bucket(created_at, period), record.get("token_id") or "", record.get("model") or "")
+            row = totals.get(key)
+            if row is None:
+                row = totals[key] = dict(zip(("period", "bucket", "token_id", "model"), key), user_id=user_id, **dict.fromkeys(_COUNTERS, 0))
+            row["requests"] += 1
+            row["errors"] += (record.get("status_code") or 0) >= 400
+            for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+                row[field] += record.get(field) or 0
+    return list(totals.values())
+
+
+def ranges(start: datetime.datetime, end: datetime.datetime) -> List[Tuple[str, datetime.datetime, datetime.datetime]]:
+    """
+        Cover [start, end) with whole days and the hours left over at either end, as (period, from, to)
+    """
+    start = bucket(start, "hour")
+    end = _utc(end)
+    if end > bucket(end, "hour"):
+        end = bucket(end, "hour") + datetime.timedelta(hours=1)
+    first_day = bucket(start, "day")
+    if first_day < start:
+        first_day += datetime.timedelta(days=1)
+    last_day = bucket(end, "day")
+    if first_day >= last_day:
+        return [("hour", start, end)] if start < end else []
+    covered = [("day", first_day, last_day)]
+    if start < first_day:
+        covered.append(("hour", start, first_day))
+    if last_day < end:
+        covered.append(("hour", last_day, end))
+    return covered
+
+
+def backfill(chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    """
+        Rebuild the rollups from usages, reading at most chunk_size rows at a time.
+        Rows written while it runs are added by the usage writer as usual.
+    """
+    with SessionLocal() as db:
+        # Clearing the rollups and finding the last row to rebuild have to see the same usages, or
+        # a batch committed in between is counted by both the writer and the rebuild. Postgres waits
+        # for batches being written and holds new ones off until the commit; on SQLite the DELETE
+        # already holds the write lock.
+        if db.get_bind().dialect.name == "postgresql":
+            db.execute(text(f"LOCK TABLE {models.Usage.__tablename__} IN SHARE MODE"))
+        db.execute(delete(models.UsageRollup))
+        # Everything up to here is rebuilt, anything newer is the usage writer's
+        last = db.scalar(select(func.max(models.Usage.id)))
+        db.commit()
+    if last is None:
+        return 0
+
+    columns = (
+        models.Usage.id, models.Usage.created_at, models.Usage.token_id, models.Usage.model, models.Usage.status_code,
+        models.Usage.prompt_tokens, models.Usage.completion_tokens, models.Usage.total_tokens, models.Token.user_id
+    )
+    done = 0
+    after = 0
+    while after < last:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(*columns)
+                .outerjoin(models.Token, models.Token.token == models.Usage.token_id)
+                .where(models.Usage.id > after, models.Usage.id <= last)
+                .order_by(models.Usage.id)
+                .limit(chunk_size)
+            ).mappings().all()
+            if not rows:
+                break
+            crud.add_rollups(db, collect(dict(row) for row in rows))
+            db.commit()
+        after = rows[-1]["id"]
+        done += len(rows)
+        print(f"Rolled up {done} usage rows")
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the usage rollups")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    args = parser.parse_args()
+    backfill(args.chunk_size)
@@ -0,0 +1,186 @@
+import asyncio
+import fnmatch
+import heapq
+import itertools
+import json
+import os
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from open_ai_token import metrics
+from open_ai_token.schemas import TokenState
+
+load_dotenv()
+
+# Upstream calls in flight are bounded per model family. Callers past the limit wait in a queue
+# ordered by priority class (admins, then club leaders, then everyone else) and, within a class,
+# by weighted fair queuing across users so one busy user cannot take every slot.
+# Families are matched in order, the first pattern that matches a model wins.
+LIMITS = json.loads(os.getenv(
+    "SCHEDULER_LIMITS",
+    '{"gpt-4*": 32, "o1*": 16, "dall-e*": 8, "text-embedding*": 64, "*": 128}'
+))
+QUEUE_SIZE = int(os.getenv("SCHEDULER_QUEUE_SIZE", "256"))
+QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "30"))
+
+ADMIN, CLUB_LEADER, DEFAULT = range(3)
+PRIORITIES = ("admin", "club_leader", "default")
+
+_sequence = itertools.count()
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Slot:
+    """
+        Permission to have one upstream call in flight, given back with release()
+    """
+
+    __slots__ = ("family", "released")
+
+    def __init__(self, family: "Family"):
+        self.family = family
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.family.release()
+
+
+class Family:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.queued = 0
+        # One heap per priority class of (finish tag, sequence, start tag, future)
+        self.queues: List[list] = [[] for _ in PRIORITIES]
+        self.virtual_time = 0.0
+        self.finish_tags: Dict[str, float] = {}
+        self.stats = {"admitted": 0, "waited": 0, "shed_full": 0, "shed_timeout": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        self.in_use = metrics.UPSTREAM_SLOTS_IN_USE.labels(name)
+
+    async def acquire(self, priority: int, owner: str) -> Slot:
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            self.stats["admitted"] += 1
+            self.in_use.set(self.active)
+            return Slot(self)
+        if self.queued >= QUEUE_SIZE:
+            self.stats["shed_full"] += 1
+            raise Overloaded(f"Too many requests queued for {self.name} models, try again shortly")
+
+        # Each user's requests are spaced one virtual unit apart, so users take turns
+        start = max(self.virtual_time, self.finish_tags.get(owner, 0.0))
+        self.finish_tags[owner] = start + 1
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues[priority]
+        heapq.heappush(queue, (start + 1, next(_sequence), start, future))
+        self.queued += 1
+        if len(queue) > 2 * QUEUE_SIZE:
+            self._compact(queue)
+
+        enqueued = time.monotonic()
+        try:
+            await asyncio.wait_for(future, QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.queued -= 1
+            self.stats["shed_timeout"] += 1
+            raise Overloaded(f"Timed out waiting for a free {self.name} slot, try again shortly")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller went away
+                self.release()
+            else:
+                self.queued -= 1
+            raise
+        waited = time.monotonic() - enqueued
+        self.stats["waited"] += 1
+        self.stats["wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+        return Slot(self)
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.limit and self.queued:
+            future = self._pop()
+            if future is None:
+                break
+            self.queued -= 1
+            self.active += 1
+            self.stats["admitted"] += 1
+            future.set_result(None)
+        self.in_use.set(self.active)
+        if not self.queued:
+            # Nobody is waiting, so nobody is owed a turn
+            self.finish_tags.clear()
+
+    def _pop(self) -> Optional[asyncio.Future]:
+        for queue in self.queues:
+            while queue:
+                _, _, start, future = heapq.heappop(queue)
+                if future.done():
+                    # Timed out or cancelled while queued
+                    continue
+                self.virtual_time = start
+                return future
+        return None
+
+    @staticmethod
+    def _compact(queue: list):
+        queue[:] = [entry for entry in queue if not entry[3].done()]
+        heapq.heapify(queue)
+
+    def snapshot(self) -> dict:
+        waited = self.stats["waited"]
+        return dict(
+            self.stats,
+            limit=self.limit,
+            active=self.active,
+            queued=self.queued,
+            queued_by_priority={name: sum(not entry[3].done() for entry in queue) for name, queue in zip(PRIORITIES, self.queues)},
+            avg_wait_seconds=self.stats["wait_seconds"] / waited if waited else 0.0
+        )
+
+
+_families: Dict[str, Family] = {pattern: Family(pattern, limit) for pattern, limit in LIMITS.items()}
+
+
+@lru_cache(maxsize=1024)
+def family_name(model: Optional[str]) -> str:
+    for pattern in LIMITS:
+        if fnmatch.fnmatchcase(model or "", pattern):
+            return pattern
+    return "*"
+
+
+def priority(state: TokenState) -> int:
+    if state.is_admin:
+        return ADMIN
+    if state.is_club_leader:
+        return CLUB_LEADER
+    return DEFAULT
+
+
+async def acquire(state: TokenState, model: Optional[str] = None) -> Slot:
+    """
+        Wait for a free upstream slot for `model`'s family.
+        Raises Overloaded if the queue is full or the wait runs past QUEUE_TIMEOUT.
+    """
+    name = family_name(model)
+    family = _families.get(name)
+    if family is None:
+        family = _families[name] = Family(name, LIMITS.get(name, 128))
+    return await family.acquire(priority(state), state.user_id or state.token)
+
+
+def stats() -> dict:
+    return {name: family.snapshot() for name, family in _families.items()}
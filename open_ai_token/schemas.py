@@ -44,12 +44,35 @@ class Token(TokenBase):
     class Config:
         from_attributes = True
 
+class TokenState(BaseModel):
+    """
+    Snapshot of a token and its owner's flags, as used to authorize requests
+    """
+    token: str
+    user_id: Union[str, None] = None
+    is_active: bool = True
+    is_revoked: bool = False
+    is_expired: bool = False
+    is_blocked: bool = False
+    uses_left: int = 0
+    is_admin: bool = False
+    is_club_leader: bool = False
+    can_use_superpowers: bool = False
+    image_usage_allowed: bool = True
+    gpt4_usage_allowed: bool = False
+    is_banned: bool = False
+
 class UsageBase(BaseModel):
     token: str
     created_at: datetime.datetime
     request_data: str
     response_data: str
     endpoint: str
+    model: Union[str, None] = None
+    prompt_tokens: Union[int, None] = None
+    completion_tokens: Union[int, None] = None
+    total_tokens: Union[int, None] = None
+    finish_reason: Union[str, None] = None
 
 class UsageCreate(UsageBase):
     pass
@@ -59,6 +82,42 @@ class Usage(UsageBase):
     class Config:
         from_attributes = True
 
+class TokenFilter(BaseModel):
+    user_id: Union[str, None] = None
+    is_blocked: Union[bool, None] = None
+    min_uses_left: Union[int, None] = None
+    max_uses_left: Union[int, None] = None
+
+class TokensBulkCreate(BaseModel):
+    """
+    One new token per listed user_id, a user listed twice gets two
+    """
+    user_ids: list[str]
+    uses_left: Union[int, None] = None
+
+class TokensBulkUpdate(BaseModel):
+    """
+    Changes applied to the listed tokens, or to every token matching the filter
+    """
+    tokens: Union[list[str], None] = None
+    filter: Union[TokenFilter, None] = None
+    uses_left: Union[int, None] = None
+    is_blocked: Union[bool, None] = None
+    is_revoked: Union[bool, None] = None
+
+class UsageSummary(BaseModel):
+    """
+    Usage totals of one group over a time range, from the rollups
+    """
+    user_id: Union[str, None] = None
+    token_id: Union[str, None] = None
+    model: Union[str, None] = None
+    requests: int
+    errors: int
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
 class TokenUse(BaseModel):
     token: str
     user_id: str
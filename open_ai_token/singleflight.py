@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import os
+from collections import deque
+from typing import Awaitable, Callable, Dict, Tuple, Union
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+import open_ai_token.openai as openai_module
+
+load_dotenv()
+
+# Identical deterministic requests that arrive while one is already in flight attach to it
+# instead of going upstream again. Streams are fanned out chunk by chunk to every subscriber.
+ENABLED = os.getenv("SINGLE_FLIGHT", "true").lower() not in ("0", "false", "no")
+# Chunks a subscriber may fall behind before it is cut off so it cannot stall the others
+SUBSCRIBER_BUFFER = int(os.getenv("SINGLE_FLIGHT_BUFFER_CHUNKS", "256"))
+# Late subscribers are replayed what was already sent, while that stays under this size
+REPLAY_LIMIT = int(os.getenv("SINGLE_FLIGHT_REPLAY_BYTES", str(1024 * 1024)))
+
+_stats = {"leaders": 0, "followers": 0, "dropped_subscribers": 0}
+
+
+def request_key(route: str, body=None) -> bytes:
+    """
+        Canonical hash of a request, independent of JSON key order.
+        Raw body bytes are hashed as they are, which is cheaper but does depend on key order.
+    """
+    if not isinstance(body, bytes):
+        body = orjson.dumps(body, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(route.encode() + b"\0" + body).digest()
+
+
+def chat_eligible(data: dict) -> bool:
+    """
+        Only requests that would get the same answer anyway are shared
+    """
+    return ENABLED and data.get("temperature") == 0 and data.get("n", 1) in (1, None)
+
+
+class Subscription:
+    """
+        One caller's view of a shared upstream response
+    """
+
+    def __init__(self, flight: "Flight"):
+        self.flight = flight
+        self.status_code = flight.status_code
+        self.headers = flight.headers
+        self.dropped = False
+        self._chunks: deque = deque(flight.replay)
+        self._limit = SUBSCRIBER_BUFFER + len(self._chunks)
+        self._finished = False
+        self._ready = asyncio.Event()
+
+    def _push(self, chunk: bytes) -> bool:
+        if len(self._chunks) >= self._limit:
+            self.dropped = True
+            self._ready.set()
+            return False
+        self._chunks.append(chunk)
+        self._ready.set()
+        return True
+
+    def _finish(self):
+        self._finished = True
+        self._ready.set()
+
+    async def aclose(self):
+        self.flight.unsubscribe(self)
+
+    async def __aiter__(self):
+        try:
+            while True:
+                while self._chunks:
+                    yield self._chunks.popleft()
+                if self._finished or self.dropped:
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+        finally:
+            self.flight.unsubscribe(self)
+
+
+class Flight:
+    def __init__(self, key: bytes, resp: httpx.Response):
+        self.key = key
+        self.resp = resp
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self.subscribers = set()
+        self.replay = []
+        self.replay_size = 0
+        self.joinable = True
+        self.done = False
+        self.task = asyncio.ensure_future(self._pump())
+
+    def subscribe(self) -> Subscription:
+        sub = Subscription(self)
+        if self.done:
+            sub._finish()
+        else:
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        self.subscribers.discard(sub)
+        if not self.subscribers and not self.done:
+            # Nobody is listening any more, stop reading from upstream
+            self.joinable = False
+            self.task.cancel()
+
+    async def _pump(self):
+        complete = False
+        try:
+            async for chunk in openai_module.iter_response(self.resp):
+                if self.joinable:
+                    self.replay.append(chunk)
+                    self.replay_size += len(chunk)
+                    if self.replay_size > REPLAY_LIMIT:
+                        self.joinable = False
+                        self.replay = []
+                for sub in list(self.subscribers):
+                    if not sub._push(chunk):
+                        self.subscribers.discard(sub)
+                        _stats["dropped_subscribers"] += 1
+            complete = True
+        finally:
+            # Callers already waiting on this flight can still be replayed a complete response
+            self.done = True
+            if not complete:
+                self.joinable = False
+                self.replay = []
+            if _in_flight.get(self.key) is self:
+                del _in_flight[self.key]
+            for sub in self.subscribers:
+                sub._finish()
+
+
+_in_flight: Dict[bytes, Union[Flight, "asyncio.Task"]] = {}
+
+
+async def _open(key: bytes, start: Callable[[], Awaitable[httpx.Response]]) -> Tuple[Flight, Subscription]:
+    try:
+        flight = Flight(key, await start())
+    except BaseException:
+        _in_flight.pop(key, None)
+        raise
+    # The leader subscribes before the pump runs so it cannot miss the start of a short response
+    leader = flight.subscribe()
+    _in_flight[key] = flight
+    return flight, leader
+
+
+async def stream(key: bytes, start: Callable[[], Awaitable[httpx.Response]]) -> Subscription:
+    """
+        Subscribe to the in-flight upstream response for `key`, starting it with `start()` if there is none
+    """
+    while True:
+        entry = _in_flight.get(key)
+        if entry is None:
+            _stats["leaders"] += 1
+            task = _in_flight[key] = asyncio.ensure_future(_open(key, start))
+            # Shielded so a leader that disconnects does not take its followers down with it
+            _, leader = await asyncio.shield(task)
+            return leader
+        if isinstance(entry, asyncio.Future):
+            flight, _ = await asyncio.shield(entry)
+        else:
+            flight = entry
+        if flight.joinable:
+            _stats["followers"] += 1
+            return flight.subscribe()
+        if _in_flight.get(key) is flight:
+            del _in_flight[key]
+
+
+async def call(key: bytes, start: Callable[[], Awaitable]):
+    """
+        Share the result of a non-streaming upstream call among identical concurrent callers
+    """
+    if not ENABLED:
+        return await start()
+    task = _in_flight.get(key)
+    if task is None:
+        _stats["leaders"] += 1
+        task = _in_flight[key] = asyncio.ensure_future(start())
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        _stats["followers"] += 1
+    return await asyncio.shield(task)
+
+
+def stats() -> dict:
+    return dict(_stats, enabled=ENABLED, in_flight=len(_in_flight))
@@ -0,0 +1,133 @@
+import json
+import re
+from typing import Optional
+
+# Only events that can carry something we record are decoded; the token deltas in between are skipped
+_EVENT_END = re.compile(rb"\r?\n\r?\n")
+_INTERESTING = re.compile(rb'"usage"\s*:\s*\{|"finish_reason"\s*:\s*"')
+
+MAX_EVENT_SIZE = 1024 * 1024
+MAX_JSON_SIZE = 4 * 1024 * 1024
+
+
+class UsageParser:
+    """
+        Incrementally scan a chat completion response for its model, finish reason and token usage.
+
+        Chunks are fed in as they are relayed to the client. Streams are parsed event by event,
+        keeping only the unfinished tail of the current event; plain JSON responses are buffered up
+        to MAX_JSON_SIZE and decoded at the end.
+
+        feed() and close() return what to relay. That is the chunk itself, unless strip_usage is
+        set for a stream whose usage event the gateway asked for and the client did not: then
+        whole events are relayed, without the usage-only event.
+    """
+
+    def __init__(self, streaming: bool = True, strip_usage: bool = False):
+        self.streaming = streaming
+        self.strip_usage = strip_usage and streaming
+        self.model: Optional[str] = None
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[dict] = None
+        self.events = 0
+        self._buffer = bytearray()
+        self._overflow = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self._overflow:
+            return chunk
+        if not self.streaming:
+            self._buffer += chunk
+            if len(self._buffer) > MAX_JSON_SIZE:
+                self._overflow = True
+                self._buffer = bytearray()
+            return chunk
+
+        if self._buffer:
+            self._buffer += chunk
+            data = bytes(self._buffer)
+        else:
+            data = chunk
+
+        relay = bytearray() if self.strip_usage else None
+        start = 0
+        for end in _EVENT_END.finditer(data):
+            usage_only = self._event(data, start, end.start())
+            if relay is not None and not usage_only:
+                relay += data[start:end.end()]
+            start = end.end()
+
+        tail = len(data) - start
+        if tail > MAX_EVENT_SIZE:
+            # A single event this large is not something we can record, skip to the next one
+            if relay is not None:
+                relay += data[start:]
+            self._buffer = bytearray()
+        elif tail:
+            self._buffer = bytearray(data[start:])
+        else:
+            self._buffer = bytearray()
+        return chunk if relay is None else bytes(relay)
+
+    def close(self) -> bytes:
+        """
+            Finish parsing, returning whatever is still held back to relay
+        """
+        rest = b""
+        if self._overflow:
+            return rest
+        if not self.streaming:
+            if self._buffer:
+                try:
+                    self._apply(json.loads(bytes(self._buffer)))
+                except ValueError:
+                    pass
+        elif self._buffer:
+            data = bytes(self._buffer)
+            if not self._event(data, 0, len(data)) and self.strip_usage:
+                rest = data
+        self._buffer = bytearray()
+        return rest
+
+    def _event(self, data: bytes, start: int, end: int) -> bool:
+        """
+            Record what an event carries. Returns True for the usage-only event that ends a stream.
+        """
+        usage_only = False
+        for line in data[start:end].splitlines():
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                continue
+            self.events += 1
+            if self.model is not None and not _INTERESTING.search(payload):
+                continue
+            try:
+                event = json.loads(payload)
+            except ValueError:
+                continue
+            self._apply(event)
+            usage_only = isinstance(event, dict) and isinstance(event.get("usage"), dict) and event.get("choices") == []
+        return usage_only
+
+    def _apply(self, event):
+        if not isinstance(event, dict):
+            return
+        if event.get("model"):
+            self.model = event["model"]
+        for choice in event.get("choices") or ():
+            if isinstance(choice, dict) and choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+        if isinstance(event.get("usage"), dict):
+            self.usage = event["usage"]
+
+    def summary(self) -> dict:
+        usage = self.usage or {}
+        return {
+            "model": self.model,
+            "finish_reason": self.finish_reason,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "total_tokens": usage.get("total_tokens")
+        }
@@ -0,0 +1,147 @@
+import asyncio
+import os
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+
+from open_ai_token import bodystore, crud, partitions, rollups
+from open_ai_token.database import SessionLocal
+
+load_dotenv()
+
+# Usage rows are queued in memory and written by a background task with multi-row
+# INSERTs, so logging costs a request no more than an append to the queue.
+QUEUE_SIZE = int(os.getenv("USAGE_QUEUE_SIZE", "10000"))
+BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "500"))
+FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL_MS", "250")) / 1000
+# How long a request may wait for room in a full queue before its row is dropped
+ENQUEUE_TIMEOUT = float(os.getenv("USAGE_ENQUEUE_TIMEOUT_MS", "50")) / 1000
+# How often upcoming partitions are created and retention is applied
+MAINTENANCE_INTERVAL = float(os.getenv("USAGE_MAINTENANCE_INTERVAL", "3600"))
+
+_queue: Optional[asyncio.Queue] = None
+_batch_ready: Optional[asyncio.Event] = None
+_writer = None
+_maintenance = None
+
+_stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "blocked": 0, "batches": 0}
+
+
+def _get_queue() -> asyncio.Queue:
+    global _queue, _batch_ready
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        _batch_ready = asyncio.Event()
+    return _queue
+
+
+async def log(record: dict):
+    """
+        Queue a usage row for the background writer. Waits briefly when the queue is full, then drops the row.
+    """
+    queue = _get_queue()
+    try:
+        queue.put_nowait(record)
+    except asyncio.QueueFull:
+        _stats["blocked"] += 1
+        try:
+            await asyncio.wait_for(queue.put(record), ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            _stats["dropped"] += 1
+            return
+        except asyncio.CancelledError:
+            _stats["dropped"] += 1
+            raise
+    _stats["enqueued"] += 1
+    if queue.qsize() >= BATCH_SIZE:
+        _batch_ready.set()
+
+
+def _write(batch: List[dict]):
+    increments = rollups.collect(batch)
+    with SessionLocal() as db:
+        crud.log_usages(db, bodystore.prepare(batch), increments)
+
+
+async def _flush(batch: List[dict]):
+    try:
+        await run_in_threadpool(_write, batch)
+    except Exception as e:
+        _stats["failed"] += len(batch)
+        print(f"Failed to write {len(batch)} usage rows: {e}")
+    else:
+        _stats["written"] += len(batch)
+        _stats["batches"] += 1
+
+
+def _drain(limit: int) -> List[dict]:
+    batch = []
+    while len(batch) < limit:
+        try:
+            batch.append(_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+
+async def _run():
+    queue = _get_queue()
+    while True:
+        try:
+            await asyncio.wait_for(_batch_ready.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _batch_ready.clear()
+        while not queue.empty():
+            await _flush(_drain(BATCH_SIZE))
+            if queue.qsize() < BATCH_SIZE:
+                break
+
+
+async def _maintain():
+    while True:
+        try:
+            await run_in_threadpool(partitions.maintain)
+        except Exception as e:
+            print(f"Usage maintenance failed: {e}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+
+async def startup():
+    global _writer, _maintenance
+    _get_queue()
+    if _writer is None:
+        _writer = asyncio.create_task(_run())
+    if _maintenance is None:
+        _maintenance = asyncio.create_task(_maintain())
+
+
+async def shutdown():
+    """
+        Stop the writer and flush everything still queued
+    """
+    global _writer, _maintenance
+    if _maintenance is not None:
+        _maintenance.cancel()
+        _maintenance = None
+    if _writer is not None:
+        _writer.cancel()
+        try:
+            await _writer
+        except asyncio.CancelledError:
+            pass
+        _writer = None
+    if _queue is not None:
+        while not _queue.empty():
+            await _flush(_drain(BATCH_SIZE))
+
+
+def stats() -> dict:
+    return dict(
+        _stats,
+        queued=_queue.qsize() if _queue is not None else 0,
+        capacity=QUEUE_SIZE,
+        body_storage=bodystore.MODE,
+        maintenance=partitions.stats()
+    )
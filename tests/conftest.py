@@ -0,0 +1,103 @@
+import os
+import tempfile
+
+# Modules read their settings when they are imported, so the test database and environment are
+# set up here, before any test imports open_ai_token
+_directory = tempfile.mkdtemp(prefix="gateway-tests-")
+# TEST_DB_URL runs them against another database instead, e.g. a scratch Postgres one
+os.environ["DB_URL"] = os.getenv("TEST_DB_URL") or f"sqlite:///{os.path.join(_directory, 'gateway.db')}"
+os.environ["POLICY_FILE"] = os.path.join(_directory, "policy.json")
+os.environ.setdefault("OPEN_AI_KEY", "sk-test")
+# benchmarks.mock_openai stands in for upstream, as fast as it goes
+os.environ["MOCK_TTFB_MS"] = "0"
+os.environ["MOCK_TOKENS_PER_SECOND"] = "1000000"
+os.environ["MOCK_COMPLETION_TOKENS"] = "4"
+for name in ("ASYNC_DB_URL", "PROMETHEUS_MULTIPROC_DIR", "CAPTURE_FILE", "REDIS_URL"):
+    os.environ.pop(name, None)
+
+import uuid  # noqa: E402
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def alembic_config():
+    from alembic.config import Config
+
+    root = os.path.dirname(os.path.dirname(__file__))
+    config = Config(os.path.join(root, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(root, "migrations"))
+    return config
+
+
+@pytest.fixture(scope="session")
+def database():
+    """
+        The test database, migrated to the latest revision
+    """
+    from alembic import command
+
+    command.upgrade(alembic_config(), "head")
+    return os.environ["DB_URL"]
+
+
+@pytest.fixture
+def make_token(database):
+    """
+        Create a user with a token and return the token, e.g. make_token(is_admin=True, uses_left=10)
+    """
+    from open_ai_token import models
+    from open_ai_token.database import SessionLocal
+
+    def make(uses_left: int = 1000, **user_fields) -> str:
+        slack_id = f"U{uuid.uuid4().hex[:12]}"
+        token = f"test-{uuid.uuid4()}"
+        with SessionLocal() as db:
+            db.add(models.User(slack_id=slack_id, name="Test", email=f"{slack_id}@example.com", **user_fields))
+            db.add(models.Token(token=token, user_id=slack_id, uses_left=uses_left))
+            db.commit()
+        return token
+
+    return make
+
+
+@pytest.fixture
+async def async_database(database):
+    """
+        For tests that use AsyncSessionLocal without the app. Its pooled connections belong to the
+        test's event loop, so they are closed with it.
+    """
+    from open_ai_token.database import async_engine
+
+    yield
+    await async_engine.dispose()
+
+
+@pytest.fixture
+async def gateway(database):
+    """
+        A client for the app, running its lifespan, with upstream served by benchmarks.mock_openai
+    """
+    from benchmarks import mock_openai
+    from open_ai_token import main
+    from open_ai_token import openai as openai_module
+    from open_ai_token import usage
+
+    # Each test runs on its own event loop, and the usage queue binds to the first one it sees
+    usage._queue = usage._batch_ready = None
+
+    base_url = openai_module.BASE_URL
+    openai_module.BASE_URL = "http://upstream/v1"
+    # Set before the lifespan starts so it is used, and closed when it ends
+    openai_module._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=mock_openai.app))
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://gateway") as client:
+                yield client
+    finally:
+        openai_module.BASE_URL = base_url
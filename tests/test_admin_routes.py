@@ -0,0 +1,65 @@
+import uuid
+
+import orjson
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def assert_admin_only(gateway, make_token, method: str, path: str, **kwargs):
+    assert (await gateway.request(method, path, **kwargs)).status_code == 403
+    assert (await gateway.request(method, path, headers=bearer("not-a-token"), **kwargs)).status_code == 401
+    assert (await gateway.request(method, path, headers=bearer(make_token()), **kwargs)).status_code == 403
+
+
+async def test_usage_summary_is_admin_only(gateway, make_token):
+    await assert_admin_only(gateway, make_token, "GET", "/usage/summary", params={"start": "2024-01-01T00:00:00"})
+    resp = await gateway.get("/usage/summary", params={"start": "2024-01-01T00:00:00"}, headers=bearer(make_token(is_admin=True)))
+    assert resp.status_code == 200
+    assert isinstance(resp.json(), list)
+
+
+async def test_exports_are_admin_only(gateway, make_token):
+    admin = make_token(is_admin=True)
+    for path in ("/users/export", "/tokens/export"):
+        await assert_admin_only(gateway, make_token, "GET", path)
+        resp = await gateway.get(path, headers=bearer(admin))
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/x-ndjson"
+    resp = await gateway.get("/tokens/export", headers=bearer(admin))
+    assert admin in resp.text
+
+
+async def test_bulk_routes_are_admin_only(gateway, make_token):
+    admin = bearer(make_token(is_admin=True))
+    slack_id = f"U{uuid.uuid4().hex[:12]}"
+    users = [{"slack_id": slack_id, "name": "Bulk", "email": f"{slack_id}@example.com"}]
+    await assert_admin_only(gateway, make_token, "POST", "/users/bulk", json=users)
+    resp = await gateway.post("/users/bulk", json=users, headers=admin)
+    assert [orjson.loads(line) for line in resp.content.splitlines()] == [{"slack_id": slack_id, "created": True}]
+
+    await assert_admin_only(gateway, make_token, "POST", "/tokens/bulk", json={"user_ids": [slack_id]})
+    resp = await gateway.post("/tokens/bulk", json={"user_ids": [slack_id], "uses_left": 5}, headers=admin)
+    [created] = [orjson.loads(line) for line in resp.content.splitlines()]
+    assert (created["user_id"], created["uses_left"]) == (slack_id, 5)
+
+    update = {"tokens": [created["token"]], "is_blocked": True}
+    await assert_admin_only(gateway, make_token, "POST", "/tokens/bulk/update", json=update)
+    resp = await gateway.get("/tokens/export", params={"user_id": slack_id}, headers=admin)
+    assert orjson.loads(resp.content)["is_blocked"] is False
+    resp = await gateway.post("/tokens/bulk/update", json=update, headers=admin)
+    assert orjson.loads(resp.content)["is_blocked"] is True
+
+
+async def test_bulk_users_listed_twice_are_reported_once(gateway, make_token):
+    slack_id = f"U{uuid.uuid4().hex[:12]}"
+    user = {"slack_id": slack_id, "name": "Twice", "email": f"{slack_id}@example.com"}
+    resp = await gateway.post("/users/bulk", json=[user, dict(user, name="Again")], headers=bearer(make_token(is_admin=True)))
+    assert [orjson.loads(line) for line in resp.content.splitlines()] == [
+        {"slack_id": slack_id, "created": True},
+        {"slack_id": slack_id, "created": False, "error": "Duplicate in request"},
+    ]
@@ -0,0 +1,72 @@
+import datetime
+import os
+
+import pytest
+
+from open_ai_token import bodystore, models
+
+
+@pytest.fixture
+def segments(monkeypatch, tmp_path):
+    monkeypatch.setattr(bodystore, "MODE", "segments")
+    monkeypatch.setattr(bodystore, "SEGMENT_DIR", str(tmp_path))
+    monkeypatch.setattr(bodystore, "_segment", None)
+    monkeypatch.setattr(bodystore, "_segment_size", 0)
+    return tmp_path
+
+
+def record(status_code: int = 200, **fields) -> dict:
+    return dict({"status_code": status_code, "request_data": b'{"model": "gpt-4o"}', "response_data": {"id": "c"}}, **fields)
+
+
+def stored(row: dict) -> models.Usage:
+    return models.Usage(**{name: row.get(name) for name in ("request_data", "response_data", "body", "body_ref")})
+
+
+def test_inline_keeps_bodies_as_text(monkeypatch):
+    monkeypatch.setattr(bodystore, "MODE", "inline")
+    [row] = bodystore.prepare([record()])
+    assert (row["request_data"], row["response_data"]) == ('{"model": "gpt-4o"}', '{"id": "c"}')
+
+
+def test_compressed_bodies_round_trip(monkeypatch):
+    monkeypatch.setattr(bodystore, "MODE", "compressed")
+    [row] = bodystore.prepare([record()])
+    assert "request_data" not in row
+    assert bodystore.load(stored(row)) == ('{"model": "gpt-4o"}', '{"id": "c"}')
+
+
+def test_segment_frames_are_appended_and_read_back(segments):
+    rows = bodystore.prepare([record(), record(response_data="second")])
+    rows += bodystore.prepare([record(response_data="third")])
+    assert len({row["body_ref"].split(":")[0] for row in rows}) == 1
+    assert [bodystore.load(stored(row))[1] for row in rows] == ['{"id": "c"}', "second", "third"]
+
+
+def test_full_segment_starts_a_new_file(segments, monkeypatch):
+    monkeypatch.setattr(bodystore, "SEGMENT_MAX_BYTES", 1)
+    rows = bodystore.prepare([record()]) + bodystore.prepare([record()])
+    assert len(os.listdir(segments)) == 2
+    assert rows[0]["body_ref"].split(":")[0] != rows[1]["body_ref"].split(":")[0]
+
+
+def test_sampling_keeps_errors(monkeypatch):
+    monkeypatch.setattr(bodystore, "SAMPLE_RATE", 0.000001)
+    rows = bodystore.prepare([record(), record(status_code=500)])
+    assert "request_data" not in rows[0]
+    assert rows[1]["request_data"] is not None
+    monkeypatch.setattr(bodystore, "MODE", "none")
+    assert "request_data" not in bodystore.prepare([record(status_code=500)])[0]
+
+
+def test_pruned_segments_read_as_empty(segments):
+    [row] = bodystore.prepare([record()])
+    old = segments / "usage-20200101-1-1.seg"
+    old.write_bytes(b"")
+    assert bodystore.prune_segments(datetime.datetime(2021, 1, 1)) == 1
+    assert not old.exists()
+    # Today's segment is still being written to
+    assert bodystore.load(stored(row)) != (None, None)
+
+    os.remove(segments / row["body_ref"].split(":")[0])
+    assert bodystore.load(stored(row)) == (None, None)
@@ -0,0 +1,68 @@
+import uuid
+
+import pytest
+
+from open_ai_token import crud, models, quota, schemas
+from open_ai_token.database import SessionLocal
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch, database):
+    # So a handful of rows already spans several statements
+    monkeypatch.setattr(crud, "BULK_CHUNK_SIZE", 2)
+
+
+def new_users(count: int) -> list:
+    ids = [f"U{uuid.uuid4().hex[:12]}" for _ in range(count)]
+    return [schemas.UserCreate(slack_id=slack_id, name="Bulk", email=f"{slack_id}@example.com") for slack_id in ids]
+
+
+def test_create_users_skips_existing():
+    users = new_users(5)
+    with SessionLocal() as db:
+        assert crud.create_users(db, users[:2]) == {user.slack_id for user in users[:2]}
+        assert crud.create_users(db, users) == {user.slack_id for user in users[2:]}
+        assert db.get(models.User, users[4].slack_id).email == users[4].email
+
+
+def test_create_tokens_reports_unknown_users():
+    users = new_users(3)
+    missing = f"U{uuid.uuid4().hex[:12]}"
+    with SessionLocal() as db:
+        crud.create_users(db, users)
+        tokens, unknown = crud.create_tokens(db, [user.slack_id for user in users] + [missing], uses_left=7)
+    assert sorted(token["user_id"] for token in tokens) == sorted(user.slack_id for user in users)
+    assert {token["uses_left"] for token in tokens} == {7}
+    assert unknown == [missing]
+
+
+def test_update_tokens_by_list_and_by_filter():
+    users = new_users(1)
+    with SessionLocal() as db:
+        crud.create_users(db, users)
+        tokens, _ = crud.create_tokens(db, [users[0].slack_id] * 3)
+        names = [token["token"] for token in tokens]
+
+        updated = crud.update_tokens(db, {"is_blocked": True}, tokens=names[:2] + ["no-such-token"])
+        assert sorted(row["token"] for row in updated) == sorted(names[:2])
+
+        updated = crud.update_tokens(db, {"is_blocked": True}, user_id=users[0].slack_id, is_blocked=False)
+        assert [row["token"] for row in updated] == names[2:]
+
+        with pytest.raises(ValueError):
+            crud.update_tokens(db, {"is_blocked": False})
+
+
+def test_overwriting_uses_left_drops_cached_state_and_leases(monkeypatch):
+    monkeypatch.setattr(quota, "_leases", {})
+    users = new_users(1)
+    with SessionLocal() as db:
+        crud.create_users(db, users)
+        [token], _ = crud.create_tokens(db, [users[0].slack_id])
+        crud.get_token_state(db, token["token"])
+        quota._leases[token["token"]] = quota.Lease(5, token["uses_version"], expires_at=0)
+
+        [row] = crud.update_tokens(db, {"uses_left": 50}, tokens=[token["token"]])
+    assert (row["uses_left"], row["uses_version"]) == (50, token["uses_version"] + 1)
+    assert token["token"] not in quota._leases
+    assert crud.get_cached_token_state(token["token"]) is crud.MISSING
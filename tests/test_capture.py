@@ -0,0 +1,91 @@
+import httpx
+import orjson
+import pytest
+
+from benchmarks import replay
+from open_ai_token import capture, main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def capture_file(monkeypatch, tmp_path):
+    path = tmp_path / "capture.jsonl"
+    monkeypatch.setattr(capture, "FILE", str(path))
+    monkeypatch.setattr(capture, "ENABLED", True)
+    monkeypatch.setattr(capture, "SAMPLE_RATE", 1)
+    monkeypatch.setattr(capture, "_lines", [])
+    monkeypatch.setattr(capture, "_stats", dict.fromkeys(capture._stats, 0))
+    return path
+
+
+@pytest.fixture
+async def captured(gateway, capture_file):
+    """
+        A client for the app with capture in front of it, as when CAPTURE_FILE is set
+    """
+    transport = httpx.ASGITransport(app=capture.CaptureMiddleware(main.app))
+    async with httpx.AsyncClient(transport=transport, base_url="http://gateway") as client:
+        yield client
+
+
+def chat(content: str, **fields) -> dict:
+    return dict({"model": "gpt-4o-mini", "messages": [{"role": "user", "content": content}]}, **fields)
+
+
+async def test_shapes_are_recorded_without_contents(captured, capture_file, make_token):
+    token = make_token()
+    body = orjson.dumps(chat("a secret prompt", stream=True, max_tokens=3))
+    resp = await captured.post("/chat/completions", content=body, headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 200
+    # Only the OpenAI routes are captured
+    await captured.get("/token/missing")
+    await capture._flush()
+
+    [line] = capture_file.read_bytes().splitlines()
+    assert b"secret" not in line and token.encode() not in line
+    record = orjson.loads(line)
+    assert record["token"] == capture.token_hash(token)
+    assert (record["route"], record["body_bytes"], record["model"]) == ("/chat/completions", len(body), "gpt-4o-mini")
+    assert (record["stream"], record["items"], record["max_tokens"], record["status"]) == (True, 1, 3, 200)
+    assert capture.stats()["written"] == 1
+
+
+async def test_full_buffer_drops_lines(captured, monkeypatch):
+    monkeypatch.setattr(capture, "MAX_BUFFERED", 1)
+    for _ in range(3):
+        await captured.get("/models")
+    assert (capture.stats()["captured"], capture.stats()["dropped"]) == (1, 2)
+
+
+async def test_failed_writes_are_counted(capture_file, monkeypatch):
+    monkeypatch.setattr(capture, "FILE", str(capture_file.parent / "missing" / "capture.jsonl"))
+    capture._lines.append(b"{}\n")
+    await capture._flush()
+    assert capture.stats()["failed"] == 1
+
+
+def test_replayed_bodies_have_the_recorded_shape():
+    record = {"method": "POST", "route": "/embeddings", "body_bytes": 400, "model": "text-embedding-3-small", "items": 3, "stream": False}
+    data = orjson.loads(replay.body(record, 7))
+    assert len(data["input"]) == 3
+    assert abs(len(replay.body(record, 7)) - 400) < 10
+    assert replay.body(dict(record, method="GET"), 7) is None
+    assert replay.path({"route": "/batches/{batch_id}/cancel"}, 2) == "/batches/batch_replay2/cancel"
+
+
+def test_peak_concurrency():
+    assert replay.peak_concurrency([(0, 2), (1, 3), (2.5, 4), (5, 6)]) == 2
+
+
+async def test_captured_traffic_replays_against_the_gateway(captured, capture_file, make_token):
+    token = make_token()
+    for content in ("one", "two two two"):
+        await captured.post("/chat/completions", json=chat(content), headers={"Authorization": f"Bearer {token}"})
+    await capture._flush()
+
+    records = replay.read(str(capture_file))
+    run = await replay.replay(captured, "", records, speed=1000, tokens={capture.token_hash(token): token})
+    summary = replay.summarize(records, run, speed=1000)
+    assert summary["requests"] == 2
+    assert summary["routes"]["/chat/completions"]["errors"] == 0
@@ -0,0 +1,94 @@
+import anyio
+import pytest
+
+from open_ai_token.coalesce import Coalescer
+
+pytestmark = pytest.mark.anyio
+
+
+class Upstream:
+    """
+        Embeds each item as its length, and fails any request with an item "bad" in it
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, data: dict, items: list):
+        self.calls.append((data, list(items)))
+        await anyio.sleep(0)
+        if "bad" in items:
+            return 400, {"error": {"message": "bad input"}}, None
+        return 200, {"model": data["model"]}, [len(item) for item in items]
+
+
+async def submit_all(coalescer: Coalescer, requests: list) -> list:
+    results = [None] * len(requests)
+
+    async def one(i, data, items):
+        results[i] = await coalescer.submit(data, items)
+
+    async with anyio.create_task_group() as tg:
+        for i, (data, items) in enumerate(requests):
+            tg.start_soon(one, i, data, items)
+    return results
+
+
+async def test_small_requests_share_one_upstream_call():
+    upstream = Upstream()
+    coalescer = Coalescer(upstream, window=0.01, max_items=100)
+    data = {"model": "text-embedding-3-small"}
+    results = await submit_all(coalescer, [(data, ["a"]), (data, ["bb", "ccc"]), (data, ["dddd"])])
+
+    assert len(upstream.calls) == 1
+    assert sorted(upstream.calls[0][1]) == ["a", "bb", "ccc", "dddd"]
+    assert sorted(result[2] for result in results) == [[1], [2, 3], [4]]
+    assert coalescer.stats()["requests_per_batch"] == 3
+
+
+async def test_different_parameters_are_not_combined():
+    upstream = Upstream()
+    coalescer = Coalescer(upstream, window=0.01, max_items=100)
+    await submit_all(coalescer, [({"model": "a"}, ["x"]), ({"model": "b"}, ["y"]), ({"model": "a", "dimensions": 8}, ["z"])])
+    assert len(upstream.calls) == 3
+
+
+async def test_full_batches_go_without_waiting():
+    upstream = Upstream()
+    coalescer = Coalescer(upstream, window=60, max_items=3)
+    data = {"model": "m"}
+    with anyio.fail_after(5):
+        results = await submit_all(coalescer, [(data, ["a"]), (data, ["b", "c"]), (data, ["dddd", "e", "f"])])
+    assert sorted(len(items) for _, items in upstream.calls) == [3, 3]
+    assert sorted(result[2] for result in results) == [[1], [1, 1], [4, 1, 1]]
+
+
+async def test_a_failed_batch_is_retried_per_caller():
+    upstream = Upstream()
+    coalescer = Coalescer(upstream, window=0.01, max_items=100)
+    data = {"model": "m"}
+    good, bad = await submit_all(coalescer, [(data, ["ok"]), (data, ["bad"])])
+
+    assert good == (200, {"model": "m"}, [2])
+    assert bad[0] == 400 and bad[2] is None
+    assert len(upstream.calls) == 3
+    assert coalescer.stats()["isolated_retries"] == 2
+
+
+async def test_an_exception_reaches_every_caller():
+    async def broken(data, items):
+        raise RuntimeError("upstream went away")
+
+    coalescer = Coalescer(broken, window=0.01, max_items=100)
+    caught = []
+
+    async def one(items):
+        try:
+            await coalescer.submit({"model": "m"}, items)
+        except RuntimeError as e:
+            caught.append(str(e))
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(one, ["a"])
+        tg.start_soon(one, ["b"])
+    assert caught == ["upstream went away"] * 2
@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+from open_ai_token import database
+from open_ai_token.database import AsyncSessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+def test_async_url_picks_the_asyncio_driver(monkeypatch):
+    monkeypatch.delenv("ASYNC_DB_URL", raising=False)
+    assert database.async_url("sqlite:///./gateway.db").drivername == "sqlite+aiosqlite"
+    url = database.async_url("postgresql://gateway:secret@db/gateway")
+    assert (url.drivername, url.password, url.database) == ("postgresql+asyncpg", "secret", "gateway")
+    assert url.query["prepared_statement_cache_size"] == str(database.STATEMENT_CACHE_SIZE)
+    with pytest.raises(ValueError, match="ASYNC_DB_URL"):
+        database.async_url("mssql://db/gateway")
+
+
+def test_async_url_can_be_overridden(monkeypatch):
+    monkeypatch.setenv("ASYNC_DB_URL", "postgresql+psycopg://db/gateway")
+    assert database.async_url("mssql://db/gateway").drivername == "postgresql+psycopg"
+
+
+def test_checkout_waits_and_timeouts_are_counted(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=database.TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.01)
+    try:
+        with engine.connect():
+            with pytest.raises(exc.TimeoutError):
+                engine.connect()
+        stats = engine.pool.checkout_stats
+        assert (stats["checkouts"], stats["timeouts"]) == (2, 1)
+        assert stats["max_wait_seconds"] >= 0.01
+    finally:
+        engine.dispose()
+
+
+async def test_both_pools_report(async_database):
+    async with AsyncSessionLocal() as db:
+        assert await db.scalar(text("SELECT 1")) == 1
+    stats = database.stats()
+    assert stats["async"]["checkouts"] >= 1
+    assert stats["async"]["in_use"] == 0
+    assert set(stats["sync"]) >= {"size", "idle", "overflow", "max_connections", "avg_wait_seconds"}
@@ -0,0 +1,117 @@
+import asyncio
+
+import orjson
+import pytest
+
+from open_ai_token import disconnect
+from open_ai_token.sse import UsageParser
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(disconnect, "_stats", dict.fromkeys(disconnect._stats, 0))
+    monkeypatch.setattr(disconnect, "_typical_completion", {})
+
+
+class Client:
+    """
+        The receive side of a request, which reports a disconnect once leave() is called
+    """
+
+    def __init__(self):
+        self.left = asyncio.Event()
+
+    def leave(self):
+        self.left.set()
+
+    async def receive(self):
+        await self.left.wait()
+        return {"type": "http.disconnect"}
+
+
+class Upstream:
+    def __init__(self, finish_when_cancelled: bool = False):
+        self.finish_when_cancelled = finish_when_cancelled
+        self.cancelled = False
+        self.discarded = []
+        self.reply = asyncio.Event()
+
+    async def start(self):
+        try:
+            await self.reply.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            if self.finish_when_cancelled:
+                return "late response"
+            raise
+        return "response"
+
+    async def discard(self, result):
+        self.discarded.append(result)
+
+
+def parser(model: str, events: int = 0, usage=None) -> UsageParser:
+    parsed = UsageParser(streaming=True)
+    parsed.model, parsed.events, parsed.usage = model, events, usage
+    return parsed
+
+
+async def test_result_is_returned_while_the_client_is_there():
+    upstream = Upstream()
+    upstream.reply.set()
+    assert await disconnect.until_disconnected(Client(), upstream.start, upstream.discard) == "response"
+    assert disconnect.stats()["aborted_before_response"] == 0
+
+
+async def test_upstream_call_is_cancelled_when_the_client_leaves():
+    client, upstream = Client(), Upstream()
+    call = asyncio.ensure_future(disconnect.until_disconnected(client, upstream.start, upstream.discard))
+    await asyncio.sleep(0)
+    client.leave()
+    with pytest.raises(disconnect.ClientDisconnected):
+        await call
+    assert upstream.cancelled and upstream.discarded == []
+    assert disconnect.stats()["aborted_before_response"] == 1
+
+
+async def test_response_that_arrives_anyway_is_discarded():
+    client, upstream = Client(), Upstream(finish_when_cancelled=True)
+    call = asyncio.ensure_future(disconnect.until_disconnected(client, upstream.start, upstream.discard))
+    await asyncio.sleep(0)
+    client.leave()
+    with pytest.raises(disconnect.ClientDisconnected):
+        await call
+    assert upstream.discarded == ["late response"]
+
+
+async def test_cancelling_the_request_cancels_the_upstream_call():
+    upstream = Upstream()
+    call = asyncio.ensure_future(disconnect.until_disconnected(Client(), upstream.start, upstream.discard))
+    await asyncio.sleep(0)
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+    assert upstream.cancelled
+
+
+def test_interrupted_stream_estimates_what_was_saved():
+    for _ in range(3):
+        disconnect.completed(parser("gpt-4o", usage={"completion_tokens": 100}))
+    fields = disconnect.interrupted(orjson.dumps({"model": "gpt-4o"}), parser("gpt-4o", events=40), elapsed=2.0)
+    assert fields == {"finish_reason": "client_disconnected", "completion_tokens": 40}
+    assert disconnect.stats()["tokens_saved"] == 60
+    assert disconnect.stats()["seconds_saved"] == pytest.approx(3.0)
+
+
+def test_max_tokens_caps_the_estimate():
+    disconnect.completed(parser("gpt-4o", usage={"completion_tokens": 100}))
+    disconnect.interrupted({"max_tokens": 50}, parser("gpt-4o", events=10), elapsed=1.0)
+    assert disconnect.stats()["tokens_saved"] == 40
+
+
+def test_interrupted_response_with_usage_is_not_estimated():
+    fields = disconnect.interrupted(None, parser("gpt-4o", events=10, usage={"completion_tokens": 10}), elapsed=1.0)
+    assert fields == {"finish_reason": "client_disconnected"}
+    assert disconnect.stats()["aborted_mid_stream"] == 1
@@ -0,0 +1,94 @@
+from array import array
+
+import httpx
+import pytest
+
+from open_ai_token import embeddings_cache
+from open_ai_token.cache import TTLCache
+
+pytestmark = pytest.mark.anyio
+
+DIMENSIONS = 1536
+
+
+def vector(seed: int) -> list:
+    return [(seed * 31 + i) % 1000 / 997 for i in range(DIMENSIONS)]
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """
+        Fake upstream embeddings endpoint, recording the inputs of every call
+    """
+    calls = []
+
+    async def create_embeddings(data):
+        calls.append(list(data["input"]))
+        body = {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": vector(len(text))} for i, text in enumerate(data["input"])],
+            "model": data["model"],
+            "usage": {"prompt_tokens": 2 * len(data["input"]), "total_tokens": 2 * len(data["input"])}
+        }
+        return httpx.Response(200, json=body)
+
+    monkeypatch.setattr(embeddings_cache.openai_module, "create_embeddings", create_embeddings)
+    monkeypatch.setattr(embeddings_cache, "_memory", TTLCache(maxsize=10 * 1024 ** 2, weigh=embeddings_cache._weigh))
+    monkeypatch.setattr(embeddings_cache, "_disk", None)
+    monkeypatch.setattr(embeddings_cache, "_coalescer", None)
+    return calls
+
+
+def test_weighted_cache_evicts_by_weight():
+    cache = TTLCache(maxsize=100, weigh=len)
+    cache.set("a", b"x" * 40)
+    cache.set("b", b"x" * 40)
+    cache.set("a", b"x" * 10)
+    assert cache.weight == 50
+    cache.set("c", b"x" * 60)
+    assert cache.get("b") is None
+    assert cache.weight == 70
+    assert cache.pop("a") == b"x" * 10
+    assert cache.weight == 60
+
+
+def test_entries_are_packed_float32():
+    packed = embeddings_cache._encode(vector(1))
+    assert len(packed) == 1 + 4 * DIMENSIONS
+    assert embeddings_cache._decode(packed) == array("f", vector(1)).tolist()
+    assert embeddings_cache._decode(embeddings_cache._encode("AAAA")) == "AAAA"
+    # float64 rows written to the disk tier by earlier versions still read back
+    assert embeddings_cache._decode(b"d" + array("d", [0.5, 0.25]).tobytes()) == [0.5, 0.25]
+
+
+async def test_only_uncached_items_go_upstream(upstream):
+    status, body, usage = await embeddings_cache.create({"model": "text-embedding-3-small", "input": ["a", "bb"]})
+    assert status == 200
+    # Fresh vectors are returned exactly as upstream sent them
+    assert body["data"][1]["embedding"] == vector(2)
+    assert usage["prompt_tokens"] == 4
+
+    status, body, usage = await embeddings_cache.create({"model": "text-embedding-3-small", "input": ["bb", "ccc", "a"]})
+    assert upstream == [["a", "bb"], ["ccc"]]
+    assert [entry["index"] for entry in body["data"]] == [0, 1, 2]
+    assert body["data"][0]["embedding"] == pytest.approx(vector(2), rel=1e-6)
+    assert body["usage"]["prompt_tokens"] == 6
+    assert usage["prompt_tokens"] == 2
+
+
+async def test_memory_tier_is_bounded_by_bytes(upstream, monkeypatch):
+    per_entry = embeddings_cache._weigh((embeddings_cache._encode(vector(0)), 0))
+    monkeypatch.setattr(embeddings_cache, "_memory", TTLCache(maxsize=3 * per_entry, weigh=embeddings_cache._weigh))
+    await embeddings_cache.create({"model": "m", "input": ["a", "b", "c", "d", "e"]})
+    assert len(embeddings_cache._memory) == 3
+    assert embeddings_cache._memory.weight <= 3 * per_entry
+
+
+async def test_disk_tier_serves_what_memory_evicted(upstream, monkeypatch, tmp_path):
+    monkeypatch.setattr(embeddings_cache, "_disk", embeddings_cache.DiskCache(str(tmp_path / "embeddings.sqlite"), 1024 ** 2))
+    await embeddings_cache.create({"model": "m", "input": ["a"]})
+    embeddings_cache._memory.clear()
+    status, body, usage = await embeddings_cache.create({"model": "m", "input": ["a"]})
+    assert upstream == [["a"]]
+    assert body["data"][0]["embedding"] == pytest.approx(vector(1), rel=1e-6)
+    assert usage["prompt_tokens"] == 0
@@ -0,0 +1,91 @@
+import json
+import time
+
+import httpx
+import pytest
+
+from open_ai_token import keys
+from open_ai_token import openai as openai_module
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = [keys.UpstreamKey("sk-first-key-0001"), keys.UpstreamKey("sk-second-key-0002"), keys.UpstreamKey("sk-gpt4-only-0003", models=["gpt-4*"])]
+    monkeypatch.setattr(keys, "pool", pool)
+    return pool
+
+
+def limits(remaining_requests: int, remaining_tokens: int = 1000) -> dict:
+    return {
+        "x-ratelimit-limit-requests": "100",
+        "x-ratelimit-remaining-requests": str(remaining_requests),
+        "x-ratelimit-reset-requests": "1m",
+        "x-ratelimit-limit-tokens": "1000",
+        "x-ratelimit-remaining-tokens": str(remaining_tokens),
+        "x-ratelimit-reset-tokens": "6m0s",
+    }
+
+
+@pytest.mark.parametrize("value, seconds", [("6m0s", 360), ("1.5s", 1.5), ("20ms", 0.02), ("1h2m", 3720), ("7", 7), ("soon", None), (None, None)])
+def test_parse_duration(value, seconds):
+    assert keys.parse_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_models_restrict_a_key(pool):
+    assert pool[2].serves("gpt-4o") and not pool[2].serves("gpt-3.5-turbo")
+    assert pool[0].serves("anything")
+    assert keys.pick("dall-e-3", exclude=pool[:2]) is None
+
+
+def test_pick_prefers_the_key_with_most_headroom(pool):
+    pool[0].observe(limits(10))
+    pool[1].observe(limits(90, remaining_tokens=500))
+    assert pool[1].headroom(time.monotonic()) == 0.5
+    assert keys.pick("gpt-3.5-turbo") is pool[1]
+
+
+def test_concurrent_picks_spread_across_keys(pool):
+    pool[0].observe(limits(51))
+    pool[1].observe(limits(50))
+    picked = [keys.pick("gpt-3.5-turbo") for _ in range(4)]
+    assert picked.count(pool[0]) == 2 and picked.count(pool[1]) == 2
+
+
+def test_throttled_key_sits_out_until_it_resets(pool):
+    now = time.monotonic()
+    pool[0].throttle({"retry-after": "30"}, now=now)
+    assert pool[0].headroom(now + 10) == -1.0
+    assert pool[0].headroom(now + 31) == 1.0
+    assert keys.pick("gpt-3.5-turbo", exclude=[pool[1]], allow_throttled=False) is None
+
+
+def test_stats_never_show_the_keys(monkeypatch):
+    configured = [{"key": "sk-first-key-0001"}, {"key": "sk-second-key-0002", "name": "batch"}]
+    monkeypatch.setenv("OPEN_AI_KEYS", json.dumps(configured))
+    monkeypatch.setattr(keys, "pool", keys._load())
+    stats = keys.stats()
+    assert [key["name"] for key in stats] == ["key-0", "batch"]
+    assert "sk-" not in json.dumps(stats) and "0001" not in json.dumps(stats)
+
+
+async def test_429_fails_over_to_another_key(pool, monkeypatch):
+    seen = []
+
+    def upstream(request: httpx.Request) -> httpx.Response:
+        key = request.headers["authorization"].removeprefix("Bearer ")
+        seen.append(key)
+        if key == pool[0].key:
+            return httpx.Response(429, headers={"retry-after": "20"})
+        return httpx.Response(200, json={"ok": True}, headers=limits(99))
+
+    pool[1].observe(limits(40))
+    async with httpx.AsyncClient(transport=httpx.MockTransport(upstream)) as client:
+        monkeypatch.setattr(openai_module, "_client", client)
+        resp = await openai_module._send_once("POST", "/chat/completions", {"model": "gpt-3.5-turbo"}, stream=False)
+
+    assert resp.status_code == 200
+    assert seen == [pool[0].key, pool[1].key]
+    assert pool[0].throttled == 1
+    assert pool[1].remaining_requests == 99
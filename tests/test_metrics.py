@@ -0,0 +1,50 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from open_ai_token import metrics
+
+pytestmark = pytest.mark.anyio
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_model_labels_are_capped(monkeypatch):
+    monkeypatch.setattr(metrics, "_models", set())
+    monkeypatch.setattr(metrics, "MAX_MODELS", 2)
+    assert [metrics.model_label(model) for model in ("gpt-4o", "o1", "gpt-4o", "made-up")] == ["gpt-4o", "o1", "gpt-4o", "other"]
+    assert metrics.model_label("x" * 65) == "other"
+    assert metrics.model_label(None) == metrics.model_label(["gpt-4o"]) == ""
+
+
+def test_spans_outside_a_request_are_ignored():
+    # Outside a request there is nothing to add the time to, and that is fine
+    with metrics.span("auth"):
+        pass
+    metrics.set_model("gpt-4o")
+
+
+async def test_responses_are_counted_by_route_template(gateway):
+    labels = {"route": "/token/{token}", "status": "404"}
+    before = sample("gateway_responses_total", **labels)
+    for token in ("missing-1", "missing-2"):
+        assert (await gateway.get(f"/token/{token}")).status_code == 404
+    assert sample("gateway_responses_total", **labels) == before + 2
+    assert sample("gateway_request_duration_seconds_count", route="/token/{token}", model="") >= 2
+
+
+async def test_proxied_calls_are_timed_per_model(gateway, make_token):
+    labels = {"endpoint": "chat", "model": "gpt-4o-mini"}
+    before = sample("gateway_upstream_ttfb_seconds_count", **labels)
+    body = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}]}
+    resp = await gateway.post("/chat/completions", json=body, headers={"Authorization": f"Bearer {make_token()}"})
+    assert resp.status_code == 200
+    assert sample("gateway_upstream_ttfb_seconds_count", **labels) == before + 1
+    assert sample("gateway_auth_duration_seconds_count", route="/chat/completions", model="gpt-4o-mini") >= 1
+
+
+async def test_metrics_endpoint_renders_the_registry(gateway):
+    resp = await gateway.get("/metrics")
+    assert resp.headers["content-type"] == metrics.CONTENT_TYPE
+    assert "gateway_responses_total" in resp.text
@@ -0,0 +1,23 @@
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+
+from open_ai_token import models
+from open_ai_token.database import engine
+from tests.conftest import alembic_config
+
+
+def differences() -> list:
+    with engine.connect() as conn:
+        return compare_metadata(MigrationContext.configure(conn), models.Base.metadata)
+
+
+def test_migrations_build_the_models(database):
+    assert differences() == []
+
+
+def test_every_migration_downgrades(database):
+    config = alembic_config()
+    command.downgrade(config, "base")
+    command.upgrade(config, "head")
+    assert differences() == []
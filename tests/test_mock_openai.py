@@ -0,0 +1,71 @@
+import httpx
+import orjson
+import pytest
+
+from benchmarks import gateway as benchmark
+from benchmarks import mock_openai
+from open_ai_token import openai as openai_module
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def mock():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=mock_openai.app), base_url="http://mock/v1") as client:
+        yield client
+
+
+async def test_chat_completion_reports_usage(mock):
+    body = {"model": "gpt-4o", "messages": [{"role": "user", "content": "12345678"}], "max_tokens": 2}
+    completion = (await mock.post("/chat/completions", json=body)).json()
+    assert completion["usage"] == {"prompt_tokens": 2, "completion_tokens": 2, "total_tokens": 4}
+    assert completion["model"] == "gpt-4o"
+
+
+async def test_streamed_chat_sends_usage_only_when_asked(mock):
+    body = {"model": "gpt-4o", "messages": [], "stream": True}
+    events = (await mock.post("/chat/completions", json=body)).text.split("\n\n")
+    # Role, one event per token, the finish and [DONE]
+    assert len([event for event in events if event]) == mock_openai.COMPLETION_TOKENS + 3
+    assert events[-2] == "data: [DONE]"
+
+    events = (await mock.post("/chat/completions", json=dict(body, stream_options={"include_usage": True}))).text.split("\n\n")
+    assert orjson.loads(events[-3][6:])["usage"]["completion_tokens"] == mock_openai.COMPLETION_TOKENS
+
+
+async def test_embeddings_models_and_batches(mock):
+    data = (await mock.post("/embeddings", json={"input": ["a", "b"]})).json()["data"]
+    assert [len(item["embedding"]) for item in data] == [mock_openai.EMBEDDING_DIMENSIONS] * 2
+    assert (await mock.get("/models/gpt-4o")).status_code == 200
+    assert (await mock.get("/models/gpt-5")).status_code == 404
+
+    batch = (await mock.post("/batches", json={"endpoint": "/v1/chat/completions", "input_file_id": "file-1"})).json()
+    assert (await mock.post(f"/batches/{batch['id']}/cancel")).json()["status"] == "cancelling"
+    assert (await mock.post("/batches/batch_unknown/cancel")).status_code == 404
+
+
+async def test_gateway_calls_the_configured_base_url(gateway, make_token):
+    urls = []
+
+    async def record(request):
+        urls.append(str(request.url))
+
+    openai_module._client.event_hooks["request"].append(record)
+    assert (await gateway.get("/models", headers={"Authorization": f"Bearer {make_token()}"})).status_code == 200
+    assert urls == ["http://upstream/v1/models"]
+
+
+async def test_benchmark_load_reads_every_response(mock):
+    scenario = next(scenario for scenario in benchmark.SCENARIOS if scenario.name == "chat stream")
+    result = await benchmark.load(mock, "", scenario, requests=6, concurrency=3)
+    assert (len(result["latencies"]), result["errors"]) == (6, 0)
+
+
+def test_benchmark_compares_with_the_last_run_of_the_same_settings(tmp_path, monkeypatch):
+    results = tmp_path / "gateway.jsonl"
+    runs = [{"settings": {"requests": 10}, "commit": "a"}, {"settings": {"requests": 20}, "commit": "b"}, {"settings": {"requests": 10}, "commit": "c"}]
+    results.write_bytes(b"".join(orjson.dumps(run) + b"\n" for run in runs))
+    monkeypatch.setattr(benchmark, "RESULTS", str(results))
+    assert benchmark.previous({"requests": 10})["commit"] == "c"
+    assert benchmark.previous({"requests": 30}) is None
+    assert benchmark.percentile([5, 1, 4, 2, 3], 0.5) == 3
@@ -0,0 +1,53 @@
+import httpx
+import pytest
+
+from open_ai_token import keys
+from open_ai_token import openai as openai_module
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """
+        Clients made by the module, each answering every request with 200
+    """
+    clients = []
+
+    def create():
+        clients.append(httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={"ok": True}))))
+        return clients[-1]
+
+    monkeypatch.setattr(openai_module, "_client", None)
+    monkeypatch.setattr(openai_module, "_create_client", create)
+    monkeypatch.setattr(keys, "pool", [keys.UpstreamKey("sk-test")])
+    return clients
+
+
+async def test_one_client_serves_every_call_until_shutdown(created):
+    await openai_module.startup()
+    await openai_module.startup()
+    for _ in range(3):
+        resp = await openai_module._send_once("GET", "/models", stream=False)
+        assert resp.status_code == 200
+    assert len(created) == 1
+    assert openai_module.get_client() is created[0]
+
+    await openai_module.shutdown()
+    assert created[0].is_closed
+    assert openai_module._client is None
+    await openai_module.shutdown()
+
+
+async def test_client_is_made_on_first_use_without_the_lifespan(created):
+    client = openai_module.get_client()
+    assert openai_module.get_client() is client
+    await openai_module.shutdown()
+    assert client.is_closed and len(created) == 1
+
+
+async def test_pool_settings_come_from_the_environment(monkeypatch):
+    monkeypatch.setattr(openai_module, "CONNECT_TIMEOUT", 3.0)
+    monkeypatch.setattr(openai_module, "READ_TIMEOUT", 90.0)
+    async with openai_module._create_client() as client:
+        assert (client.timeout.connect, client.timeout.read, client.timeout.pool) == (3.0, 90.0, openai_module.POOL_TIMEOUT)
@@ -0,0 +1,76 @@
+import datetime
+import uuid
+
+import orjson
+import pytest
+
+from open_ai_token import models, pagination
+from open_ai_token.database import SessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+def test_cursors_round_trip():
+    moment = datetime.datetime(2026, 10, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    assert pagination.decode_cursor(pagination.encode_cursor("U123"), 1) == ("U123",)
+    assert pagination.decode_time_cursor(pagination.encode_cursor(moment, "tok")) == (moment, "tok")
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", pagination.encode_cursor("a", "b", "c"), pagination.encode_cursor("yesterday", "tok")])
+def test_bad_cursors_are_refused(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        pagination.decode_time_cursor(cursor)
+
+
+def test_ndjson_chunks_rows():
+    chunks = list(pagination.ndjson(({"n": n} for n in range(5)), chunk_size=2))
+    assert chunks == [b'{"n":0}\n{"n":1}\n', b'{"n":2}\n{"n":3}\n', b'{"n":4}\n']
+    assert list(pagination.ndjson([])) == []
+
+
+@pytest.fixture
+def user_tokens(database):
+    """
+        A user with three tokens, returned oldest first
+    """
+    slack_id = f"U{uuid.uuid4().hex[:12]}"
+    tokens = [f"page-{uuid.uuid4()}" for _ in range(3)]
+    start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    with SessionLocal() as db:
+        db.add(models.User(slack_id=slack_id, name="Pages", email=f"{slack_id}@example.com"))
+        for minute, token in enumerate(tokens):
+            db.add(models.Token(token=token, user_id=slack_id, uses_left=10, created_at=start + datetime.timedelta(minutes=minute)))
+        db.commit()
+    return slack_id, tokens
+
+
+async def test_token_pages_follow_the_cursor(gateway, user_tokens):
+    slack_id, tokens = user_tokens
+    resp = await gateway.get("/tokens", params={"user_id": slack_id, "limit": 2})
+    assert [token["token"] for token in resp.json()] == tokens[:2]
+
+    cursor = resp.headers["X-Next-Cursor"]
+    resp = await gateway.get("/tokens", params={"user_id": slack_id, "limit": 2, "cursor": cursor})
+    assert [token["token"] for token in resp.json()] == tokens[2:]
+    assert "X-Next-Cursor" not in resp.headers
+
+
+async def test_bad_cursor_is_a_400(gateway):
+    assert (await gateway.get("/tokens", params={"cursor": "nope"})).status_code == 400
+    assert (await gateway.get("/users", params={"cursor": "nope"})).status_code == 400
+
+
+async def test_user_pages_do_not_repeat(gateway, user_tokens):
+    resp = await gateway.get("/users", params={"limit": 1})
+    [first] = resp.json()
+    resp = await gateway.get("/users", params={"limit": 1, "cursor": resp.headers["X-Next-Cursor"]})
+    [second] = resp.json()
+    assert first["slack_id"] < second["slack_id"]
+
+
+async def test_export_streams_every_matching_token(gateway, make_token, user_tokens):
+    slack_id, tokens = user_tokens
+    resp = await gateway.get("/tokens/export", params={"user_id": slack_id}, headers={"Authorization": f"Bearer {make_token(is_admin=True)}"})
+    rows = [orjson.loads(line) for line in resp.content.splitlines()]
+    assert [row["token"] for row in rows] == tokens
+    assert {row["uses_left"] for row in rows} == {10}
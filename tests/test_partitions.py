@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from open_ai_token import models, partitions
+from open_ai_token.database import SessionLocal, engine
+
+UTC = datetime.timezone.utc
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(partitions, "_stats", dict.fromkeys(partitions._stats, 0))
+
+
+def test_monthly_periods(monkeypatch):
+    monkeypatch.setattr(partitions, "INTERVAL", "month")
+    start = partitions.period_start(datetime.datetime(2026, 12, 31, 23, 59, tzinfo=UTC))
+    assert start == datetime.datetime(2026, 12, 1, tzinfo=UTC)
+    assert partitions.next_period(start) == datetime.datetime(2027, 1, 1, tzinfo=UTC)
+    assert partitions.partition_name(start) == "usages_202612"
+
+
+def test_daily_periods(monkeypatch):
+    monkeypatch.setattr(partitions, "INTERVAL", "day")
+    start = partitions.period_start(datetime.datetime(2026, 2, 28, 12, tzinfo=UTC))
+    assert partitions.next_period(start) == datetime.datetime(2026, 3, 1, tzinfo=UTC)
+    assert partitions.partition_name(start) == "usages_20260228"
+
+
+def test_partition_bounds_are_parsed():
+    assert partitions._parse_bound("MINVALUE") == "MINVALUE"
+    assert partitions._parse_bound("'2026-11-01 00:00:00+00'") == datetime.datetime(2026, 11, 1, tzinfo=UTC)
+
+
+def test_retention_deletes_old_rows_in_batches(database, make_token, monkeypatch):
+    if engine.dialect.name == "postgresql":
+        pytest.skip("usages is partitioned on Postgres, retention drops partitions there")
+    monkeypatch.setattr(partitions, "DELETE_BATCH_SIZE", 2)
+    token = make_token()
+    with SessionLocal() as db:
+        for day in range(1, 6):
+            db.add(models.Usage(token_id=token, endpoint="/models", created_at=datetime.datetime(1999, 1, day, tzinfo=UTC)))
+        db.add(models.Usage(token_id=token, endpoint="/models", created_at=datetime.datetime(2001, 1, 1, tzinfo=UTC)))
+        db.commit()
+
+    with engine.connect() as conn:
+        partitions.delete_before(conn, datetime.datetime(2000, 1, 1, tzinfo=UTC))
+
+    with SessionLocal() as db:
+        left = db.scalars(select(models.Usage.created_at).where(models.Usage.token_id == token)).all()
+    assert [moment.year for moment in left] == [2001]
+    assert partitions.stats()["rows_deleted"] == 5
+
+
+def test_maintain_without_retention_keeps_everything(database, monkeypatch):
+    monkeypatch.setattr(partitions, "RETENTION_DAYS", 0)
+    with SessionLocal() as db:
+        before = db.scalar(select(func.count()).select_from(models.Usage))
+    partitions.maintain()
+    with SessionLocal() as db:
+        assert db.scalar(select(func.count()).select_from(models.Usage)) == before
+    assert partitions.stats()["runs"] == 1
@@ -0,0 +1,44 @@
+import orjson
+import pytest
+
+from open_ai_token import openai as openai_module
+from open_ai_token import passthrough
+
+pytestmark = pytest.mark.anyio
+
+
+def test_body_keeps_the_bytes_it_was_given():
+    raw = b'{ "model" : "gpt-4o",\n"messages": [] }'
+    body = passthrough.JSONBody(raw)
+    assert body.raw is raw
+    assert body.data == {"model": "gpt-4o", "messages": []}
+
+
+@pytest.mark.parametrize("raw, error", [(b"{nope", "not valid JSON"), (b"", "not valid JSON"), (b"[1, 2]", "must be a JSON object")])
+def test_bad_bodies_are_refused(raw, error):
+    with pytest.raises(ValueError, match=error):
+        passthrough.JSONBody(raw)
+
+
+def test_stream_usage_is_added_after_leading_whitespace():
+    raw = b'\n  {"stream": true}'
+    assert orjson.loads(passthrough.with_stream_usage(raw)) == {"stream": True, "stream_options": {"include_usage": True}}
+
+
+async def test_chat_body_reaches_upstream_byte_for_byte(gateway, make_token):
+    sent = []
+
+    async def record(request):
+        sent.append(request.content)
+
+    openai_module._client.event_hooks["request"].append(record)
+    raw = b'{"messages": [{"role": "user", "content": "hi"}],   "model": "gpt-4o-mini", "x_unknown": {"kept": 1.50}}'
+    resp = await gateway.post("/chat/completions", content=raw, headers={"Authorization": f"Bearer {make_token()}"})
+    assert resp.status_code == 200
+    assert sent == [raw]
+
+
+async def test_invalid_body_is_refused_before_upstream(gateway, make_token):
+    resp = await gateway.post("/chat/completions", content=b"[]", headers={"Authorization": f"Bearer {make_token()}"})
+    assert resp.status_code == 422
+    assert resp.json()["detail"] == "Request body must be a JSON object"
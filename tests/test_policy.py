@@ -0,0 +1,123 @@
+import json
+import os
+
+import pytest
+
+from open_ai_token import policy
+from open_ai_token.schemas import TokenState
+
+pytestmark = pytest.mark.anyio
+
+
+def state(**flags) -> TokenState:
+    return TokenState(token="t", user_id="U1", **flags)
+
+
+@pytest.fixture
+def policy_file(monkeypatch):
+    """
+        Write POLICY_FILE and have the next lookup pick it up
+    """
+    for name in ("_policy", "_mtime", "_error", "_checked"):
+        monkeypatch.setattr(policy, name, getattr(policy, name))
+    monkeypatch.setattr(policy, "RELOAD_INTERVAL", 0)
+    monkeypatch.setattr(policy, "_stats", dict.fromkeys(policy._stats, 0))
+
+    def write(contents, mtime: float):
+        with open(policy.POLICY_FILE, "w") as f:
+            f.write(contents if isinstance(contents, str) else json.dumps(contents))
+        os.utime(policy.POLICY_FILE, (mtime, mtime))
+
+    yield write
+    if os.path.exists(policy.POLICY_FILE):
+        os.remove(policy.POLICY_FILE)
+
+
+def test_model_rules_match_names_prefixes_and_globs():
+    table = policy.ModelTable([("gpt-4o", "exact"), ("gpt-4*", "short"), ("gpt-4o*", "long"), ("*-mini", "glob")])
+    assert table.lookup("gpt-4o") == ("exact", "long", "short")
+    assert table.lookup("gpt-4o-mini") == ("long", "short", "glob")
+    assert table.lookup("dall-e-3") == ()
+
+
+def test_every_matching_model_rule_applies():
+    rules = policy.Policy({"models": [
+        {"match": "gpt-4*", "requires": ["gpt4_usage_allowed"]},
+        {"match": ["gpt-4-32k"], "requires": "can_use_superpowers"},
+    ]})
+    rules.check_body("/chat/completions", {"model": "gpt-4o"}, state(gpt4_usage_allowed=True))
+    with pytest.raises(policy.PolicyDenied):
+        rules.check_body("/chat/completions", {"model": "gpt-4-32k"}, state(gpt4_usage_allowed=True))
+    rules.check_body("/chat/completions", {"model": "gpt-4-32k"}, state(gpt4_usage_allowed=True, can_use_superpowers=True))
+
+
+def test_endpoints_limit_callers_and_models():
+    rules = policy.Policy({"endpoints": {"/images/generations": {"requires": ["image_usage_allowed"], "models": ["dall-e-*"]}}})
+    with pytest.raises(policy.PolicyDenied):
+        rules.authorize("/images/generations", state(image_usage_allowed=False))
+    with pytest.raises(policy.PolicyDenied, match="cannot be used"):
+        rules.check_body("/images/generations", {"model": "gpt-4o"}, state())
+    rules.check_body("/images/generations", {"model": "dall-e-3"}, state())
+    with pytest.raises(policy.PolicyDenied, match="banned"):
+        rules.authorize("/models", state(is_banned=True))
+
+
+def test_tier_caps_are_a_400():
+    rules = policy.Policy({"tiers": {"default": {"max_tokens": 100, "n": 1}}})
+    with pytest.raises(policy.PolicyDenied) as denied:
+        rules.check_body("/chat/completions", {"max_completion_tokens": 101}, state())
+    assert denied.value.status_code == 400
+    with pytest.raises(policy.PolicyDenied, match="n is limited"):
+        rules.check_body("/chat/completions", {"n": 2}, state())
+    rules.check_body("/chat/completions", {"max_tokens": 5000, "n": 8}, state(is_club_leader=True))
+
+
+@pytest.mark.parametrize("config", [
+    {"models": [{"match": "gpt-4*", "requires": ["is_wizard"]}]},
+    {"tiers": {"default": {"temperature": 1}}},
+])
+def test_unknown_names_are_refused(config):
+    with pytest.raises(ValueError, match="Unknown"):
+        policy.Policy(config)
+
+
+def test_policy_file_is_reloaded_when_it_changes(policy_file):
+    policy_file({"models": [{"match": "o1*", "requires": ["is_admin"]}]}, mtime=1000)
+    with pytest.raises(policy.PolicyDenied):
+        policy.check_body("/chat/completions", {"model": "o1-mini"}, state())
+    assert policy.stats()["reloads"] == 1
+    assert policy.stats()["source"] == policy.POLICY_FILE
+
+    # A broken file is reported and the last good policy stays
+    policy_file("{not json", mtime=2000)
+    with pytest.raises(policy.PolicyDenied):
+        policy.check_body("/chat/completions", {"model": "o1-mini"}, state())
+    assert policy.stats()["reload_errors"] == 1
+    assert policy.stats()["last_error"].startswith("JSONDecodeError")
+
+    policy_file({"models": []}, mtime=3000)
+    policy.check_body("/chat/completions", {"model": "o1-mini"}, state())
+    assert policy.stats()["last_error"] is None
+
+
+async def test_denied_requests_never_reach_upstream(gateway, make_token):
+    resp = await gateway.post("/chat/completions", json={"model": "gpt-4o", "messages": []}, headers={"Authorization": f"Bearer {make_token()}"})
+    assert resp.status_code == 403
+    assert resp.json() == {"error": "This model is not available for use at this time."}
+
+
+async def test_denied_requests_are_not_charged(gateway, make_token, monkeypatch):
+    from open_ai_token import ratelimit
+
+    backend = ratelimit.LocalBackend()
+    monkeypatch.setattr(ratelimit, "_local", backend)
+    monkeypatch.setattr(ratelimit, "_backend", backend)
+    monkeypatch.setattr(ratelimit, "ENABLED", True)
+    monkeypatch.setitem(ratelimit.TIERS, "default", {"requests": 1, "tokens": 100000})
+    headers = {"Authorization": f"Bearer {make_token()}"}
+    for _ in range(3):
+        resp = await gateway.post("/chat/completions", json={"model": "gpt-4o", "messages": []}, headers=headers)
+        assert resp.status_code == 403
+    # The one request a minute is still there
+    resp = await gateway.post("/chat/completions", json={"model": "gpt-4o-mini", "messages": []}, headers=headers)
+    assert resp.status_code == 200
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import orjson
+import pytest
+
+from open_ai_token import metrics, profiler
+
+pytestmark = pytest.mark.anyio
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+def busy_wait(stop: threading.Event):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+def test_sampling_counts_the_stacks_of_a_thread():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_wait, args=(stop,))
+    worker.start()
+    try:
+        counts = profiler.sample(worker.ident, 0.05, interval=0.005)
+    finally:
+        stop.set()
+        worker.join()
+    assert counts
+    assert all("busy_wait (test_profiler.py:" in stack for stack in counts)
+    first = profiler.folded(counts).splitlines()[0]
+    assert int(first.rsplit(" ", 1)[1]) == max(counts.values())
+
+
+def test_one_profile_at_a_time():
+    with profiler._running:
+        with pytest.raises(profiler.ProfilerBusy):
+            profiler.sample(threading.get_ident(), 0.01)
+
+
+async def test_phases_are_sent_as_server_timing(gateway, make_token):
+    resp = await gateway.get("/models", headers=bearer(make_token()))
+    phases = dict(entry.split(";dur=") for entry in resp.headers["server-timing"].split(", "))
+    assert {"auth", "total"} <= set(phases)
+    assert all(float(ms) >= 0 for ms in phases.values())
+
+
+async def test_slow_requests_are_logged(gateway, monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "SLOW_REQUEST_MS", 0)
+    await gateway.get("/token/missing")
+    [line] = [line for line in capsys.readouterr().out.splitlines() if line.startswith("Slow request ")]
+    logged = orjson.loads(line[len("Slow request "):])
+    assert (logged["route"], logged["status"]) == ("/token/{token}", 404)
+    assert logged["first_byte_ms"] <= logged["total_ms"]
+
+
+async def test_profile_route_is_for_admins_when_enabled(gateway, make_token, monkeypatch):
+    assert (await gateway.get("/debug/profile", headers=bearer(make_token(is_admin=True)))).status_code == 404
+    monkeypatch.setattr(profiler, "ENABLED", True)
+    assert (await gateway.get("/debug/profile", headers=bearer("not-a-token"))).status_code == 401
+    assert (await gateway.get("/debug/profile", headers=bearer(make_token()))).status_code == 403
+    too_long = {"seconds": profiler.MAX_SECONDS + 1}
+    assert (await gateway.get("/debug/profile", params=too_long, headers=bearer(make_token(is_admin=True)))).status_code == 422
+    resp = await gateway.get("/debug/profile", params={"seconds": 0.05}, headers=bearer(make_token(is_admin=True)))
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
@@ -0,0 +1,100 @@
+"""
+    The hot crud queries must be index lookups rather than table scans. Each case runs a crud
+    function inside a transaction that is rolled back, captures every SELECT it issues and
+    EXPLAINs it.
+"""
+import datetime
+
+import pytest
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Session
+
+from open_ai_token import crud, models
+from open_ai_token.database import engine
+
+USER = "U_PLAN_CHECK"
+TOKEN = "plan-check-token"
+SINCE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+# The lookups the gateway does per request or per admin call, plus the usage range scans
+QUERIES = {
+    "check_token": lambda db: crud.check_token(db, TOKEN),
+    "get_token": lambda db: crud.get_token(db, TOKEN),
+    "get_token_state": lambda db: crud.get_token_state(db, TOKEN),
+    "get_user_by_slack_id": lambda db: crud.get_user_by_slack_id(db, USER),
+    "get_user_by_email": lambda db: crud.get_user_by_email(db, "plan-check@example.com"),
+    "get_tokens_by_owner": lambda db: crud.get_tokens_by_owner(db, USER),
+    "get_users after a cursor": lambda db: crud.get_users(db, after=USER),
+    "get_tokens after a cursor": lambda db: crud.get_tokens(db, after=(SINCE, TOKEN)),
+    "get_tokens of an owner": lambda db: crud.get_tokens(db, after=(SINCE, TOKEN), user_id=USER),
+    "get_tokens that are blocked": lambda db: crud.get_tokens(db, is_blocked=True),
+    "get_tokens by uses left": lambda db: crud.get_tokens(db, min_uses_left=1, max_uses_left=10),
+    "usage of a token since": lambda db: db.scalars(
+        select(models.Usage).where(models.Usage.token_id == TOKEN, models.Usage.created_at >= SINCE).order_by(models.Usage.created_at)
+    ).all(),
+    "usage since": lambda db: db.scalars(select(models.Usage.id).where(models.Usage.created_at >= SINCE)).all(),
+}
+
+
+@pytest.fixture
+def plan_db(database):
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            if conn.dialect.name == "postgresql":
+                # Tiny tables are cheaper to scan, make the planner show whether an index is usable
+                conn.execute(text("SET LOCAL enable_seqscan = off"))
+            db = Session(bind=conn, join_transaction_mode="create_savepoint")
+            db.add(models.User(slack_id=USER, name="plan check", email="plan-check@example.com"))
+            db.add(models.Token(token=TOKEN, user_id=USER))
+            db.flush()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            db.add_all(models.Usage(token_id=TOKEN, endpoint="/chat/completions", created_at=now) for _ in range(3))
+            db.flush()
+            db.expunge_all()
+            yield conn, db
+        finally:
+            transaction.rollback()
+
+
+def partial_indexes(conn) -> set:
+    return {
+        row[1]
+        for table in ("users", "tokens", "usages")
+        for row in conn.exec_driver_sql(f"PRAGMA index_list('{table}')").fetchall()
+        if row[4]
+    }
+
+
+def full_scans(conn, statement: str, parameters) -> list:
+    if conn.dialect.name == "sqlite":
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        # Walking a partial index only reads the rows it covers
+        partial = partial_indexes(conn)
+        return [
+            row[-1] for row in rows
+            if row[-1].startswith("SCAN ") and not any(row[-1].endswith(f"INDEX {name}") for name in partial)
+        ]
+    rows = conn.exec_driver_sql("EXPLAIN " + statement, parameters).fetchall()
+    return [row[0].strip() for row in rows if "Seq Scan" in row[0]]
+
+
+@pytest.mark.parametrize("name", list(QUERIES))
+def test_query_uses_an_index(plan_db, name):
+    conn, db = plan_db
+    crud.token_cache.clear()
+    crud.invalid_token_cache.clear()
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        QUERIES[name](db)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    assert captured
+    assert [scan for statement, parameters in captured for scan in full_scans(conn, statement, parameters)] == []
@@ -0,0 +1,141 @@
+import contextlib
+import time
+
+import anyio
+import pytest
+
+from open_ai_token import crud, models, quota
+from open_ai_token.database import SessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def leases(monkeypatch, async_database):
+    monkeypatch.setattr(quota, "_leases", {})
+    monkeypatch.setattr(quota, "_refilling", {})
+    monkeypatch.setattr(quota, "LEASE_SIZE", 20)
+
+
+def uses_left(token: str) -> int:
+    with SessionLocal() as db:
+        return db.get(models.Token, token).uses_left
+
+
+def overwrite(token: str, value: int):
+    """
+        Set uses_left as another worker's admin route would, leaving this worker's lease in place
+    """
+    lease = quota._leases.get(token)
+    with SessionLocal() as db:
+        crud.update_tokens(db, {"uses_left": value}, tokens=[token])
+    if lease is not None:
+        quota._leases[token] = lease
+
+
+async def test_uses_are_spent_from_a_leased_block(make_token):
+    token = make_token(uses_left=100)
+    for _ in range(5):
+        await quota.consume(token)
+    assert uses_left(token) == 80
+    assert quota.remaining(token) == 15
+
+    await quota.release_all()
+    assert uses_left(token) == 95
+
+
+async def test_last_few_uses_are_leased_in_one_go(make_token):
+    token = make_token(uses_left=3)
+    for _ in range(3):
+        await quota.consume(token)
+    assert uses_left(token) == 0
+    with pytest.raises(ValueError):
+        await quota.consume(token)
+
+
+async def test_request_for_more_than_is_left_fails(make_token):
+    token = make_token(uses_left=3)
+    with pytest.raises(ValueError):
+        await quota.consume(token, 4)
+    assert uses_left(token) == 3
+
+
+async def test_release_after_an_overwrite_does_not_give_uses_back(make_token):
+    token = make_token(uses_left=100)
+    await quota.consume(token)
+    overwrite(token, 0)
+    await quota.release_all()
+    assert uses_left(token) == 0
+
+
+async def test_expired_lease_after_an_overwrite_is_not_given_back(make_token):
+    token = make_token(uses_left=100)
+    await quota.consume(token)
+    overwrite(token, 50)
+    quota._leases[token].expires_at = time.monotonic() - 1
+    await quota.release_expired()
+    assert uses_left(token) == 50
+
+
+async def test_lease_from_before_an_overwrite_is_not_returned_on_renewal(make_token):
+    token = make_token(uses_left=100)
+    await quota.consume(token)
+    overwrite(token, 10)
+    quota._leases[token].expires_at = time.monotonic() - 1
+    await quota.consume(token)
+    assert uses_left(token) == 0
+    assert quota.remaining(token) == 9
+
+
+@contextlib.contextmanager
+def database_down():
+    def lease_uses(*args):
+        raise ConnectionError("database is down")
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(quota, "lease_uses", lease_uses)
+        yield
+
+
+async def test_failed_renewal_keeps_the_live_lease(make_token):
+    token = make_token(uses_left=100)
+    await quota.consume(token)
+    with database_down(), pytest.raises(ConnectionError):
+        await quota.consume(token, 25)
+    assert quota.remaining(token) == 19
+
+    await quota.release_all()
+    assert uses_left(token) == 99
+
+
+async def test_failed_renewal_keeps_the_expired_lease_to_give_back(make_token):
+    token = make_token(uses_left=100)
+    await quota.consume(token)
+    quota._leases[token].expires_at = time.monotonic() - 1
+    with database_down(), pytest.raises(ConnectionError):
+        await quota.consume(token)
+    # What it gave back was rolled back with the failed lease
+    assert uses_left(token) == 80
+
+    await quota.release_expired()
+    assert uses_left(token) == 99
+
+
+async def test_concurrent_requests_never_overspend(make_token):
+    token = make_token(uses_left=30)
+    spent = 0
+
+    async def request():
+        nonlocal spent
+        try:
+            await quota.consume(token)
+        except ValueError:
+            return
+        spent += 1
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(50):
+            tg.start_soon(request)
+    assert spent == 30
+    await quota.release_all()
+    assert uses_left(token) == 0
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from open_ai_token import ratelimit
+from open_ai_token.schemas import TokenState
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture(autouse=True)
+def limiter(monkeypatch, clock):
+    backend = ratelimit.LocalBackend()
+    monkeypatch.setattr(ratelimit, "_local", backend)
+    monkeypatch.setattr(ratelimit, "_backend", backend)
+    monkeypatch.setattr(ratelimit, "ENABLED", True)
+    monkeypatch.setattr(ratelimit, "USER_MULTIPLIER", 1.5)
+    monkeypatch.setattr(ratelimit, "_stats", dict.fromkeys(ratelimit._stats, 0))
+    monkeypatch.setitem(ratelimit.TIERS, "default", {"requests": 4, "tokens": 1000})
+    monkeypatch.setitem(ratelimit.TIERS, "club_leader", {"requests": 40, "tokens": 10000})
+
+
+def state(token: str = "t1", user_id: str = "U1", **flags) -> TokenState:
+    return TokenState(token=token, user_id=user_id, **flags)
+
+
+async def allowed(sec: TokenState, count: int, tokens: int = 0) -> int:
+    passed = 0
+    for _ in range(count):
+        try:
+            await ratelimit.check(sec, tokens)
+        except ratelimit.RateLimited:
+            continue
+        passed += 1
+    return passed
+
+
+async def test_bucket_allows_a_minutes_worth_then_says_how_long_to_wait(clock):
+    sec = state()
+    assert await allowed(sec, 4) == 4
+    with pytest.raises(ratelimit.RateLimited) as limited:
+        await ratelimit.check(sec)
+    # Four a minute refill one every 15 seconds
+    assert limited.value.retry_after == pytest.approx(15)
+    assert ratelimit.retry_after(limited.value.retry_after) == "15"
+
+    clock[0] += 15
+    assert await allowed(sec, 2) == 1
+
+
+async def test_tokens_of_one_user_share_the_user_bucket():
+    assert await allowed(state("t1"), 4) == 4
+    # The user's bucket holds 6 requests, so the second token only gets what is left of it
+    assert await allowed(state("t2"), 4) == 2
+    assert await allowed(state("t3", user_id="U2"), 4) == 4
+
+
+async def test_tiers_follow_the_user_flags():
+    assert ratelimit.tier(state(can_use_superpowers=True, is_club_leader=True)) == "superpowers"
+    assert await allowed(state(is_club_leader=True), 10) == 10
+
+
+async def test_large_requests_are_capped_at_a_full_bucket():
+    assert await allowed(state(), 1, tokens=5000) == 1
+    assert await allowed(state(), 1, tokens=1) == 0
+
+
+async def test_settling_charges_the_real_usage():
+    charge = await ratelimit.check(state(), tokens=100)
+    await charge.settle(1100)
+    with pytest.raises(ratelimit.RateLimited):
+        await ratelimit.check(state(), tokens=1)
+
+
+async def test_concurrent_checks_never_overspend():
+    sec = state()
+    results = await asyncio.gather(*(ratelimit.check(sec) for _ in range(10)), return_exceptions=True)
+    assert sum(not isinstance(result, ratelimit.RateLimited) for result in results) == 4
+
+
+async def test_shared_backend_failure_falls_back_to_local_buckets(monkeypatch):
+    class Down:
+        name = "redis"
+
+        async def acquire(self, limits, force=False):
+            raise ConnectionError("redis is down")
+
+    monkeypatch.setattr(ratelimit, "_backend", Down())
+    assert await allowed(state(), 6) == 4
+    assert ratelimit.stats()["backend_errors"] == 6
+
+
+async def test_idle_buckets_are_forgotten(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, "IDLE_TTL", 60)
+    await ratelimit.check(state())
+    assert ratelimit.stats()["local_buckets"] == 4
+    clock[0] += 61
+    await ratelimit.check(state("t2", user_id="U2"))
+    assert ratelimit.stats()["local_buckets"] == 4
+
+
+def test_estimate_tokens():
+    assert ratelimit.estimate_tokens("400") == 100
+    assert ratelimit.estimate_tokens(None) == 0
+    assert ratelimit.estimate_tokens("lots") == 0
+
@@ -0,0 +1,134 @@
+import asyncio
+
+import httpx
+import pytest
+
+from open_ai_token import resilience
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(resilience, "BREAKER_FAILURES", 3)
+    monkeypatch.setattr(resilience, "BREAKER_COOLDOWN", 0.05)
+    monkeypatch.setattr(resilience, "HEDGE_AFTER", 0)
+
+
+def responses(*outcomes, headers=None):
+    """
+        A send that returns or raises each outcome in turn, repeating the last one
+    """
+    calls = []
+
+    async def send():
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return httpx.Response(outcome, headers=headers or {})
+
+    return send, calls
+
+
+async def trip(endpoint: str):
+    send, _ = responses(500)
+    for _ in range(resilience.BREAKER_FAILURES):
+        await resilience.call(endpoint, send, retry="never")
+    assert resilience.breaker(endpoint.strip("/")).open
+
+
+async def test_retries_server_errors_until_success():
+    send, calls = responses(502, 503, 200)
+    resp = await resilience.call("/chat/completions", send)
+    assert resp.status_code == 200
+    assert len(calls) == 3
+
+
+async def test_never_retry_returns_first_answer():
+    send, calls = responses(502, 200)
+    resp = await resilience.call("/batches", send, retry="never")
+    assert resp.status_code == 502
+    assert len(calls) == 1
+
+
+async def test_safe_retry_only_repeats_requests_upstream_never_got():
+    send, calls = responses(httpx.ReadTimeout("slow"), 200)
+    with pytest.raises(httpx.ReadTimeout):
+        await resilience.call("/embeddings", send)
+    assert len(calls) == 1
+
+    send, calls = responses(httpx.ConnectError("refused"), 200)
+    assert (await resilience.call("/embeddings", send)).status_code == 200
+    assert len(calls) == 2
+
+
+async def test_long_retry_after_is_not_waited_for():
+    send, calls = responses(429, headers={"retry-after": "600"})
+    resp = await resilience.call("/models", send, retry="all")
+    assert resp.status_code == 429
+    assert len(calls) == 1
+
+
+async def test_breaker_opens_and_closes_after_a_good_probe():
+    await trip("/images")
+    with pytest.raises(resilience.CircuitOpen):
+        await resilience.call("/images", responses(200)[0])
+    await asyncio.sleep(resilience.BREAKER_COOLDOWN)
+    assert (await resilience.call("/images", responses(200)[0])).status_code == 200
+    assert resilience.breaker("images").snapshot()["state"] == "closed"
+
+
+async def test_cancelled_probe_lets_the_next_call_probe():
+    await trip("/images")
+    await asyncio.sleep(resilience.BREAKER_COOLDOWN)
+
+    started = asyncio.Event()
+
+    async def hang():
+        started.set()
+        await asyncio.sleep(60)
+
+    probe = asyncio.ensure_future(resilience.call("/images", hang))
+    await started.wait()
+    assert resilience.breaker("images").snapshot()["state"] == "half_open"
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+
+    assert resilience.breaker("images").snapshot()["state"] == "open"
+    assert (await resilience.call("/images", responses(200)[0])).status_code == 200
+    assert resilience.breaker("images").snapshot()["state"] == "closed"
+
+
+async def test_probe_failing_unexpectedly_reopens_the_breaker():
+    await trip("/images")
+    await asyncio.sleep(resilience.BREAKER_COOLDOWN)
+
+    async def broken():
+        raise RuntimeError("bug")
+
+    with pytest.raises(RuntimeError):
+        await resilience.call("/images", broken)
+    gate = resilience.breaker("images")
+    assert gate.snapshot()["state"] == "open"
+    with pytest.raises(resilience.CircuitOpen):
+        await resilience.call("/images", responses(200)[0])
+    await asyncio.sleep(resilience.BREAKER_COOLDOWN)
+    assert (await resilience.call("/images", responses(200)[0])).status_code == 200
+
+
+async def test_hedge_returns_the_faster_copy(monkeypatch):
+    monkeypatch.setattr(resilience, "HEDGE_AFTER", 0.01)
+    calls = []
+
+    async def send():
+        calls.append(1)
+        await asyncio.sleep(1 if len(calls) == 1 else 0)
+        return httpx.Response(200, text=str(len(calls)))
+
+    resp = await resilience.call("/models", send, retry="all", hedge=True)
+    assert resp.text == "2"
+    assert len(calls) == 2
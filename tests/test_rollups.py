@@ -0,0 +1,90 @@
+import datetime
+import threading
+
+from open_ai_token import crud, models, rollups, usage
+
+
+def record(token: str, user_id: str, created_at: datetime.datetime, status_code: int = 200, tokens: int = 10) -> dict:
+    return {
+        "token_id": token,
+        "user_id": user_id,
+        "created_at": created_at,
+        "endpoint": "/chat/completions",
+        "model": "gpt-4o-mini",
+        "prompt_tokens": tokens,
+        "completion_tokens": tokens,
+        "total_tokens": 2 * tokens,
+        "status_code": status_code,
+    }
+
+
+def owner(token: str) -> str:
+    from open_ai_token.database import SessionLocal
+
+    with SessionLocal() as db:
+        return db.get(models.Token, token).user_id
+
+
+def summary(user_id: str, start: datetime.datetime, end: datetime.datetime) -> dict:
+    from open_ai_token.database import SessionLocal
+
+    with SessionLocal() as db:
+        rows = crud.get_usage_summary(db, rollups.ranges(start, end), ["user_id"], user_id=user_id)
+        return dict(rows[0]) if rows else {}
+
+
+def test_collect_adds_up_hours_and_days():
+    moment = datetime.datetime(2024, 3, 1, 10, 30, tzinfo=datetime.timezone.utc)
+    increments = rollups.collect([
+        record("t", "u", moment),
+        record("t", "u", moment + datetime.timedelta(minutes=10), status_code=500),
+        record("t", "u", moment + datetime.timedelta(hours=1)),
+    ])
+    hours = sorted((row["bucket"], row["requests"], row["errors"]) for row in increments if row["period"] == "hour")
+    assert hours == [(datetime.datetime(2024, 3, 1, 10), 2, 1), (datetime.datetime(2024, 3, 1, 11), 1, 0)]
+    [day] = [row for row in increments if row["period"] == "day"]
+    assert (day["bucket"], day["requests"], day["total_tokens"], day["user_id"]) == (datetime.datetime(2024, 3, 1), 3, 60, "u")
+
+
+def test_ranges_use_whole_days_and_hours_at_the_edges():
+    start = datetime.datetime(2024, 3, 1, 22, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(2024, 3, 4, 1, 30, tzinfo=datetime.timezone.utc)
+    assert sorted(rollups.ranges(start, end)) == [
+        ("day", datetime.datetime(2024, 3, 2), datetime.datetime(2024, 3, 4)),
+        ("hour", datetime.datetime(2024, 3, 1, 22), datetime.datetime(2024, 3, 2)),
+        ("hour", datetime.datetime(2024, 3, 4), datetime.datetime(2024, 3, 4, 2)),
+    ]
+    assert rollups.ranges(start, start) == []
+
+
+def test_backfill_rebuilds_what_the_writer_added(make_token):
+    token = make_token()
+    user_id = owner(token)
+    start = datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc)
+    usage._write([record(token, user_id, start + datetime.timedelta(hours=i), status_code=500 if i == 3 else 200) for i in range(30)])
+    written = summary(user_id, start, start + datetime.timedelta(days=3))
+    assert (written["requests"], written["errors"], written["total_tokens"]) == (30, 1, 600)
+
+    assert rollups.backfill(chunk_size=7) > 0
+    assert summary(user_id, start, start + datetime.timedelta(days=3)) == written
+
+
+def test_backfill_while_the_writer_runs_counts_each_row_once(make_token):
+    token = make_token()
+    user_id = owner(token)
+    start = datetime.datetime(2024, 4, 1, tzinfo=datetime.timezone.utc)
+    batches = 40
+    done = threading.Event()
+
+    def write():
+        for i in range(batches):
+            usage._write([record(token, user_id, start + datetime.timedelta(minutes=i))])
+        done.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while not done.is_set():
+        rollups.backfill(chunk_size=5)
+    writer.join()
+
+    assert summary(user_id, start, start + datetime.timedelta(days=1))["requests"] == batches
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from open_ai_token import scheduler
+from open_ai_token.schemas import TokenState
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def families(monkeypatch):
+    monkeypatch.setattr(scheduler, "_families", {})
+    monkeypatch.setitem(scheduler.LIMITS, "*", 1)
+
+
+def state(user_id: str, **flags) -> TokenState:
+    return TokenState(token=f"token-{user_id}", user_id=user_id, **flags)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class Waiters:
+    """
+        Queue requests behind a held slot and record the order they are admitted in
+    """
+
+    def __init__(self):
+        self.admitted = []
+        self.tasks = []
+
+    async def add(self, name: str, sec: TokenState, model: str = "gpt-3.5-turbo"):
+        async def wait():
+            slot = await scheduler.acquire(sec, model)
+            self.admitted.append((name, slot))
+
+        self.tasks.append(asyncio.ensure_future(wait()))
+        await settle()
+
+    async def drain(self) -> list:
+        order = []
+        while len(order) < len(self.tasks):
+            await settle()
+            name, slot = self.admitted[len(order)]
+            order.append(name)
+            slot.release()
+        await asyncio.gather(*self.tasks)
+        return order
+
+
+def test_models_map_to_the_first_matching_family():
+    assert scheduler.family_name("gpt-4o") == "gpt-4*"
+    assert scheduler.family_name("text-embedding-3-small") == "text-embedding*"
+    assert scheduler.family_name(None) == "*"
+
+
+async def test_calls_past_the_limit_wait_for_a_slot():
+    held = await scheduler.acquire(state("a"))
+    waiters = Waiters()
+    await waiters.add("b", state("b"))
+    assert waiters.admitted == []
+    assert scheduler.stats()["*"]["queued"] == 1
+
+    held.release()
+    held.release()
+    assert await waiters.drain() == ["b"]
+    assert scheduler.stats()["*"]["active"] == 0
+
+
+async def test_admins_then_club_leaders_go_first():
+    held = await scheduler.acquire(state("x"))
+    waiters = Waiters()
+    await waiters.add("default", state("d"))
+    await waiters.add("club_leader", state("c", is_club_leader=True))
+    await waiters.add("admin", state("a", is_admin=True))
+    held.release()
+    assert await waiters.drain() == ["admin", "club_leader", "default"]
+
+
+async def test_users_take_turns():
+    held = await scheduler.acquire(state("x"))
+    waiters = Waiters()
+    for i in range(3):
+        await waiters.add(f"busy{i}", state("busy"))
+    await waiters.add("other", state("other"))
+    held.release()
+    assert await waiters.drain() == ["busy0", "other", "busy1", "busy2"]
+
+
+async def test_full_queue_sheds_load(monkeypatch):
+    monkeypatch.setattr(scheduler, "QUEUE_SIZE", 1)
+    held = await scheduler.acquire(state("a"))
+    waiters = Waiters()
+    await waiters.add("b", state("b"))
+    with pytest.raises(scheduler.Overloaded):
+        await scheduler.acquire(state("c"))
+    assert scheduler.stats()["*"]["shed_full"] == 1
+    held.release()
+    await waiters.drain()
+
+
+async def test_waiting_too_long_sheds_load(monkeypatch):
+    monkeypatch.setattr(scheduler, "QUEUE_TIMEOUT", 0.01)
+    held = await scheduler.acquire(state("a"))
+    with pytest.raises(scheduler.Overloaded):
+        await scheduler.acquire(state("b"))
+    snapshot = scheduler.stats()["*"]
+    assert (snapshot["queued"], snapshot["shed_timeout"]) == (0, 1)
+    held.release()
+    assert scheduler.stats()["*"]["active"] == 0
+
+
+async def test_cancelled_waiters_give_up_their_place():
+    held = await scheduler.acquire(state("a"))
+    waiters = Waiters()
+    await waiters.add("gone", state("b"))
+    await waiters.add("c", state("c"))
+    waiters.tasks[0].cancel()
+    await settle()
+    assert scheduler.stats()["*"]["queued"] == 1
+
+    held.release()
+    await settle()
+    assert [name for name, _ in waiters.admitted] == ["c"]
+    waiters.admitted[0][1].release()
+    assert scheduler.stats()["*"]["active"] == 0
+
+
+async def test_families_are_limited_separately():
+    await scheduler.acquire(state("a"), "gpt-3.5-turbo")
+    slot = await asyncio.wait_for(scheduler.acquire(state("a"), "gpt-4o"), 1)
+    slot.release()
@@ -0,0 +1,142 @@
+import asyncio
+
+import httpx
+import pytest
+
+from open_ai_token import singleflight
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def flights(monkeypatch):
+    monkeypatch.setattr(singleflight, "ENABLED", True)
+    monkeypatch.setattr(singleflight, "_in_flight", {})
+    monkeypatch.setattr(singleflight, "_stats", dict.fromkeys(singleflight._stats, 0))
+
+
+class Upstream:
+    """
+        A streamed upstream response whose chunks are sent one at a time by the test
+    """
+
+    def __init__(self):
+        self.starts = 0
+        self.chunks: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+
+    async def body(self):
+        try:
+            while True:
+                chunk = await self.chunks.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.closed = True
+
+    async def start(self) -> httpx.Response:
+        self.starts += 1
+        return httpx.Response(200, content=self.body())
+
+    async def send(self, *chunks: bytes):
+        for chunk in chunks:
+            await self.chunks.put(chunk)
+        # Let the flight hand them to subscribers
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+
+async def read(subscription) -> bytes:
+    return b"".join([chunk async for chunk in subscription])
+
+
+def test_request_key_ignores_key_order():
+    assert singleflight.request_key("/x", {"a": 1, "b": 2}) == singleflight.request_key("/x", {"b": 2, "a": 1})
+    assert singleflight.request_key("/x", {"a": 1}) != singleflight.request_key("/y", {"a": 1})
+    assert singleflight.request_key("/x", b'{"a":1,"b":2}') != singleflight.request_key("/x", b'{"b":2,"a":1}')
+
+
+def test_only_deterministic_chats_are_shared():
+    assert singleflight.chat_eligible({"temperature": 0})
+    assert not singleflight.chat_eligible({"temperature": 0, "n": 2})
+    assert not singleflight.chat_eligible({})
+
+
+async def test_identical_calls_share_one_upstream_call():
+    started = []
+
+    async def start():
+        started.append(1)
+        await asyncio.sleep(0.01)
+        return {"data": []}, 200, {}
+
+    results = await asyncio.gather(*(singleflight.call(b"models", start) for _ in range(5)))
+    assert len(started) == 1
+    assert all(result is results[0] for result in results)
+    assert singleflight.stats()["in_flight"] == 0
+
+    await singleflight.call(b"models", start)
+    assert len(started) == 2
+
+
+async def test_followers_get_the_whole_stream():
+    upstream = Upstream()
+    leader = await singleflight.stream(b"chat", upstream.start)
+    await upstream.send(b"one ")
+    # Joins after the first chunk went out, and is replayed it
+    follower = await singleflight.stream(b"chat", upstream.start)
+    await upstream.send(b"two", None)
+
+    assert await asyncio.gather(read(leader), read(follower)) == [b"one two", b"one two"]
+    assert upstream.starts == 1
+    assert singleflight.stats()["followers"] == 1
+
+
+async def test_stream_keeps_going_when_the_leader_leaves():
+    upstream = Upstream()
+    leader = await singleflight.stream(b"chat", upstream.start)
+    follower = await singleflight.stream(b"chat", upstream.start)
+    await leader.aclose()
+    await upstream.send(b"still here", None)
+    assert await read(follower) == b"still here"
+
+
+async def test_upstream_is_closed_when_everyone_leaves():
+    upstream = Upstream()
+    leader = await singleflight.stream(b"chat", upstream.start)
+    follower = await singleflight.stream(b"chat", upstream.start)
+    await upstream.send(b"partial")
+    await leader.aclose()
+    await follower.aclose()
+    await upstream.send()
+    assert upstream.closed
+
+    # The abandoned flight is not joined, the next caller starts afresh
+    again = Upstream()
+    fresh = await singleflight.stream(b"chat", again.start)
+    await again.send(b"new", None)
+    assert await read(fresh) == b"new"
+
+
+async def test_slow_subscriber_is_cut_off(monkeypatch):
+    monkeypatch.setattr(singleflight, "SUBSCRIBER_BUFFER", 2)
+    upstream = Upstream()
+    fast = await singleflight.stream(b"chat", upstream.start)
+    slow = await singleflight.stream(b"chat", upstream.start)
+    received = []
+
+    async def keep_up():
+        async for chunk in fast:
+            received.append(chunk)
+
+    reader = asyncio.ensure_future(keep_up())
+    for _ in range(5):
+        await upstream.send(b"x")
+    await upstream.send(None)
+    await reader
+
+    assert received == [b"x"] * 5
+    await read(slow)
+    assert slow.dropped
+    assert singleflight.stats()["dropped_subscribers"] == 1
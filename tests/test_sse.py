@@ -0,0 +1,74 @@
+import orjson
+import pytest
+
+from open_ai_token import passthrough
+from open_ai_token.sse import UsageParser
+
+pytestmark = pytest.mark.anyio
+
+
+def event(payload) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+DELTA = event({"id": "c", "model": "gpt-4o", "choices": [{"index": 0, "delta": {"content": "hi"}, "finish_reason": None}]})
+FINISH = event({"id": "c", "model": "gpt-4o", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+USAGE = event({"id": "c", "model": "gpt-4o", "choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}})
+DONE = b"data: [DONE]\n\n"
+STREAM = DELTA + DELTA + FINISH + USAGE + DONE
+
+
+def relay(parser: UsageParser, chunks) -> bytes:
+    out = b"".join(parser.feed(chunk) for chunk in chunks)
+    return out + parser.close()
+
+
+def split(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, len(STREAM)])
+def test_stream_usage_is_read_across_chunk_boundaries(size):
+    parser = UsageParser()
+    assert relay(parser, split(STREAM, size)) == STREAM
+    assert parser.summary() == {"model": "gpt-4o", "finish_reason": "stop", "prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}
+    assert parser.events == 4
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, len(STREAM)])
+def test_usage_event_the_gateway_asked_for_is_not_relayed(size):
+    parser = UsageParser(strip_usage=True)
+    assert relay(parser, split(STREAM, size)) == DELTA + DELTA + FINISH + DONE
+    assert parser.summary()["total_tokens"] == 7
+
+
+def test_plain_json_response():
+    body = orjson.dumps({"model": "gpt-4o", "choices": [{"finish_reason": "length"}], "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}})
+    parser = UsageParser(streaming=False, strip_usage=True)
+    assert relay(parser, split(body, 10)) == body
+    assert parser.summary()["finish_reason"] == "length"
+    assert parser.summary()["total_tokens"] == 3
+
+
+def test_usage_is_added_only_when_the_client_did_not_ask():
+    assert passthrough.adds_stream_usage({"stream": True})
+    assert passthrough.adds_stream_usage({"stream": True, "stream_options": {"include_usage": False}})
+    assert not passthrough.adds_stream_usage({"stream": True, "stream_options": {"include_usage": True}})
+    assert not passthrough.adds_stream_usage({"stream": False})
+    raw = b'{"model": "gpt-4o", "stream": true}'
+    assert orjson.loads(passthrough.with_stream_usage(raw)) == {"model": "gpt-4o", "stream": True, "stream_options": {"include_usage": True}}
+
+
+async def test_streamed_chat_through_the_gateway(gateway, make_token):
+    headers = {"Authorization": f"Bearer {make_token()}"}
+    body = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+    resp = await gateway.post("/chat/completions", json=body, headers=headers)
+    events = [orjson.loads(line[6:]) for line in resp.text.split("\n\n") if line.startswith("data: {")]
+    assert resp.status_code == 200
+    assert all(event["choices"] for event in events)
+
+    resp = await gateway.post("/chat/completions", json=dict(body, stream_options={"include_usage": True}), headers=headers)
+    events = [orjson.loads(line[6:]) for line in resp.text.split("\n\n") if line.startswith("data: {")]
+    assert events[-1]["choices"] == []
+    assert events[-1]["usage"]["completion_tokens"] == 4
@@ -0,0 +1,99 @@
+import time
+
+import pytest
+from sqlalchemy import event, update
+
+from open_ai_token import crud, models, schemas
+from open_ai_token.cache import MISSING, TTLCache
+from open_ai_token.database import SessionLocal, engine
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    monkeypatch.setattr(crud, "token_cache", TTLCache(maxsize=100, ttl=30))
+    monkeypatch.setattr(crud, "invalid_token_cache", TTLCache(maxsize=100, ttl=60))
+
+
+@pytest.fixture
+def queries():
+    """
+        Count the statements sent to the database
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    yield statements
+    event.remove(engine, "before_cursor_execute", count)
+
+
+def state(token: str):
+    with SessionLocal() as db:
+        return crud.get_token_state(db, token)
+
+
+def owner(token: str) -> str:
+    with SessionLocal() as db:
+        return db.get(models.Token, token).user_id
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b", MISSING) is MISSING
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = TTLCache(ttl=10)
+    cache.set("a", None)
+    assert cache.get("a", MISSING) is None
+    now[0] += 10
+    assert cache.get("a", MISSING) is MISSING
+    assert len(cache) == 0
+
+
+def test_token_state_is_read_once(make_token, queries):
+    token = make_token(is_admin=True)
+    first = state(token)
+    assert first.is_admin and first.uses_left == 1000
+    queries.clear()
+    assert state(token) == first
+    assert queries == []
+
+
+def test_unknown_tokens_are_cached_as_invalid(database, queries):
+    assert state("no-such-token") is None
+    queries.clear()
+    assert state("no-such-token") is None
+    assert queries == []
+    assert crud.token_cache.get("no-such-token", MISSING) is MISSING
+
+
+def test_changes_through_crud_invalidate_the_cached_state(make_token):
+    token = make_token()
+    assert not state(token).is_blocked
+    with SessionLocal() as db:
+        crud.block_token(db, schemas.TokenUse(token=token, user_id=owner(token)))
+    assert state(token).is_blocked
+
+
+def test_direct_writes_are_seen_after_the_ttl(make_token, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    token = make_token()
+    assert state(token).uses_left == 1000
+    with SessionLocal() as db:
+        db.execute(update(models.Token).where(models.Token.token == token).values(uses_left=7))
+        db.commit()
+    assert state(token).uses_left == 1000
+    now[0] += 30
+    assert state(token).uses_left == 7
+
@@ -0,0 +1,97 @@
+import datetime
+
+import anyio
+import pytest
+from sqlalchemy import func, select
+
+from open_ai_token import models, usage
+from open_ai_token.database import SessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+async def writer(monkeypatch, database):
+    for name in ("_queue", "_batch_ready", "_writer", "_maintenance"):
+        monkeypatch.setattr(usage, name, None)
+    monkeypatch.setattr(usage, "_stats", dict.fromkeys(usage._stats, 0))
+    monkeypatch.setattr(usage, "FLUSH_INTERVAL", 0.01)
+    yield
+    await usage.shutdown()
+
+
+def record(token: str, **fields) -> dict:
+    return dict({
+        "token_id": token,
+        "user_id": None,
+        "created_at": datetime.datetime.now(),
+        "request_data": {"model": "gpt-4o-mini"},
+        "response_data": None,
+        "endpoint": "/chat/completions",
+        "model": "gpt-4o-mini",
+        "status_code": 200,
+    }, **fields)
+
+
+def rows(token: str) -> int:
+    with SessionLocal() as db:
+        return db.scalar(select(func.count()).select_from(models.Usage).where(models.Usage.token_id == token))
+
+
+async def wait_for(condition):
+    with anyio.fail_after(5):
+        while not condition():
+            await anyio.sleep(0.01)
+
+
+async def test_rows_are_written_in_batches(make_token, monkeypatch):
+    monkeypatch.setattr(usage, "BATCH_SIZE", 2)
+    token = make_token()
+    await usage.startup()
+    for _ in range(5):
+        await usage.log(record(token))
+    await wait_for(lambda: usage.stats()["written"] == 5)
+    assert rows(token) == 5
+    assert usage.stats()["batches"] >= 3
+
+
+async def test_shutdown_writes_what_is_queued(make_token, monkeypatch):
+    monkeypatch.setattr(usage, "FLUSH_INTERVAL", 60)
+    token = make_token()
+    await usage.startup()
+    for _ in range(3):
+        await usage.log(record(token))
+    assert rows(token) == 0
+    await usage.shutdown()
+    assert rows(token) == 3
+
+
+async def test_full_queue_drops_rows_after_a_short_wait(make_token, monkeypatch):
+    monkeypatch.setattr(usage, "QUEUE_SIZE", 2)
+    monkeypatch.setattr(usage, "ENQUEUE_TIMEOUT", 0.01)
+    token = make_token()
+    for _ in range(3):
+        await usage.log(record(token))
+    stats = usage.stats()
+    assert (stats["enqueued"], stats["blocked"], stats["dropped"], stats["queued"]) == (2, 1, 1, 2)
+
+
+async def test_cancelling_a_blocked_log_is_not_swallowed(make_token, monkeypatch):
+    monkeypatch.setattr(usage, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(usage, "ENQUEUE_TIMEOUT", 10)
+    token = make_token()
+    await usage.log(record(token))
+    with anyio.move_on_after(0.01) as scope:
+        await usage.log(record(token))
+    assert scope.cancelled_caught
+    assert usage.stats()["dropped"] == 1
+
+
+async def test_failed_batches_are_counted_not_raised(make_token):
+    token = make_token()
+    await usage.startup()
+    await usage.log(record(token, created_at="yesterday"))
+    await wait_for(lambda: usage.stats()["failed"] == 1)
+    await usage.log(record(token))
+    await wait_for(lambda: usage.stats()["written"] == 1)
+    assert rows(token) == 1